@@ -0,0 +1,173 @@
+import math
+import os
+import threading
+import engine
+
+# Estimated CPU-seconds to encode a megapixel, by AVIF profile or output format.
+# Measured with one encoder thread on a photo; only the ratios need to be right.
+ENCODE_SECONDS_PER_MEGAPIXEL = {'fast': 0.05, 'balanced': 0.3, 'archival': 5.0, 'png': 0.35, 'jpg': 0.02}
+# CPU-seconds to decode a megapixel, by input format
+DECODE_SECONDS_PER_MEGAPIXEL = {'HEIF': 0.2}
+DEFAULT_DECODE_SECONDS_PER_MEGAPIXEL = 0.03
+# The target mode encodes a small proxy a few times before its full-size encode
+TARGET_SEARCH_FACTOR = 1.5
+# Cost of a HEIF preview, which decodes an embedded thumbnail
+PREVIEW_SECONDS = 0.05
+# Pixels per byte assumed for declared files whose header wasn't read yet
+PIXELS_PER_BYTE = {'png': 0.5, 'jpg': 6, 'jpeg': 6, 'heic': 8, 'heif': 8}
+
+# Estimated CPU-seconds of work converting at the same time; more waits its turn
+ADMISSION_CAPACITY = float(os.environ.get('ADMISSION_CAPACITY', '0')) or engine.CONVERT_WORKERS * 60.0
+# Work that would wait longer than this many seconds to start is refused with 503
+ADMISSION_MAX_WAIT = float(os.environ.get('ADMISSION_MAX_WAIT', '120'))
+
+def file_cost(filename, mode, options, pixels, width=None, images=1, format=None):
+    """Estimated CPU-seconds of converting one file"""
+    if mode == 'png' and engine.heif_images(options) == 'preview':
+        return PREVIEW_SECONDS
+    megapixels = pixels / 1e6
+    extension, _ = engine.output_settings(filename, mode, options)
+    per_megapixel = ENCODE_SECONDS_PER_MEGAPIXEL[engine.avif_profile(options) if extension == 'avif' else extension]
+    decode = DECODE_SECONDS_PER_MEGAPIXEL.get(format, DEFAULT_DECODE_SECONDS_PER_MEGAPIXEL) * megapixels
+    if mode == 'responsive':
+        # Variants cost in proportion to their area
+        width = width or math.isqrt(int(pixels * 4 / 3))
+        area = sum((variant / width) ** 2 if variant else 1.0
+                   for _, variant in engine.output_plan(filename, mode, options, width))
+        return decode + per_megapixel * megapixels * area
+    if mode == 'target':
+        return decode + per_megapixel * megapixels * TARGET_SEARCH_FACTOR
+    if mode == 'png' and engine.heif_images(options) == 'all':
+        return (decode + per_megapixel * megapixels) * images
+    return decode + per_megapixel * megapixels
+
+def batch_cost(uploads, mode, options):
+    """Estimated CPU-seconds of converting ingested uploads, from their headers"""
+    return sum(file_cost(upload.filename, mode, options, upload.pixels, upload.width, upload.images,
+                         upload.format) for upload in uploads)
+
+def declared_cost(files, mode, options):
+    """Estimated CPU-seconds of files known only by (name, filename, size)"""
+    cost = 0.0
+    for _, filename, size in files:
+        extension = filename.rsplit('.', 1)[-1].lower()
+        pixels = size * PIXELS_PER_BYTE.get(extension, 1)
+        cost += file_cost(filename, mode, options, pixels, format='HEIF' if mode == 'png' else None)
+    return cost
+
+class Ticket:
+    """Work waiting for or holding admission; remaining shrinks as it progresses"""
+
+    def __init__(self, client, cost, group, slots, start):
+        self.client = client
+        self.cost = cost
+        self.remaining = cost
+        self.group = group
+        self.slots = slots
+        # Virtual start time under fair queueing
+        self.start = start
+
+class FairScheduler:
+    """Admit work by estimated cost, sharing the capacity fairly between clients.
+
+    Work runs once its cost fits next to the work already running, or when
+    nothing runs, and its group (batches, chunked files) has a free slot.
+    Waiting work is ordered by start-time fair queueing: each client's work
+    is stamped with the virtual time its previous work would have finished,
+    so a client with a large backlog doesn't hold up one with a small job.
+    """
+
+    def __init__(self, capacity, throughput, max_wait):
+        self.capacity = capacity
+        # CPU-seconds of work done per second, one per encoder process
+        self.throughput = throughput
+        self.max_wait = max_wait
+        self._cond = threading.Condition()
+        self._waiting = []  # in arrival order
+        self._running = []
+        self._virtual = 0.0
+        self._finish = {}  # client -> virtual time its queued work finishes
+
+    def _wait_seconds(self, client, cost):
+        """Estimated seconds until work of client starts, if it was queued now"""
+        own = sum(ticket.cost for ticket in self._waiting if ticket.client == client)
+        others = {}
+        for ticket in self._waiting:
+            if ticket.client != client:
+                others[ticket.client] = others.get(ticket.client, 0.0) + ticket.cost
+        # Fair queueing lets each other client go ahead by about as much as this one has queued
+        ahead = (sum(ticket.remaining for ticket in self._running) + own
+                 + sum(min(queued, own + cost) for queued in others.values()))
+        return max(0.0, ahead - max(0.0, self.capacity - cost)) / self.throughput
+
+    def retry_after(self, client, cost):
+        """Seconds after which to offer work that would wait too long now, None if it can queue"""
+        with self._cond:
+            wait = self._wait_seconds(client, cost)
+        if wait <= self.max_wait:
+            return None
+        return max(1, math.ceil(wait - self.max_wait))
+
+    def _next(self):
+        running = {}
+        for ticket in self._running:
+            running[ticket.group] = running.get(ticket.group, 0) + 1
+        candidates = [ticket for ticket in self._waiting if running.get(ticket.group, 0) < ticket.slots]
+        # min() keeps the earliest arrival among equal start times
+        return min(candidates, key=lambda ticket: ticket.start, default=None)
+
+    def _admissible(self, ticket):
+        if self._next() is not ticket:
+            return False
+        return not self._running or sum(running.remaining for running in self._running) + ticket.cost <= self.capacity
+
+    def enqueue(self, client, cost, group='batch', slots=1):
+        """Queue work of client without waiting; returns its Ticket for wait()"""
+        with self._cond:
+            start = max(self._virtual, self._finish.get(client, 0.0))
+            ticket = Ticket(client, cost, group, slots, start)
+            self._finish[client] = start + cost
+            self._waiting.append(ticket)
+            return ticket
+
+    def wait(self, ticket):
+        """Block until a queued ticket may run; release() it once done"""
+        with self._cond:
+            while not self._admissible(ticket):
+                self._cond.wait()
+            self._waiting.remove(ticket)
+            self._running.append(ticket)
+            self._virtual = max(self._virtual, ticket.start)
+            # Let the next in line check whether it fits as well
+            self._cond.notify_all()
+            return ticket
+
+    def acquire(self, client, cost, group='batch', slots=1):
+        """Wait until work of client may run; returns its Ticket for progress() and release()"""
+        return self.wait(self.enqueue(client, cost, group, slots))
+
+    def progress(self, ticket, done):
+        """Record that the fraction done of a running ticket's work is finished"""
+        with self._cond:
+            ticket.remaining = ticket.cost * max(0.0, 1.0 - done)
+            self._cond.notify_all()
+
+    def release(self, ticket):
+        with self._cond:
+            self._running.remove(ticket)
+            if not any(other.client == ticket.client for other in self._waiting + self._running):
+                # Forget idle clients, a returning one starts at the current virtual time
+                self._finish.pop(ticket.client, None)
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'waiting': len(self._waiting),
+                'waiting_cost': sum(ticket.cost for ticket in self._waiting),
+                'running': len(self._running),
+                'running_cost': sum(ticket.remaining for ticket in self._running),
+                'capacity': self.capacity
+            }
+
+scheduler = FairScheduler(ADMISSION_CAPACITY, engine.CONVERT_WORKERS, ADMISSION_MAX_WAIT)
@@ -1,79 +1,184 @@
+import plugins  # first, so the startup report times the imports below
 import math
 import shutil
-from flask import Flask, request, render_template, send_file, flash, redirect, url_for, session, after_this_request
-from PIL import Image
-import pillow_avif
-import pillow_heif
+from flask import Flask, Request, Response, request, render_template, flash, redirect, url_for
 import os
 import io
 import zipfile
 import uuid
 import tempfile
-import math
+import hashlib
+from urllib.parse import quote
+import werkzeug.utils
 from werkzeug.utils import secure_filename
+from werkzeug.middleware.proxy_fix import ProxyFix
+plugins.checkpoint('import Flask')
+import admission
+import engine
+import quality
+plugins.checkpoint('import engine, Pillow and numpy')
+import jobs
+import metrics
+import storage
+from broker import MemoryBroker, task_broker
+from cache import conversion_cache
+from ingest import ingest, IngestError
+from registry import BatchRegistry, adopt_folders
+from results import CONVERTED_FOLDER, result_store
+from resumable import ChunkedBatch, ChunkError, UPLOAD_CHUNK_BYTES, MAX_BATCH_BYTES
+plugins.checkpoint('import jobs and open the cache and result stores')
+
+UPLOAD_FOLDER = storage.path('uploads')
+# Uploaded files larger than this are spooled to UPLOAD_FOLDER while the request is parsed
+UPLOAD_SPOOL_BYTES = int(os.environ.get('UPLOAD_SPOOL_BYTES', str(512 * 1024)))
 
-# Register HEIF opener
-pillow_heif.register_heif_opener()
+class SpoolingRequest(Request):
+    """Keeps at most UPLOAD_SPOOL_BYTES of each uploaded file in memory"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # On the upload volume rather than /tmp, which may be RAM-backed in containers
+        return tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES, mode='rb+', dir=UPLOAD_FOLDER)
 
 app = Flask(__name__)
+app.request_class = SpoolingRequest
 app.secret_key = 'your-secret-key-change-this'
-app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB max total size
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_CONTENT_LENGTH', str(100 * 1024 * 1024)))  # 100MB max total size
+BUSY_MESSAGE = 'Server is busy, please try again in a moment'
+# Reverse proxies in front of the app; the client address is taken from their X-Forwarded-For
+PROXY_COUNT = int(os.environ.get('PROXY_COUNT', '0'))
+if PROXY_COUNT:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_COUNT)
+
+def client_id():
+    """Who sent the request, for sharing the conversion capacity fairly"""
+    return request.remote_addr or 'unknown'
 
-CONVERTED_FOLDER = 'converted'
+def busy(retry_after):
+    """Message and headers of a 503 for work the server can't take before retry_after seconds"""
+    if not retry_after:
+        return BUSY_MESSAGE, {}
+    return f"Server is busy, please try again in {retry_after} seconds", {'Retry-After': str(retry_after)}
 
 # Create directories if they don't exist
 os.makedirs(CONVERTED_FOLDER, exist_ok=True)
+os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 def allowed_file(filename, mode='avif'):
     if not filename or '.' not in filename:
         return False
     ext = filename.rsplit('.', 1)[1].lower()
-    if mode == 'avif':
-        return ext in ['png', 'jpg', 'jpeg']
-    elif mode == 'png':
-        return ext in ['heic', 'heif']
-    elif mode == 'compress':
-        return ext in ['png', 'jpg', 'jpeg']
-    return False
+    return ext in engine.MODE_EXTENSIONS.get(mode, ())
 
 import time
 import threading
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Seconds a batch is kept after it was created, and at least after each download
+BATCH_TTL = int(os.environ.get('BATCH_TTL', '600'))
+# Longest sleep of the cleanup thread; it wakes earlier when a batch is due
+CLEANUP_INTERVAL = 60
+# Resyncing the cache index lists the whole cache folder, so it runs less often
+CACHE_TRIM_INTERVAL = 3600
+
+# Folder on this node's own disk for the batch registry and the cleanup lock.
+# SQLite and flock aren't reliable across hosts on network filesystems, so
+# each node keeps its own and sweeps the shared storage by itself.
+STATE_FOLDER = os.environ.get('STATE_FOLDER', 'state')
+os.makedirs(STATE_FOLDER, exist_ok=True)
+
+batch_registry = BatchRegistry(os.path.join(STATE_FOLDER, 'batches.sqlite'))
+
+def touch_batch(batch_id):
+    """Keep a batch for at least BATCH_TTL more seconds, on every node"""
+    batch_registry.touch(batch_id, BATCH_TTL)
+    # Other nodes' registries only see accesses through the shared folder
+    result_store.touch(batch_id)
 
 def cleanup_old_files():
-    """Clean up folders older than 10 minutes"""
-    current_time = time.time()
-    if os.path.exists(CONVERTED_FOLDER):
-        for batch_id in os.listdir(CONVERTED_FOLDER):
-            batch_path = os.path.join(CONVERTED_FOLDER, batch_id)
-            if os.path.isdir(batch_path):
-                # Check if the folder itself is old
-                if current_time - os.path.getctime(batch_path) > 600:
-                    try:
-                        shutil.rmtree(batch_path)
-                    except:
-                        pass
-            elif os.path.isfile(batch_path) and batch_id.startswith('converted_') and batch_id.endswith('.zip'):
-                # Clean up temporary zip files
-                if current_time - os.path.getctime(batch_path) > 300: # 5 minutes for zips
-                    try:
-                        os.remove(batch_path)
-                    except:
-                        pass
+    """Remove the batches whose TTL has expired"""
+    for batch_id in batch_registry.due():
+        if batch_active(batch_id):
+            # Still converting, check again once it had time to finish
+            batch_registry.touch(batch_id, BATCH_TTL)
+            continue
+        accessed_at = result_store.accessed_at(batch_id)
+        if accessed_at and accessed_at + BATCH_TTL > time.time():
+            # Downloaded through another node since this one registered it
+            batch_registry.touch(batch_id, accessed_at + BATCH_TTL - time.time())
+            continue
+        remove_batch(batch_id)
+
+def batch_active(batch_id):
+    """Whether a batch is still queued or converting, as a job or a chunked upload"""
+    chunked = load_chunked_batch(batch_id)
+    return jobs.is_active(batch_id) or bool(chunked and chunked.is_active())
+
+def remove_batch(batch_id):
+    """Delete a batch's outputs, uploads and status, then forget it"""
+    result_store.remove(batch_id)
+    shutil.rmtree(os.path.join(UPLOAD_FOLDER, batch_id), ignore_errors=True)
+    jobs.forget(batch_id)
+    batch_registry.remove(batch_id)
+
+def next_cleanup_delay():
+    next_expiry = batch_registry.next_expiry()
+    if next_expiry is None:
+        return CLEANUP_INTERVAL
+    return min(CLEANUP_INTERVAL, max(1, next_expiry - time.time()))
+
+# Held by the one process per host that runs the cleanup sweep
+CLEANUP_LOCK = os.path.join(STATE_FOLDER, 'cleanup.lock')
+
+def acquire_cleanup_lock():
+    """Try to become the cleanup process; returns the open lock file or None"""
+    if fcntl is None:
+        # No flock on Windows, where only the single-process dev server runs
+        return True
+    lock_file = open(CLEANUP_LOCK, 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
 
 def start_cleanup_thread():
     def run_cleanup():
+        lock = None
+        trimmed_at = 0
         while True:
-            cleanup_old_files()
-            time.sleep(60)
-    
+            delay = CLEANUP_INTERVAL
+            # Every worker process retries, so another one takes over if the holder exits
+            if not lock:
+                lock = acquire_cleanup_lock()
+                # Adopt the existing batches as soon as this process holds the lock
+                trimmed_at = 0
+            if lock:
+                if time.time() - trimmed_at > CACHE_TRIM_INTERVAL:
+                    # Batches from before the registry, from a crash before they were
+                    # registered, or created through other nodes sharing the storage
+                    adopt_folders(batch_registry, [CONVERTED_FOLDER, UPLOAD_FOLDER], BATCH_TTL)
+                    # Cached outputs are kept outside CONVERTED_FOLDER and only trimmed to their size cap
+                    conversion_cache.trim()
+                    trimmed_at = time.time()
+                with metrics.cleanup_seconds.time():
+                    cleanup_old_files()
+                delay = next_cleanup_delay()
+            jobs.prune()
+            time.sleep(delay)
+
     thread = threading.Thread(target=run_cleanup, daemon=True)
     thread.start()
 
 # Start background cleanup
 if not os.environ.get('WERKZEUG_RUN_MAIN'): # Prevent double-start in debug mode
     start_cleanup_thread()
-
-# ... (start_cleanup_thread remains same, just ensuring it calls this updated version)
+    if plugins.prewarm_modes():
+        # In the background, so the first requests are served while it runs
+        threading.Thread(target=engine.prewarm, args=(plugins.prewarm_modes(),), daemon=True).start()
 
 @app.route('/')
 def index():
@@ -86,21 +191,33 @@ def upload_file():
     else:
         return upload_form()
 
-def upload_ajax():
-    files = request.files.getlist('files')
-    mode = request.form.get('mode', 'avif')
-    
-    if not files or all(f.filename == '' for f in files):
-        return {'success': False, 'error': 'No files selected'}
-    
+def conversion_options(form):
+    """Collect the per-request encoder choices sent with the upload form"""
+    profile = form.get('profile', engine.DEFAULT_PROFILE)
+    if profile not in engine.AVIF_PROFILES:
+        profile = engine.DEFAULT_PROFILE
+    return {
+        'profile': profile,
+        'widths': engine.parse_widths(form.get('widths')) or engine.responsive_widths(None),
+        'target': quality.parse_target(form.get('target')) or engine.quality_target(None),
+        'images': engine.heif_images(form),
+        'metadata': engine.heif_metadata(form)
+    }
+
+def store_uploads(files, mode, options):
+    """Save the allowed uploads of a new batch and queue it for conversion.
+
+    Returns (job, error); error is set when no file was accepted. Raises
+    jobs.QueueFull when the server can't take another batch right now.
+    """
     batch_id = str(uuid.uuid4())[:12]
     batch_folder = os.path.join(CONVERTED_FOLDER, batch_id)
-    os.makedirs(batch_folder, exist_ok=True)
-    
-    converted_files = []
+    upload_folder = os.path.join(UPLOAD_FOLDER, batch_id)
+    os.makedirs(upload_folder, exist_ok=True)
+
+    uploads = []
     errors = []
     skipped = []
-    
     for file in files:
         if not file or not file.filename:
             continue
@@ -108,65 +225,52 @@ def upload_ajax():
             skipped.append(file.filename)
             continue
         filename = secure_filename(file.filename)
+        # Prefix with the position so identical names don't overwrite each other
+        input_path = os.path.join(upload_folder, f"{len(uploads)}_{filename}")
         try:
-            file.stream.seek(0)
-            original_size = len(file.read())
-            file.stream.seek(0)
-            img = Image.open(file.stream)
-            img.verify()
-            file.stream.seek(0)
-            img = Image.open(file.stream)
-            
-            base_name = filename.rsplit('.', 1)[0]
-            if mode == 'avif':
-                if img.mode in ('LA', 'P'):
-                    img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
-                output_filename = f"{base_name}.avif"
-                output_path = os.path.join(batch_folder, output_filename)
-                img.save(output_path, 'AVIF', lossless=True)
-            elif mode == 'png':
-                if img.mode not in ('RGB', 'RGBA'):
-                    img = img.convert('RGB')
-                output_filename = f"{base_name}.png"
-                output_path = os.path.join(batch_folder, output_filename)
-                img.save(output_path, 'PNG')
-            elif mode == 'compress':
-                original_ext = filename.rsplit('.', 1)[1].lower()
-                if original_ext in ['jpg', 'jpeg']:
-                    if img.mode in ('RGBA', 'LA'): img = img.convert('RGB')
-                    output_filename = f"{base_name}.jpg"
-                    output_path = os.path.join(batch_folder, output_filename)
-                    img.save(output_path, 'JPEG', quality=95, optimize=True)
-                else:
-                    output_filename = f"{base_name}.png"
-                    output_path = os.path.join(batch_folder, output_filename)
-                    img.save(output_path, 'PNG', optimize=True)
-            
-            converted_size = os.path.getsize(output_path)
-            savings_percent = ((original_size - converted_size) / original_size) * 100
-            
-            converted_files.append({
-                'filename': output_filename,
-                'original_name': filename,
-                'original_size': original_size,
-                'converted_size': converted_size,
-                'savings_percent': savings_percent
-            })
-        except Exception as e:
+            with metrics.stage_seconds.time(mode=mode, stage='ingest'):
+                uploads.append(ingest(file, filename, input_path))
+        except IngestError as e:
             errors.append(f"{file.filename}: {str(e)}")
+    metrics.files.inc(len(skipped), mode=mode, result='skipped')
+    metrics.files.inc(len(errors), mode=mode, result='failed')
+
+    if not uploads:
+        shutil.rmtree(upload_folder, ignore_errors=True)
+        return None, 'No files were converted successfully'
+
+    os.makedirs(batch_folder, exist_ok=True)
+    batch_registry.register(batch_id, BATCH_TTL)
+    try:
+        return jobs.submit(batch_id, mode, options, batch_folder, upload_folder, uploads, skipped, errors,
+                           client_id()), None
+    except jobs.QueueFull:
+        metrics.batches_rejected.inc()
+        batch_registry.remove(batch_id)
+        shutil.rmtree(upload_folder, ignore_errors=True)
+        shutil.rmtree(batch_folder, ignore_errors=True)
+        raise
+
+def upload_ajax():
+    files = request.files.getlist('files')
+    mode = request.form.get('mode', 'avif')
     
-    if not converted_files:
-        return {'success': False, 'error': 'No files were converted successfully'}
+    if not files or all(f.filename == '' for f in files):
+        return {'success': False, 'error': 'No files selected'}
+    
+    try:
+        job, error = store_uploads(files, mode, conversion_options(request.form))
+    except jobs.QueueFull as e:
+        message, headers = busy(e.retry_after)
+        return {'success': False, 'error': message, 'retry_after': e.retry_after}, 503, headers
+    if error:
+        return {'success': False, 'error': error}
     
     return {
         'success': True,
-        'batch_id': batch_id,
-        'files': converted_files,
-        'errors': errors,
-        'skipped': skipped,
-        'is_batch': len(converted_files) > 1,
-        'mode': mode
-    }
+        'batch_id': job.batch_id,
+        'status_url': url_for('job_status', batch_id=job.batch_id)
+    }, 202
 
 def upload_form():
     mode = request.form.get('mode', 'avif')
@@ -175,121 +279,315 @@ def upload_form():
         flash('No files selected')
         return redirect(url_for('index'))
     
-    batch_id = str(uuid.uuid4())[:12]
-    batch_folder = os.path.join(CONVERTED_FOLDER, batch_id)
-    os.makedirs(batch_folder, exist_ok=True)
-    
-    converted_files = []
-    errors = []
-    skipped = []
-    
-    for file in files:
-        if not file or not file.filename: continue
-        if not allowed_file(file.filename, mode):
-            skipped.append(file.filename)
-            continue
-        filename = secure_filename(file.filename)
-        try:
-            file.stream.seek(0)
-            original_size = len(file.read())
-            file.stream.seek(0)
-            img = Image.open(file.stream)
-            img.verify()
-            file.stream.seek(0)
-            img = Image.open(file.stream)
-            base_name = filename.rsplit('.', 1)[0]
-            if mode == 'avif':
-                if img.mode in ('LA', 'P'):
-                    img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
-                output_filename = f"{base_name}.avif"
-                output_path = os.path.join(batch_folder, output_filename)
-                img.save(output_path, 'AVIF', lossless=True)
-            elif mode == 'png':
-                if img.mode not in ('RGB', 'RGBA'):
-                    img = img.convert('RGB')
-                output_filename = f"{base_name}.png"
-                output_path = os.path.join(batch_folder, output_filename)
-                img.save(output_path, 'PNG')
-            else:
-                original_ext = filename.rsplit('.', 1)[1].lower()
-                if original_ext in ['jpg', 'jpeg']:
-                    if img.mode in ('RGBA', 'LA'): img = img.convert('RGB')
-                    output_filename = f"{base_name}.jpg"
-                    output_path = os.path.join(batch_folder, output_filename)
-                    img.save(output_path, 'JPEG', quality=95, optimize=True)
-                else:
-                    output_filename = f"{base_name}.png"
-                    output_path = os.path.join(batch_folder, output_filename)
-                    img.save(output_path, 'PNG', optimize=True)
-            
-            converted_size = os.path.getsize(output_path)
-            converted_files.append({
-                'filename': output_filename,
-                'original_name': filename,
-                'original_size': original_size,
-                'converted_size': converted_size,
-                'savings_percent': ((original_size - converted_size) / original_size) * 100
-            })
-        except Exception as e:
-            errors.append(f"{file.filename}: {str(e)}")
+    try:
+        job, error = store_uploads(files, mode, conversion_options(request.form))
+    except jobs.QueueFull as e:
+        # Rendered rather than redirected, so proxies and clients see the 503 and Retry-After
+        message, headers = busy(e.retry_after)
+        flash(message)
+        return render_template('index.html'), 503, headers
+    if error:
+        flash(error)
+        return redirect(url_for('index'))
 
-    if not converted_files:
-        flash('No files were converted successfully')
+    # Plain form posts can't poll, so wait for the queued job here
+    job.wait()
+    results = job.result()
+    if not results['success']:
+        flash(results['error'])
         return redirect(url_for('index'))
 
-    return render_template('index.html', results={
+    return render_template('index.html', results=results)
+
+def load_chunked_batch(batch_id):
+    batch_id = secure_filename(batch_id)
+    return ChunkedBatch.load(batch_id, os.path.join(UPLOAD_FOLDER, batch_id),
+                             os.path.join(CONVERTED_FOLDER, batch_id))
+
+# Fields of a chunked upload request that are sent as text, like the form's
+TEXT_FIELDS = ('mode', 'profile', 'widths', 'target', 'images', 'metadata')
+
+def invalid_upload_request(data):
+    """Describe what is malformed in a chunked upload request, None if it's well formed"""
+    if not isinstance(data, dict):
+        return 'Request body must be a JSON object'
+    for field in TEXT_FIELDS:
+        if data.get(field) is not None and not isinstance(data[field], str):
+            return f"'{field}' must be a string"
+    if not isinstance(data.get('files') or [], list):
+        return "'files' must be a list"
+    for declared in data.get('files') or []:
+        if not isinstance(declared, dict):
+            return "Each entry of 'files' must be an object"
+        if declared.get('name') is not None and not isinstance(declared['name'], str):
+            return "A file's 'name' must be a string"
+        # bool is an int subclass, but true isn't a size
+        if not isinstance(declared.get('size'), int) or isinstance(declared['size'], bool):
+            return "A file's 'size' must be an integer"
+    return None
+
+@app.route('/uploads', methods=['POST'])
+def create_chunked_upload():
+    """Start a chunked batch; the body lists the files that will be sent"""
+    data = request.get_json(silent=True)
+    if data is None:
+        data = {}
+    error = invalid_upload_request(data)
+    if error:
+        return {'success': False, 'error': error}, 400
+    mode = data.get('mode', 'avif')
+    if mode not in engine.MODE_EXTENSIONS:
+        return {'success': False, 'error': 'Unknown mode'}, 400
+    files = []
+    skipped = []
+    errors = []
+    positions = []
+    for position, declared in enumerate(data.get('files') or []):
+        name = declared.get('name') or ''
+        size = declared['size']
+        if not allowed_file(name, mode):
+            skipped.append(name)
+        elif size <= 0:
+            errors.append(f"{name}: file is empty")
+        else:
+            files.append((name, secure_filename(name), size))
+            positions.append(position)
+    if not files:
+        return {'success': False, 'error': 'No files selected'}, 400
+    if sum(size for _, _, size in files) > MAX_BATCH_BYTES:
+        return {'success': False, 'error': f"Batch too large. Maximum size is {format_file_size(MAX_BATCH_BYTES)} total."}, 413
+    options = conversion_options(data)
+    # Headers aren't known yet, so the cost is estimated from the declared sizes
+    client = client_id()
+    retry_after = admission.scheduler.retry_after(client, admission.declared_cost(files, mode, options))
+    if retry_after is not None:
+        metrics.batches_rejected.inc()
+        message, headers = busy(retry_after)
+        return {'success': False, 'error': message, 'retry_after': retry_after}, 503, headers
+    metrics.files.inc(len(skipped), mode=mode, result='skipped')
+    metrics.files.inc(len(errors), mode=mode, result='failed')
+
+    batch_id = str(uuid.uuid4())[:12]
+    ChunkedBatch.create(batch_id, os.path.join(UPLOAD_FOLDER, batch_id), os.path.join(CONVERTED_FOLDER, batch_id),
+                        mode, options, files, skipped, errors, client)
+    batch_registry.register(batch_id, BATCH_TTL)
+    return {
+        'success': True,
         'batch_id': batch_id,
-        'files': converted_files,
-        'errors': errors,
+        'chunk_size': UPLOAD_CHUNK_BYTES,
+        # position is the file's place in the request, index its number in this batch
+        'files': [{'index': index, 'position': position, 'name': name, 'size': size}
+                  for index, ((name, _, size), position) in enumerate(zip(files, positions))],
         'skipped': skipped,
-        'is_batch': len(converted_files) > 1,
-        'mode': mode
-    })
+        'upload_url': url_for('chunked_upload', batch_id=batch_id),
+        'status_url': url_for('job_status', batch_id=batch_id)
+    }, 201
+
+@app.route('/uploads/<batch_id>')
+def chunked_upload(batch_id):
+    """Bytes received per file, for resuming an interrupted upload"""
+    batch = load_chunked_batch(batch_id)
+    if batch is None:
+        return {'success': False, 'error': 'Unknown batch'}, 404
+    return {
+        'success': True,
+        'finalized': batch.info['finalized'],
+        'files': [{'index': index, 'name': declared['name'], 'size': declared['size'], 'received': batch.received(index)}
+                  for index, declared in enumerate(batch.info['files'])]
+    }
+
+@app.route('/uploads/<batch_id>/<int:index>', methods=['PUT'])
+def upload_chunk(batch_id, index):
+    """Append the request body to file index at the Upload-Offset header"""
+    batch = load_chunked_batch(batch_id)
+    if batch is None:
+        return {'success': False, 'error': 'Unknown batch'}, 404
+    try:
+        offset = int(request.headers.get('Upload-Offset', '0'))
+        received = batch.write_chunk(index, offset, request.stream)
+    except ValueError:
+        return {'success': False, 'error': 'Invalid Upload-Offset'}, 400
+    except ChunkError as e:
+        return {'success': False, 'error': str(e), 'received': e.received}, e.status
+    # Keep a batch that is still being uploaded from expiring
+    touch_batch(batch_id)
+    return {'success': True, 'received': received, 'complete': received == batch.info['files'][index]['size']}
+
+@app.route('/uploads/<batch_id>/finalize', methods=['POST'])
+def finalize_chunked_upload(batch_id):
+    batch = load_chunked_batch(batch_id)
+    if batch is None:
+        return {'success': False, 'error': 'Unknown batch'}, 404
+    batch.finalize()
+    touch_batch(batch_id)
+    return {'success': True, 'batch_id': batch_id, 'status_url': url_for('job_status', batch_id=batch_id)}
+
+@app.route('/status/<batch_id>')
+def job_status(batch_id):
+    status = jobs.status(batch_id)
+    if status is None:
+        batch = load_chunked_batch(batch_id)
+        if batch is None:
+            return {'success': False, 'error': 'Unknown batch'}, 404
+        status = batch.status()
+    return status
+
+@app.route('/cache_stats')
+def cache_stats():
+    return conversion_cache.stats()
+
+@app.route('/startup')
+def startup_report():
+    """Import, setup and plugin loading costs of this worker process"""
+    return plugins.report()
+
+# Sampled when /metrics is scraped
+metrics.Gauge('imgtoavif_job_queue_depth', 'Batches waiting for admission', jobs.queue_depth)
+metrics.Gauge('imgtoavif_admission_running_seconds', 'Estimated CPU-seconds left of admitted work',
+              lambda: admission.scheduler.stats()['running_cost'])
+metrics.Gauge('imgtoavif_admission_waiting_seconds', 'Estimated CPU-seconds of work waiting for admission',
+              lambda: admission.scheduler.stats()['waiting_cost'])
+metrics.Gauge('imgtoavif_decoded_pixels_in_use', 'Pixels reserved by conversions in progress',
+              lambda: engine.decode_budget.in_use)
+metrics.Gauge('imgtoavif_cache_hits', 'Conversion cache hits since start', lambda: conversion_cache.stats()['hits'])
+metrics.Gauge('imgtoavif_cache_misses', 'Conversion cache misses since start',
+              lambda: conversion_cache.stats()['misses'])
+# Shared by the worker processes, except for the in-process stand-in broker
+metrics.Gauge('imgtoavif_batches', 'Batches kept on disk until their TTL expires', lambda: batch_registry.count(),
+              shared=True)
+metrics.Gauge('imgtoavif_cache_bytes', 'Size of the conversion cache', lambda: conversion_cache.stats()['bytes'],
+              shared=True)
+metrics.Gauge('imgtoavif_broker_pending_tasks', 'Batches waiting for a conversion worker',
+              lambda: task_broker.depth() if task_broker else 0,
+              shared=task_broker is not None and not isinstance(task_broker, MemoryBroker))
+metrics.Gauge('imgtoavif_result_memory_bytes', 'Outputs held by the memory result store',
+              lambda: result_store.stats().get('bytes', 0))
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# Outputs never change under their batch id, so browsers may keep them for this long
+DOWNLOAD_MAX_AGE = int(os.environ.get('DOWNLOAD_MAX_AGE', str(365 * 24 * 3600)))
+# Let a fronting proxy send files from disk: 'x-accel' (nginx) or 'x-sendfile' (Apache, lighttpd)
+DOWNLOAD_OFFLOAD = os.environ.get('DOWNLOAD_OFFLOAD', '')
+# Internal nginx location that maps to the converted folder, for X-Accel-Redirect
+DOWNLOAD_ACCEL_PREFIX = os.environ.get('DOWNLOAD_ACCEL_PREFIX', '/_converted/')
+
+def send_result(batch_id, result, as_attachment):
+    """Serve a stored output with its content ETag, immutable caching, 304s and byte ranges"""
+    offload = DOWNLOAD_OFFLOAD in ('x-accel', 'x-sendfile') and result.path
+    response = werkzeug.utils.send_file(
+        result.path or result.open(), request.environ, as_attachment=as_attachment,
+        download_name=result.filename, last_modified=result.mtime, etag=result.etag,
+        max_age=DOWNLOAD_MAX_AGE, use_x_sendfile=bool(offload), response_class=Response,
+        # The proxy answers range requests itself
+        conditional=not offload)
+    if offload:
+        # The proxy sends the body; only answer If-None-Match / If-Modified-Since here
+        response = response.make_conditional(request)
+        if response.status_code == 304:
+            response.headers.pop('X-Sendfile', None)
+        elif DOWNLOAD_OFFLOAD == 'x-accel':
+            del response.headers['X-Sendfile']
+            response.headers['X-Accel-Redirect'] = f"{DOWNLOAD_ACCEL_PREFIX}{quote(batch_id)}/{quote(result.filename)}"
+    response.cache_control.immutable = True
+    return response
 
 @app.route('/download/<batch_id>/<filename>')
 def download_file(batch_id, filename):
-    file_path = os.path.join(CONVERTED_FOLDER, batch_id, filename)
-    if os.path.exists(file_path):
-        should_download = request.args.get('download') == '1'
-        return send_file(file_path, as_attachment=should_download, download_name=filename)
+    result = result_store.get(batch_id, filename)
+    if result:
+        touch_batch(batch_id)
+        return send_result(batch_id, result, as_attachment=request.args.get('download') == '1')
     return redirect(url_for('index'))
 
+# Formats that are already compressed; deflating them again only burns CPU
+STORED_EXTENSIONS = {'avif', 'jpg', 'jpeg', 'png'}
+ZIP_CHUNK_SIZE = 256 * 1024
+
+class ZipStream(io.RawIOBase):
+    """Unseekable sink that zipfile writes into while the response drains it"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def stream_zip(batch_id, filenames):
+    """Yield a ZIP archive of the batch as it is being built"""
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, 'w') as zipf:
+        for filename in filenames:
+            result = result_store.get(batch_id, filename)
+            if result is None:
+                # Removed while the archive was streamed
+                continue
+            info = zipfile.ZipInfo(filename, time.localtime(result.mtime)[:6])
+            info.file_size = result.size
+            ext = filename.rsplit('.', 1)[-1].lower()
+            info.compress_type = zipfile.ZIP_STORED if ext in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+            with result.open() as src, zipf.open(info, 'w') as dst:
+                for chunk in iter(lambda: src.read(ZIP_CHUNK_SIZE), b''):
+                    dst.write(chunk)
+                    data = stream.drain()
+                    if data:
+                        yield data
+    # Central directory, written when the archive is closed
+    yield stream.drain()
+
 @app.route('/download_batch/<batch_id>')
 def download_batch(batch_id):
-    batch_folder = os.path.join(CONVERTED_FOLDER, batch_id)
-    if not os.path.exists(batch_folder):
+    filenames = result_store.list(batch_id)
+    if filenames is None:
         return redirect(url_for('index'))
         
     zip_filename = f'converted_{batch_id}.zip'
-    zip_path = os.path.join(CONVERTED_FOLDER, zip_filename)
-    
-    try:
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for filename in os.listdir(batch_folder):
-                file_path = os.path.join(batch_folder, filename)
-                zipf.write(file_path, filename)
-        
-        return send_file(zip_path, as_attachment=True, download_name=zip_filename)
-    except Exception as e:
-        if os.path.exists(zip_path):
-            os.remove(zip_path)
-        flash(f'Error: {str(e)}')
-        return redirect(url_for('index'))
+    touch_batch(batch_id)
+
+    # The archive is built on the fly, so it has an ETag and 304s but no byte ranges. Outputs are
+    # written once, so their names, sizes and mtimes identify it without reading them first.
+    digest = hashlib.sha256()
+    for filename in filenames:
+        result = result_store.get(batch_id, filename)
+        version = f"{result.size}:{result.mtime}" if result else ''
+        digest.update(f"{filename}:{version}\n".encode())
+    response = Response(stream_zip(batch_id, filenames), mimetype='application/zip', headers={
+        'Content-Disposition': f'attachment; filename={zip_filename}'
+    })
+    response.set_etag(digest.hexdigest()[:32])
+    response.cache_control.public = True
+    response.cache_control.max_age = DOWNLOAD_MAX_AGE
+    response.cache_control.immutable = True
+    return response.make_conditional(request)
 
 @app.route('/clear_files/<batch_id>', methods=['POST'])
 def clear_files(batch_id):
-    batch_folder = os.path.join(CONVERTED_FOLDER, batch_id)
+    batch_id = secure_filename(batch_id)
+    if not batch_id:
+        return {'success': False}, 404
+    if batch_active(batch_id):
+        # The conversion would write into the folders removed here; the expiry sweep removes it later
+        return {'success': False, 'error': 'The batch is still converting'}, 409
     try:
-        if os.path.exists(batch_folder):
-            import shutil
-            shutil.rmtree(batch_folder)
+        remove_batch(batch_id)
         return {'success': True}
     except:
         return {'success': False}
 
 @app.errorhandler(413)
 def too_large(e):
-    flash('File too large. Maximum size is 100MB total.')
+    flash(f"File too large. Maximum size is {format_file_size(app.config['MAX_CONTENT_LENGTH'])} total.")
     return redirect(url_for('index'))
 
 def format_file_size(size_bytes):
@@ -307,8 +605,16 @@ def format_file_size(size_bytes):
     s = round(size_bytes / p, 2)
     return f"{prefix}{s} {size_names[i]}"
 
-# Make format_file_size available in templates
-app.jinja_env.globals.update(format_file_size=format_file_size)
+# Make format_file_size and the encoder defaults available in templates
+app.jinja_env.globals.update(format_file_size=format_file_size,
+                             avif_profiles=list(engine.AVIF_PROFILES),
+                             default_profile=engine.DEFAULT_PROFILE,
+                             default_widths=engine.RESPONSIVE_WIDTHS,
+                             default_target=engine.QUALITY_TARGET,
+                             heif_images=engine.HEIF_IMAGES,
+                             default_heif_images=engine.DEFAULT_HEIF_IMAGES,
+                             default_heif_metadata=engine.DEFAULT_HEIF_METADATA)
+plugins.checkpoint('app setup')
 
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=8080)
\ No newline at end of file
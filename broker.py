@@ -0,0 +1,176 @@
+import importlib
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+import storage
+
+# How batches are converted: '' in this process, 'memory' through the
+# in-process stand-in broker, 'directory' through task files in BROKER_FOLDER
+# that worker.py processes on any node take, or 'package.module:Class' for
+# another broker with the same methods
+BROKER = os.environ.get('BROKER', '')
+BROKER_FOLDER = os.environ.get('BROKER_FOLDER', storage.path('queue'))
+# Seconds a claimed task may go without a heartbeat before it is delivered again
+TASK_LEASE = float(os.environ.get('TASK_LEASE', '60'))
+# Seconds between looks for new task files
+DIRECTORY_POLL_INTERVAL = 0.5
+
+class MemoryBroker:
+    """Task queue within one process, the stand-in for a remote broker.
+
+    A broker delivers JSON-serialisable task dicts to workers:
+
+      publish(task)       queue a task
+      claim(timeout)      (receipt, task, deliveries) of the next task, or None
+                          after waiting timeout seconds
+      heartbeat(receipt)  extend the lease of a claimed task
+      ack(receipt)        drop a task once its work is done
+      depth()             tasks waiting to be claimed
+
+    A claim whose lease runs out without heartbeats, because its worker
+    died, is delivered again with deliveries counting up. Tasks go through
+    JSON here as well, so the stand-in fails on anything a remote broker
+    couldn't carry.
+    """
+
+    def __init__(self, lease=TASK_LEASE):
+        self.lease = lease
+        self._cond = threading.Condition()
+        self._pending = deque()  # (deliveries so far, body)
+        self._claimed = {}  # receipt -> (lease expiry, deliveries, body)
+
+    def publish(self, task):
+        body = json.dumps(task)
+        with self._cond:
+            self._pending.append((0, body))
+            self._cond.notify()
+
+    def _expire(self):
+        now = time.monotonic()
+        for receipt, (expires, deliveries, body) in list(self._claimed.items()):
+            if expires <= now:
+                del self._claimed[receipt]
+                self._pending.append((deliveries, body))
+
+    def claim(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                self._expire()
+                if self._pending:
+                    deliveries, body = self._pending.popleft()
+                    receipt = uuid.uuid4().hex
+                    self._claimed[receipt] = (time.monotonic() + self.lease, deliveries + 1, body)
+                    return receipt, json.loads(body), deliveries + 1
+                remaining = self.lease if deadline is None else deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                # Wakes up for expired leases as well as new tasks
+                self._cond.wait(min(remaining, self.lease))
+
+    def heartbeat(self, receipt):
+        with self._cond:
+            if receipt in self._claimed:
+                _, deliveries, body = self._claimed[receipt]
+                self._claimed[receipt] = (time.monotonic() + self.lease, deliveries, body)
+
+    def ack(self, receipt):
+        with self._cond:
+            self._claimed.pop(receipt, None)
+
+    def depth(self):
+        with self._cond:
+            self._expire()
+            return len(self._pending)
+
+class DirectoryBroker:
+    """Task queue of JSON files in a folder, shared by every node through the storage volume.
+
+    Tasks are files in pending/ named <publish time>-<id>.<deliveries>.json.
+    A worker claims one by renaming it into claimed/, which only one of
+    several racing workers can do; the claimed file's mtime is its lease,
+    renewed by heartbeat(). Expired claims are moved back to pending/ by
+    whichever worker looks next, so node clocks must agree to well within
+    TASK_LEASE.
+    """
+
+    def __init__(self, folder, lease=TASK_LEASE):
+        self.folder = folder
+        self.lease = lease
+        self._pending = os.path.join(folder, 'pending')
+        self._claimed = os.path.join(folder, 'claimed')
+        os.makedirs(self._pending, exist_ok=True)
+        os.makedirs(self._claimed, exist_ok=True)
+
+    def publish(self, task):
+        name = f"{time.time_ns():020d}-{uuid.uuid4().hex}.0.json"
+        # Written outside pending/ so no worker sees a partial file
+        tmp_path = os.path.join(self.folder, f".{name}.tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump(task, f)
+        os.replace(tmp_path, os.path.join(self._pending, name))
+
+    def _expire(self):
+        now = time.time()
+        for name in os.listdir(self._claimed):
+            path = os.path.join(self._claimed, name)
+            try:
+                if os.path.getmtime(path) + self.lease > now:
+                    continue
+                os.rename(path, os.path.join(self._pending, name))
+            except OSError:
+                # Acked, or moved back by another worker
+                continue
+
+    def claim(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            self._expire()
+            for name in sorted(os.listdir(self._pending)):
+                prefix, deliveries, _ = name.rsplit('.', 2)
+                receipt = f"{prefix}.{int(deliveries) + 1}.json"
+                path = os.path.join(self._claimed, receipt)
+                try:
+                    # The lease starts now, not when the task was published; set
+                    # before the rename so no worker sees it expired in claimed/
+                    os.utime(os.path.join(self._pending, name))
+                    os.rename(os.path.join(self._pending, name), path)
+                except OSError:
+                    # Claimed by another worker first
+                    continue
+                with open(path) as f:
+                    return receipt, json.load(f), int(deliveries) + 1
+            remaining = DIRECTORY_POLL_INTERVAL if deadline is None else deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            time.sleep(min(remaining, DIRECTORY_POLL_INTERVAL))
+
+    def heartbeat(self, receipt):
+        try:
+            os.utime(os.path.join(self._claimed, receipt))
+        except OSError:
+            pass
+
+    def ack(self, receipt):
+        try:
+            os.remove(os.path.join(self._claimed, receipt))
+        except OSError:
+            pass
+
+    def depth(self):
+        return len(os.listdir(self._pending))
+
+def create_broker(kind, folder):
+    if not kind:
+        return None
+    if kind == 'memory':
+        return MemoryBroker()
+    if kind == 'directory':
+        return DirectoryBroker(folder)
+    module, _, name = kind.partition(':')
+    return getattr(importlib.import_module(module), name)()
+
+task_broker = create_broker(BROKER, BROKER_FOLDER)
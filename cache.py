@@ -0,0 +1,192 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+from importlib import metadata
+import PIL
+
+# Cached outputs live outside converted/ so the batch cleanup never removes them
+CACHE_FOLDER = os.environ.get('CACHE_FOLDER', 'cache')
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', str(1024 * 1024 * 1024)))  # 1GB
+
+def _package_version(name):
+    try:
+        return metadata.version(name)
+    except metadata.PackageNotFoundError:
+        return 'unknown'
+
+# Read from the package metadata, so computing keys doesn't load the codec plugin
+_ENCODER_VERSION = f"Pillow-{PIL.__version__}/pillow-avif-{_package_version('pillow-avif-plugin')}"
+
+def encoder_version():
+    """Part of every key, so upgrading an encoder never serves outputs of the old one"""
+    return _ENCODER_VERSION
+
+class ConversionCache:
+    """Content-addressed store of converted outputs with LRU eviction.
+
+    Blobs are stored as <folder>/<key[:2]>/<key>. The last use of a blob is
+    the mtime of an empty <key>.used file beside it, which keeps the LRU
+    order across restarts and between processes sharing the folder. The
+    blob's own mtime is left alone: blobs are hardlinked into batch folders,
+    where it is the Last-Modified and ZIP timestamp of the output.
+    """
+
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> size, least recently used first
+        self._total = 0
+        os.makedirs(folder, exist_ok=True)
+        self._load()
+
+    def _path(self, key):
+        return os.path.join(self.folder, key[:2], key)
+
+    def _load(self):
+        """Rebuild the LRU index from the blobs on disk"""
+        blobs = []
+        for prefix in os.listdir(self.folder):
+            prefix_path = os.path.join(self.folder, prefix)
+            if not os.path.isdir(prefix_path):
+                continue
+            for key in os.listdir(prefix_path):
+                if key.endswith(('.tmp', '.meta', '.used')):
+                    continue
+                blob_path = os.path.join(prefix_path, key)
+                try:
+                    stat = os.stat(blob_path)
+                except OSError:
+                    continue
+                try:
+                    used = os.path.getmtime(f"{blob_path}.used")
+                except OSError:
+                    used = stat.st_mtime
+                blobs.append((max(used, stat.st_mtime), key, stat.st_size))
+        blobs.sort()
+        self._entries = OrderedDict((key, size) for _, key, size in blobs)
+        self._total = sum(self._entries.values())
+
+    def key(self, input_path, mode, settings):
+        """Hash the input bytes together with everything that shapes the output"""
+        digest = hashlib.sha256()
+        with open(input_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        digest.update(json.dumps([mode, settings, encoder_version()], sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def fetch(self, key, output_path):
+        """Place the cached output for key at output_path; False on a miss"""
+        blob_path = self._path(key)
+        try:
+            if not os.path.exists(blob_path):
+                raise FileNotFoundError(blob_path)
+            _link_or_copy(blob_path, output_path)
+            _touch(f"{blob_path}.used")
+        except OSError:
+            with self._lock:
+                self.misses += 1
+                size = self._entries.pop(key, None)
+                if size is not None:
+                    self._total -= size
+            return False
+        with self._lock:
+            self.hits += 1
+            if key not in self._entries:
+                # Stored by another process sharing the folder
+                self._entries[key] = os.path.getsize(blob_path)
+                self._total += self._entries[key]
+            self._entries.move_to_end(key)
+        return True
+
+    def meta(self, key):
+        """Return the metadata stored with key, or None"""
+        try:
+            with open(f"{self._path(key)}.meta") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def store(self, key, output_path, meta=None, data=None):
+        """Remember a freshly converted output under key, with optional JSON metadata.
+
+        data holds the output bytes when they were kept in memory rather than
+        written to output_path.
+        """
+        blob_path = self._path(key)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        tmp_path = f"{blob_path}.{uuid.uuid4().hex[:8]}.tmp"
+        try:
+            if meta:
+                # Written first, so a blob is never visible without its metadata
+                with open(tmp_path, 'w') as f:
+                    json.dump(meta, f)
+                os.replace(tmp_path, f"{blob_path}.meta")
+            if data is None:
+                _link_or_copy(output_path, tmp_path)
+            else:
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+            os.replace(tmp_path, blob_path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        size = os.path.getsize(blob_path)
+        with self._lock:
+            self._total += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+        self._evict()
+
+    def _evict(self):
+        while True:
+            with self._lock:
+                if self._total <= self.max_bytes or not self._entries:
+                    return
+                key, size = self._entries.popitem(last=False)
+                self._total -= size
+            for path in (self._path(key), f"{self._path(key)}.meta", f"{self._path(key)}.used"):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def trim(self):
+        """Resync with the disk and enforce the size cap (run by the cleanup sweep)"""
+        with self._lock:
+            self._load()
+        self._evict()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self._entries),
+                'bytes': self._total,
+                'max_bytes': self.max_bytes
+            }
+
+def _touch(path):
+    """Set the mtime of path to now, creating it empty if needed"""
+    with open(path, 'a'):
+        pass
+    os.utime(path)
+
+def _link_or_copy(src, dst):
+    """Hardlink src to dst, copying when the filesystem can't link"""
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+conversion_cache = ConversionCache(CACHE_FOLDER, CACHE_MAX_BYTES)
@@ -1,4 +1,6 @@
 #!/usr/bin/env python3
+import hashlib
+import importlib.util
 import subprocess
 import sys
 import os
@@ -7,95 +9,75 @@ import threading
 import time
 import platform
 
+REQUIREMENTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'requirements.txt')
+# Modules the app needs, checked without importing them
+REQUIRED_MODULES = ['flask', 'PIL', 'pillow_avif', 'pillow_heif', 'numpy']
+# Written into the venv after a successful install, with the hash of the requirements it installed
+INSTALLED_MARKER = 'requirements.sha256'
+# Set when relaunching inside the venv, which skips the dependency check
+READY_ENV = 'IMGTOAVIF_ENV_READY'
+
+def requirements_hash():
+    with open(REQUIREMENTS, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def venv_python(venv_path):
+    if platform.system() == 'Windows':
+        return os.path.join(venv_path, 'Scripts', 'python')
+    return os.path.join(venv_path, 'bin', 'python')
+
+def venv_ready(venv_path):
+    """True when the venv holds exactly the current requirements"""
+    try:
+        with open(os.path.join(venv_path, INSTALLED_MARKER)) as f:
+            return f.read().strip() == requirements_hash()
+    except OSError:
+        return False
+
+def dependencies_present():
+    return all(importlib.util.find_spec(name) for name in REQUIRED_MODULES)
+
 def setup_venv_and_install():
-    """Create venv and install packages (Mac/Linux)"""
+    """Create or reuse the venv and install the requirements into it (Mac/Linux)"""
     import venv
     
     venv_path = 'venv'
+    python_exe = venv_python(venv_path)
+    if venv_ready(venv_path):
+        return python_exe
     if not os.path.exists(venv_path):
         print("Creating virtual environment...")
         venv.create(venv_path, with_pip=True)
     
-    # Get venv python and pip paths
-    if platform.system() == 'Windows':
-        python_exe = os.path.join(venv_path, 'Scripts', 'python')
-        pip_exe = os.path.join(venv_path, 'Scripts', 'pip')
-    else:
-        python_exe = os.path.join(venv_path, 'bin', 'python')
-        pip_exe = os.path.join(venv_path, 'bin', 'pip')
-    
-    requirements = ['Flask', 'Pillow', 'pillow-avif-plugin', 'pillow-heif']
-    
+    # One pip run resolves all packages together instead of one install per package
     print("Installing dependencies in virtual environment...")
-    for req in requirements:
-        print(f"Installing {req}...")
-        try:
-            subprocess.check_call([pip_exe, 'install', req])
-        except subprocess.CalledProcessError:
-            print(f"Failed to install {req}")
-            return None
-    
+    try:
+        subprocess.check_call([python_exe, '-m', 'pip', 'install', '-r', REQUIREMENTS])
+    except subprocess.CalledProcessError:
+        print("Failed to install dependencies")
+        return None
+    with open(os.path.join(venv_path, INSTALLED_MARKER), 'w') as f:
+        f.write(requirements_hash())
     return python_exe
 
 def install_requirements():
     """Install required packages (Windows fallback)"""
-    requirements = ['Flask', 'Pillow', 'pillow-avif-plugin', 'pillow-heif']
-    
     print("Installing dependencies...")
-    for req in requirements:
-        print(f"Installing {req}...")
-        try:
-            subprocess.check_call([sys.executable, '-m', 'pip', 'install', req])
-        except subprocess.CalledProcessError:
-            print(f"Failed to install {req}")
-            return False
+    try:
+        subprocess.check_call([sys.executable, '-m', 'pip', 'install', '-r', REQUIREMENTS])
+    except subprocess.CalledProcessError:
+        print("Failed to install dependencies")
+        return False
     return True
 
-def cleanup_old_files():
-    """Remove batch folders and temporary zips older than 10 minutes"""
-    current_time = time.time()
-    if os.path.exists('converted'):
-        for item in os.listdir('converted'):
-            if item.startswith('.'):
-                continue
-            path = os.path.join('converted', item)
-            if os.path.isdir(path):
-                # Clean up old batch folders
-                if current_time - os.path.getctime(path) > 600:
-                    try:
-                        import shutil
-                        shutil.rmtree(path)
-                    except:
-                        pass
-            elif os.path.isfile(path) and item.startswith('converted_') and item.endswith('.zip'):
-                # Clean up temporary zips
-                if current_time - os.path.getctime(path) > 300:
-                    try:
-                        os.remove(path)
-                    except:
-                        pass
-
-def cleanup_files():
-    """Background cleanup task"""
-    while True:
-        time.sleep(60)  # Check every minute
-        cleanup_old_files()
-
 def main():
     print("Image Converter - AVIF & HEIC to PNG")
     print("=" * 30)
     print(f"Running on {platform.system()} {platform.release()}")
     print()
     
-    # Check if packages are installed
-    try:
-        import flask
-        import PIL
-        import pillow_avif
-        import pillow_heif
-    except ImportError:
-        print("Installing required packages...")
-        
+    # Check if packages are installed; a relaunch inside the venv already knows they are
+    if not os.environ.get(READY_ENV) and not dependencies_present():
         # Use venv on Mac/Linux, direct install on Windows
         if platform.system() in ['Darwin', 'Linux']:
             python_exe = setup_venv_and_install()
@@ -103,36 +85,28 @@ def main():
                 print("Failed to setup environment. Please run manually:")
                 print("python3 -m venv venv")
                 print("source venv/bin/activate")
-                print("pip install Flask Pillow pillow-avif-plugin pillow-heif")
+                print("pip install -r requirements.txt")
                 input("Press Enter to exit...")
                 return
             
-            # Restart with venv python
-            print("Restarting with virtual environment...")
-            subprocess.call([python_exe, os.path.abspath(__file__)])
-            return
+            # Replace this process with the venv python
+            print("Starting in virtual environment...")
+            os.environ[READY_ENV] = '1'
+            os.execv(python_exe, [python_exe, os.path.abspath(__file__)])
         else:
+            print("Installing required packages...")
             # Windows - direct install
             if not install_requirements():
                 print("Failed to install packages. Please run manually:")
-                print("pip install Flask Pillow pillow-avif-plugin pillow-heif")
+                print("pip install -r requirements.txt")
                 input("Press Enter to exit...")
                 return
     
-    # Create required directories
-    os.makedirs('converted', exist_ok=True)
-    
-    # Clean old files on startup
-    cleanup_old_files()
-    
-    # Start cleanup thread
-    cleanup_thread = threading.Thread(target=cleanup_files, daemon=True)
-    cleanup_thread.start()
-    
-    # Import and run Flask app
+    # Import and run Flask app (it creates its folders and runs the cleanup sweep)
     try:
         from app import app
-        print("Starting converter...")
+        import plugins
+        print(f"Starting converter, {plugins.summary()}")
         print("Opening browser...")
         
         # Open browser after short delay
@@ -0,0 +1,624 @@
+import io
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from PIL import Image
+import heif
+import ingest  # applies the MAX_IMAGE_PIXELS limit in pool workers too
+import plugins
+import pngopt
+import quality
+import tiles
+
+# Number of encoder processes shared by all requests (0 = one per CPU core)
+CONVERT_WORKERS = int(os.environ.get('CONVERT_WORKERS', '0')) or os.cpu_count() or 1
+
+# Pixels that may be decoded at the same time across all workers; files that
+# would go over wait for running conversions to finish (about 4 bytes each)
+MAX_DECODED_PIXELS = int(os.environ.get('MAX_DECODED_PIXELS', str(200 * 1000 * 1000)))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+class PixelBudget:
+    """Counting semaphore over decoded pixels.
+
+    A file larger than the whole budget still runs, but only on its own.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_use = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, pixels):
+        with self._cond:
+            while self.in_use and self.in_use + pixels > self.limit:
+                self._cond.wait()
+            self.in_use += pixels
+
+    def release(self, pixels):
+        with self._cond:
+            self.in_use -= pixels
+            self._cond.notify_all()
+
+decode_budget = PixelBudget(MAX_DECODED_PIXELS)
+
+# libheif threads decoding one HEIF image; by default the CPUs are shared by the encoder processes
+HEIF_DECODE_THREADS = int(os.environ.get('HEIF_DECODE_THREADS', '0')) or max(1, (os.cpu_count() or 1) // CONVERT_WORKERS)
+
+# Images above this many pixels are converted in tiles by the avif and compress
+# modes: decoded in strips and written as an AVIF grid or PNG row by row
+LARGE_IMAGE_PIXELS = int(os.environ.get('LARGE_IMAGE_PIXELS', str(64 * 1000 * 1000)))
+# Side of the square AVIF tiles and rows per strip; grown as needed to fit the AVIF grid limits
+LARGE_TILE_SIZE = int(os.environ.get('LARGE_TILE_SIZE', '1024'))
+# Threads encoding the tiles of one large image. Large images are rare and
+# their tiles encode independently, so they get up to 4 CPUs even when every
+# encoder process is busy.
+LARGE_TILE_THREADS = int(os.environ.get('LARGE_TILE_THREADS', '0')) or min(4, os.cpu_count() or 1)
+# Threads running the trial encodes and the final encode of a compress-mode PNG.
+# zlib releases the GIL and the search is bounded by PNG_SEARCH_SECONDS, so it
+# gets up to 4 CPUs even when every encoder process is busy.
+PNG_SEARCH_THREADS = int(os.environ.get('PNG_SEARCH_THREADS', '0')) or min(4, os.cpu_count() or 1)
+
+# Named AVIF encoder settings, chosen per request with the 'profile' option.
+# max_threads is only honoured by pillow-avif versions that expose it.
+AVIF_PROFILES = {
+    'fast': {'quality': 70, 'speed': 10, 'codec': 'aom', 'max_threads': 1},
+    'balanced': {'quality': 75, 'speed': 6, 'codec': 'auto', 'max_threads': 2},
+    'archival': {'quality': 100, 'speed': 4, 'codec': 'aom', 'subsampling': '4:4:4',
+                 'max_threads': os.cpu_count() or 1},
+}
+DEFAULT_PROFILE = os.environ.get('AVIF_PROFILE', 'balanced')
+
+# Input extensions each conversion mode accepts
+MODE_EXTENSIONS = {
+    'avif': ['png', 'jpg', 'jpeg'],
+    'png': ['heic', 'heif'],
+    'compress': ['png', 'jpg', 'jpeg'],
+    'responsive': ['png', 'jpg', 'jpeg'],
+    'target': ['png', 'jpg', 'jpeg'],
+}
+# Lossy AVIF modes, encoded with the settings of an AVIF profile
+AVIF_MODES = ('avif', 'responsive', 'target')
+
+# Variant widths produced by the responsive mode; 'full' keeps the source size
+RESPONSIVE_WIDTHS = os.environ.get('RESPONSIVE_WIDTHS', '320,640,1280,full')
+# Goal of the target mode: 'ssim:<floor>', 'psnr:<dB floor>' or 'size:<bytes, k or m>'
+QUALITY_TARGET = os.environ.get('QUALITY_TARGET', 'ssim:0.95')
+MAX_VARIANT_WIDTH = 16384
+
+# Images of a HEIF container the png mode exports: the primary one, all of
+# them (bursts, Live Photos) or a preview from the embedded thumbnail
+HEIF_IMAGES = ('primary', 'all', 'preview')
+DEFAULT_HEIF_IMAGES = os.environ.get('HEIF_IMAGES', 'primary')
+# Whether the png mode keeps EXIF and exports depth maps ('keep') or drops them
+DEFAULT_HEIF_METADATA = os.environ.get('HEIF_METADATA', 'drop')
+# Longest side of previews; larger embedded thumbnails are scaled down to it
+HEIF_PREVIEW_SIZE = int(os.environ.get('HEIF_PREVIEW_SIZE', '512'))
+
+def parse_widths(text):
+    """Parse '320,640,full' into widths, largest first, with None for full size.
+
+    Invalid entries are ignored; returns None when nothing valid is left.
+    """
+    widths = set()
+    for token in (text or '').split(','):
+        token = token.strip().lower()
+        if token == 'full':
+            widths.add(None)
+        elif token.isdigit() and 0 < int(token) <= MAX_VARIANT_WIDTH:
+            widths.add(int(token))
+    if not widths:
+        return None
+    return sorted(widths, key=lambda width: -1 if width is None else -width)
+
+def responsive_widths(options):
+    return (options or {}).get('widths') or parse_widths(RESPONSIVE_WIDTHS)
+
+def quality_target(options):
+    return (options or {}).get('target') or quality.parse_target(QUALITY_TARGET)
+
+def heif_images(options):
+    images = (options or {}).get('images')
+    return images if images in HEIF_IMAGES else DEFAULT_HEIF_IMAGES
+
+def heif_metadata(options):
+    metadata = (options or {}).get('metadata')
+    return metadata if metadata in ('keep', 'drop') else DEFAULT_HEIF_METADATA
+
+def large_image(mode, pixels, streamable):
+    """Whether a file is converted in tiles instead of decoded as a whole.
+
+    The avif mode tiles any large input, the compress mode only PNGs it can
+    decode in strips; other modes always decode the whole image.
+    """
+    return pixels > LARGE_IMAGE_PIXELS and (mode == 'avif' or (mode == 'compress' and streamable))
+
+def decoded_pixels(upload, mode):
+    """Pixels held decoded at once while converting an upload"""
+    if upload.streamable and large_image(mode, upload.pixels, True):
+        # The strip being encoded and the one being decoded
+        return min(upload.pixels, 2 * upload.width * LARGE_TILE_SIZE)
+    return upload.pixels
+
+def avif_profile(options):
+    """Name of the AVIF profile requested in options, falling back to the default"""
+    profile = (options or {}).get('profile')
+    return profile if profile in AVIF_PROFILES else DEFAULT_PROFILE
+
+def output_settings(filename, mode, options=None):
+    """Return (extension, save options) of the file a mode produces"""
+    if mode in AVIF_MODES:
+        return 'avif', dict(AVIF_PROFILES[avif_profile(options)], format='AVIF')
+    elif mode == 'png':
+        return 'png', {'format': 'PNG'}
+    original_ext = filename.rsplit('.', 1)[1].lower()
+    if original_ext in ['jpg', 'jpeg']:
+        return 'jpg', {'format': 'JPEG', 'quality': 95, 'optimize': True}
+    return 'png', {'format': 'PNG', 'optimize': True}
+
+def output_plan(filename, mode, options, source_width, images=1, depth_maps=0):
+    """List the (output_filename, width) pairs converting a file produces.
+
+    width is None for a full-size output. The responsive mode produces a file
+    per width; variants at least as wide as the source collapse into the
+    full-size one since images are never upscaled. The png mode produces one
+    file per exported HEIF image plus one per kept depth map, as counted by
+    ingest.probe().
+    """
+    extension, _ = output_settings(filename, mode, options)
+    base_name = filename.rsplit('.', 1)[0]
+    if mode == 'png':
+        exported = heif_images(options)
+        if exported == 'preview':
+            return [(f"{base_name}-preview.{extension}", None)]
+        if exported == 'all' and images > 1:
+            plan = [(f"{base_name}-{index + 1}.{extension}", None) for index in range(images)]
+        else:
+            plan = [(f"{base_name}.{extension}", None)]
+        if heif_metadata(options) == 'keep':
+            plan += [(f"{base_name}-depth{index + 1 if depth_maps > 1 else ''}.{extension}", None)
+                     for index in range(depth_maps)]
+        return plan
+    if mode != 'responsive':
+        return [(f"{base_name}.{extension}", None)]
+    plan = []
+    for width in responsive_widths(options):
+        if width is not None and width < source_width:
+            plan.append((f"{base_name}-{width}w.{extension}", width))
+        elif (f"{base_name}.{extension}", None) not in plan:
+            plan.insert(0, (f"{base_name}.{extension}", None))
+    return plan
+
+def cache_settings(filename, mode, options=None):
+    """Save options that shape the output bytes, used in conversion cache keys"""
+    _, save_options = output_settings(filename, mode, options)
+    # Thread count changes encode time, not output, and differs between hosts
+    save_options.pop('max_threads', None)
+    if mode == 'responsive':
+        save_options['widths'] = responsive_widths(options)
+    elif mode == 'target':
+        save_options['target'] = quality_target(options)
+    elif mode == 'compress' and save_options['format'] == 'PNG':
+        # The strategy search picks the output within its time budget
+        save_options['search_seconds'] = pngopt.PNG_SEARCH_SECONDS
+        save_options['search_min_pixels'] = pngopt.PNG_SEARCH_MIN_PIXELS
+    elif mode == 'png':
+        save_options.update(images=heif_images(options), metadata=heif_metadata(options))
+        if save_options['images'] == 'preview':
+            save_options['preview_size'] = HEIF_PREVIEW_SIZE
+    return save_options
+
+def output_keys(key, plan, filename):
+    """Cache key of every planned output, by output filename.
+
+    An output named like the input is stored under key itself, the others
+    under key plus what sets their filename apart, e.g. '-640w' or '-depth'.
+    """
+    base_name = filename.rsplit('.', 1)[0]
+    return {output_filename: key + output_filename.rsplit('.', 1)[0][len(base_name):]
+            for output_filename, _ in plan}
+
+# Entry fields describing how the target and compress modes encoded a file, kept with cached outputs
+SEARCH_FIELDS = ('quality', 'ssim', 'psnr', 'strategy', 'encode_seconds')
+
+def result_entry(filename, output_filename, original_size, converted_size, mode, options=None,
+                 width=None, search=None):
+    """Build the converted_files entry reported for one output file"""
+    entry = {
+        'filename': output_filename,
+        'original_name': filename,
+        'original_size': original_size,
+        'converted_size': converted_size,
+        'savings_percent': ((original_size - converted_size) / original_size) * 100
+    }
+    if mode in AVIF_MODES:
+        entry['profile'] = avif_profile(options)
+    if mode == 'responsive':
+        entry['width'] = width
+    if search:
+        entry.update(search)
+    return entry
+
+# Timed steps of a conversion, reported in the stats of convert_file()
+STAGES = ('decode', 'color', 'resize', 'search', 'encode', 'write')
+
+def _encode(img, save_options):
+    buffer = io.BytesIO()
+    img.save(buffer, **save_options)
+    return buffer.getbuffer()
+
+def _write(data, output_path):
+    # Unlink first: the old file may be a hardlink into the conversion cache
+    if os.path.exists(output_path):
+        os.remove(output_path)
+    with open(output_path, 'wb') as f:
+        f.write(data)
+
+def _store(entry, data, output_path, inline_below):
+    if len(data) < inline_below:
+        # Handed back to convert_batch for the result store instead of written here
+        entry['data'] = bytes(data)
+    else:
+        _write(data, output_path)
+
+def convert_file(input_path, filename, mode, batch_folder, original_size, options=None, inline_below=0):
+    """Convert a single stored image and return (entries, stats).
+
+    entries are the converted_files entries of the outputs written to
+    batch_folder; outputs smaller than inline_below bytes aren't written
+    and their entry carries the bytes in 'data' instead. stats holds the
+    seconds spent in each of STAGES plus the pixel and byte counts, for
+    metrics and benchmarks.
+
+    The upload was already validated from its header during ingest, so the
+    image is opened and decoded exactly once here, also when the responsive
+    mode derives several variants from it. Large images in the avif and
+    compress modes are converted in tiles instead, see large_image().
+    """
+    # Runs in the pool workers, which load the codec plugins on first use too
+    plugins.load_mode(mode)
+    stats = dict.fromkeys(STAGES, 0.0)
+    clock = time.perf_counter()
+
+    def lap(stage):
+        nonlocal clock
+        now = time.perf_counter()
+        stats[stage] += now - clock
+        clock = now
+
+    if mode == 'png':
+        entries, pixels = _convert_heif(input_path, filename, batch_folder, original_size, options,
+                                        inline_below, lap)
+        stats.update(mode=mode, pixels=pixels, bytes_in=original_size,
+                     bytes_out=sum(entry['converted_size'] for entry in entries))
+        return entries, stats
+
+    width, height, streamable = _image_size(input_path)
+    if large_image(mode, width * height, streamable):
+        entries = _convert_tiled(input_path, filename, mode, batch_folder, original_size, options,
+                                 streamable, lap)
+        stats.update(mode=mode, pixels=width * height, bytes_in=original_size,
+                     bytes_out=entries[0]['converted_size'])
+        return entries, stats
+    if width * height > ingest.MAX_IMAGE_PIXELS:
+        # Accepted for the tiled modes, but this one decodes the whole image
+        raise ValueError(f"image is {width}x{height}, the {mode} mode converts at most "
+                         f"{ingest.MAX_IMAGE_PIXELS} pixels")
+
+    with Image.open(input_path) as source:
+        source_width, source_height = source.size
+        plan = output_plan(filename, mode, options, source_width)
+        if mode == 'responsive' and all(width for _, width in plan):
+            # Let JPEG decode straight at a reduced DCT scale when no full-size output is needed
+            largest = max(width for _, width in plan)
+            source.draft(None, (largest, max(1, round(largest * source_height / source_width))))
+        source.load()
+        lap('decode')
+
+        img = source
+        if mode in AVIF_MODES:
+            if img.mode in ('LA', 'P'):
+                img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+        elif output_settings(filename, mode)[0] == 'jpg':
+            if img.mode in ('RGBA', 'LA'): img = img.convert('RGB')
+        lap('color')
+
+        _, save_options = output_settings(filename, mode, options)
+        entries = []
+        for output_filename, width in plan:
+            output_path = os.path.join(batch_folder, output_filename)
+            search = None
+            if mode == 'target':
+                # The search ends with the full-size encode, counted as its own stage
+                data, chosen_quality, measured = quality.search(img, save_options, quality_target(options))
+                search = dict(measured, quality=chosen_quality)
+                lap('search')
+            elif mode == 'compress' and save_options['format'] == 'PNG':
+                started = time.perf_counter()
+                data, strategy = pngopt.optimize(img, PNG_SEARCH_THREADS)
+                search = {'strategy': strategy, 'encode_seconds': round(time.perf_counter() - started, 3)}
+                lap('encode')
+            elif width is None:
+                data = _encode(img, save_options)
+                lap('encode')
+            else:
+                height = max(1, round(width * source_height / source_width))
+                # reducing_gap runs Image.reduce() first, then resamples the small remainder
+                variant = img.resize((width, height), Image.LANCZOS, reducing_gap=3.0)
+                lap('resize')
+                data = _encode(variant, save_options)
+                variant.close()
+                lap('encode')
+            entry = result_entry(filename, output_filename, original_size, len(data),
+                                 mode, options, width or source_width, search)
+            _store(entry, data, output_path, inline_below)
+            lap('write')
+            entries.append(entry)
+        if img is not source:
+            # Free the converted copy now; the source is closed by the with block
+            img.close()
+
+    stats.update(mode=mode, pixels=source_width * source_height, bytes_in=original_size,
+                 bytes_out=sum(entry['converted_size'] for entry in entries))
+    return entries, stats
+
+def _image_size(input_path):
+    """Return (width, height, streamable) of a stored input from its header"""
+    with open(input_path, 'rb') as f:
+        header = tiles.png_header(f)
+    if header:
+        return header
+    with Image.open(input_path) as img:
+        return img.size + (False,)
+
+def _convert_tiled(input_path, filename, mode, batch_folder, original_size, options, streamable, lap):
+    """Convert a large image in tiles, writing the output as it is encoded.
+
+    Streamable PNGs are decoded a strip at a time, so memory depends on the
+    tile size only; other inputs are decoded whole and encoded tile by tile.
+    """
+    source = tiles.PngStrips(input_path) if streamable else tiles.ImageStrips(input_path)
+    try:
+        lap('decode')
+        (output_filename, _), = output_plan(filename, mode, options, source.width)
+        output_path = os.path.join(batch_folder, output_filename)
+        # Unlink first: the old file may be a hardlink into the conversion cache
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        started = time.perf_counter()
+        search = None
+        if mode == 'compress':
+            with open(output_path, 'wb') as f:
+                fallback_row = tiles.encode_png(source, f, LARGE_TILE_SIZE, LARGE_TILE_THREADS,
+                                                budget=pngopt.PNG_SEARCH_SECONDS)
+            # Too large for trial encodes, the strips get the filter and zlib settings that usually win,
+            # as long as they fit the PNG budget
+            filter = 'none' if source.mode == 'P' else 'adaptive'
+            strategy = f"{source.mode} strips, {filter} filter, zlib default level 9"
+            if fallback_row is not None:
+                filter = 'none' if source.mode == 'P' else tiles.PNG_FALLBACK_FILTER
+                strategy += f", from row {fallback_row} {filter} filter, zlib default level {tiles.PNG_FALLBACK_LEVEL}"
+            search = {'strategy': strategy, 'encode_seconds': round(time.perf_counter() - started, 3)}
+        else:
+            _, save_options = output_settings(filename, mode, options)
+            tiles.encode_avif(source, output_path, save_options, LARGE_TILE_SIZE, LARGE_TILE_THREADS)
+        lap('encode')
+    finally:
+        source.close()
+    return [result_entry(filename, output_filename, original_size, os.path.getsize(output_path),
+                         mode, options, search=search)]
+
+def _open_heif(data, thumbnails, depth_images):
+    """Parse a HEIF container, reading thumbnail and depth map entries only when asked to"""
+    pillow_heif = plugins.load('heif')
+    pillow_heif.options.DECODE_THREADS = HEIF_DECODE_THREADS
+    saved = pillow_heif.options.THUMBNAILS, pillow_heif.options.DEPTH_IMAGES
+    pillow_heif.options.THUMBNAILS, pillow_heif.options.DEPTH_IMAGES = thumbnails, depth_images
+    try:
+        return pillow_heif.open_heif(data)
+    finally:
+        pillow_heif.options.THUMBNAILS, pillow_heif.options.DEPTH_IMAGES = saved
+
+def _heif_thumbnail(data, heif_file, primary):
+    """Return the largest thumbnail embedded for the primary image, or None"""
+    sizes = set(primary.info['thumbnails'])
+    if not sizes:
+        return None
+    detached = heif.detach_thumbnails(data)
+    if detached is None:
+        return None
+    # Detaching lists the thumbnails among the images that were already there,
+    # such as the other frames of a burst; what is left after taking those out
+    # by size, and has the size of a thumbnail of the primary, is one
+    remaining = Counter(image.size for image in heif_file)
+    thumbnails = []
+    for image in _open_heif(detached, False, False):
+        if remaining[image.size]:
+            remaining[image.size] -= 1
+        elif max(image.size) in sizes:
+            thumbnails.append(image)
+    return max(thumbnails, key=lambda image: image.size[0] * image.size[1], default=None)
+
+def _convert_heif(input_path, filename, batch_folder, original_size, options, inline_below, lap):
+    """Export the images of a HEIF file as PNGs; returns (entries, decoded pixels).
+
+    The container is parsed once, and EXIF, ICC profile and depth maps are
+    taken from that parse for every output. A preview decodes the embedded
+    thumbnail when there is one instead of the full primary image.
+    """
+    exported, keep = heif_images(options), heif_metadata(options) == 'keep'
+    with open(input_path, 'rb') as f:
+        data = f.read()
+    heif_file = _open_heif(data, exported == 'preview', keep and exported != 'preview')
+    primary = heif_file[heif_file.primary_index]
+    if exported == 'preview':
+        sources = [_heif_thumbnail(data, heif_file, primary) or primary]
+    elif exported == 'all':
+        sources = list(heif_file)
+    else:
+        sources = [primary]
+    depth_maps = primary.info['depth_images'] if keep and exported != 'preview' else []
+    plan = output_plan(filename, 'png', options, primary.size[0], len(heif_file), len(depth_maps))
+
+    _, save_options = output_settings(filename, 'png', options)
+    image_options = save_options
+    if keep and primary.info.get('exif'):
+        exif = Image.Exif()
+        exif.load(primary.info['exif'])
+        # libheif already applied the rotation, viewers mustn't apply it again
+        if 0x0112 in exif:
+            exif[0x0112] = 1
+        image_options = dict(save_options, exif=exif.tobytes())
+    lap('decode')
+
+    entries = []
+    pixels = 0
+    for index, ((output_filename, _), source) in enumerate(zip(plan, sources + depth_maps)):
+        img = source.to_pillow()
+        pixels += img.width * img.height
+        lap('decode')
+        if index >= len(sources):
+            # Depth maps stay single-channel and carry no EXIF
+            data = _encode(img, save_options)
+        else:
+            if img.mode not in ('RGB', 'RGBA'):
+                img = img.convert('RGB')
+            lap('color')
+            if exported == 'preview' and max(img.size) > HEIF_PREVIEW_SIZE:
+                img.thumbnail((HEIF_PREVIEW_SIZE, HEIF_PREVIEW_SIZE), Image.LANCZOS, reducing_gap=3.0)
+                lap('resize')
+            data = _encode(img, image_options)
+        img.close()
+        lap('encode')
+        entry = result_entry(filename, output_filename, original_size, len(data), 'png', options)
+        _store(entry, data, os.path.join(batch_folder, output_filename), inline_below)
+        lap('write')
+        entries.append(entry)
+    return entries, pixels
+
+def _fetch_cached(cache, keys, plan, upload, mode, options, batch_folder):
+    """Link every output of an upload from the cache; None unless all of them hit"""
+    entries = []
+    for key, (output_filename, width) in zip(keys, plan):
+        output_path = os.path.join(batch_folder, output_filename)
+        if not cache.fetch(key, output_path):
+            # Partial hit: the worker rewrites all outputs of this upload
+            for entry in entries:
+                os.remove(os.path.join(batch_folder, entry['filename']))
+            return None
+        entries.append(result_entry(upload.filename, output_filename, upload.size,
+                                    os.path.getsize(output_path), mode, options,
+                                    width or upload.width,
+                                    cache.meta(key) if mode in ('target', 'compress') else None))
+    return entries
+
+def get_pool():
+    """Return the shared process pool, creating it on first use"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=CONVERT_WORKERS)
+        return _pool
+
+def _load_plugins(modes):
+    for mode in modes:
+        plugins.load_mode(mode)
+
+def prewarm(modes):
+    """Load the plugins of modes and start the encoder processes ahead of the first request"""
+    _load_plugins(modes)
+    started = time.perf_counter()
+    # Forked after the plugins were loaded, the workers inherit them
+    pool = get_pool()
+    for future in [pool.submit(_load_plugins, modes) for _ in range(CONVERT_WORKERS)]:
+        future.result()
+    plugins.record('start encoder processes', time.perf_counter() - started)
+
+def _reset_pool(pool):
+    """Drop a pool whose worker died so the next batch gets a fresh one"""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def convert_batch(uploads, mode, batch_folder, options=None, progress=None, cache=None, observe=None,
+                  results=None):
+    """Convert ingested uploads in parallel.
+
+    Returns (converted_files, errors) in upload order, in the same shape the
+    upload handlers have always produced. options holds per-request encoder
+    choices such as the AVIF 'profile' and the responsive 'widths'. If given, progress(index, ok) is
+    called as each file finishes, in completion order. With a cache, inputs
+    converted before with the same settings are copied instead of encoded.
+    If given, observe(stats) receives the convert_file() stats of every
+    converted file; cache hits report 'cached': True and no stage timings.
+    With a result store, outputs below its inline_bytes come back from the
+    encoder processes and are put() into it instead of written to batch_folder.
+    """
+    batch_id = os.path.basename(batch_folder)
+    inline_below = results.inline_bytes if results else 0
+    pool = get_pool()
+    pending = []
+    for index, upload in enumerate(uploads):
+        keys = None
+        if cache:
+            plan = output_plan(upload.filename, mode, options, upload.width, upload.images, upload.depth_maps)
+            key = cache.key(upload.path, mode, cache_settings(upload.filename, mode, options))
+            keys = output_keys(key, plan, upload.filename)
+            entries = _fetch_cached(cache, keys.values(), plan, upload, mode, options, batch_folder)
+            if entries is not None:
+                pending.append((upload.name, keys, None, entries))
+                if observe:
+                    observe({'mode': mode, 'cached': True, 'pixels': upload.pixels, 'bytes_in': upload.size,
+                             'bytes_out': sum(entry['converted_size'] for entry in entries)})
+                if progress:
+                    progress(index, True)
+                continue
+        pixels = decoded_pixels(upload, mode)
+        decode_budget.acquire(pixels)
+        try:
+            future = pool.submit(convert_file, upload.path, upload.filename, mode, batch_folder,
+                                 upload.size, options, inline_below)
+        except Exception:
+            decode_budget.release(pixels)
+            raise
+        future.add_done_callback(lambda f, pixels=pixels: decode_budget.release(pixels))
+        if progress:
+            future.add_done_callback(
+                lambda f, index=index: progress(index, not f.cancelled() and f.exception() is None))
+        pending.append((upload.name, keys, future, None))
+
+    converted_files = []
+    errors = []
+    broken = False
+    for name, keys, future, entries in pending:
+        if future is None:
+            converted_files.extend(entries)
+            continue
+        try:
+            entries, stats = future.result()
+        except BrokenProcessPool:
+            broken = True
+            errors.append(f"{name}: conversion worker crashed")
+        except Exception as e:
+            errors.append(f"{name}: {str(e)}")
+        else:
+            for entry in entries:
+                data = entry.pop('data', None)
+                if data is not None:
+                    results.put(batch_id, entry['filename'], data)
+                if cache and entry['filename'] in keys:
+                    cache.store(keys[entry['filename']], os.path.join(batch_folder, entry['filename']),
+                                {field: entry[field] for field in SEARCH_FIELDS if field in entry}, data)
+            converted_files.extend(entries)
+            if observe:
+                observe(stats)
+    if broken:
+        _reset_pool(pool)
+    return converted_files, errors
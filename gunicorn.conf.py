@@ -0,0 +1,104 @@
+"""Production server settings, read by `gunicorn app:app`.
+
+Web workers only parse uploads and stream downloads; the encoding runs in
+each worker's engine process pool. The host's encoder processes and decode
+budget are therefore split between the web workers instead of every worker
+sizing its pool for the whole machine.
+"""
+import os
+import shutil
+import tempfile
+
+def cpu_count():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def memory_bytes():
+    """Memory available to this host or container"""
+    for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(path) as f:
+                limit = f.read().strip()
+        except OSError:
+            continue
+        # cgroup v1 reports a huge number when there is no limit
+        if limit.isdigit() and int(limit) < 1 << 60:
+            return int(limit)
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+CPUS = cpu_count()
+MEMORY = memory_bytes()
+# Memory a web worker needs with its share of the encoders (0 = don't limit by memory)
+WEB_WORKER_MEMORY = int(os.environ.get('WEB_WORKER_MEMORY_MB', '512')) * 1024 * 1024
+
+def default_workers():
+    if os.environ.get('RESULT_STORE') == 'memory':
+        # Outputs held in memory can only be downloaded from the worker that converted them
+        return 1
+    workers = max(2, CPUS // 2)
+    if MEMORY and WEB_WORKER_MEMORY:
+        workers = min(workers, MEMORY // WEB_WORKER_MEMORY)
+    return max(1, workers)
+
+bind = os.environ.get('BIND', f"0.0.0.0:{os.environ.get('PORT', '8080')}")
+workers = int(os.environ.get('WEB_WORKERS', '0')) or default_workers()
+# Threads per worker for polling, downloads and uploads that are still being received
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', '8'))
+# Form posts wait for their batch to convert
+timeout = int(os.environ.get('WEB_TIMEOUT', '300'))
+# On SIGHUP or shutdown, workers get this long to finish requests and queued batches
+graceful_timeout = int(os.environ.get('WEB_GRACEFUL_TIMEOUT', '120'))
+# Restart workers when the code changes (development only)
+reload = os.environ.get('WEB_RELOAD') == '1'
+accesslog = '-'
+
+# Host totals, divided between the web workers in post_fork
+TOTAL_CONVERT_WORKERS = int(os.environ.get('CONVERT_WORKERS', '0')) or CPUS
+TOTAL_DECODED_PIXELS = int(os.environ.get('MAX_DECODED_PIXELS', str(200 * 1000 * 1000)))
+# Unset, each worker derives its admission capacity from its own encoder processes
+TOTAL_ADMISSION_CAPACITY = float(os.environ.get('ADMISSION_CAPACITY', '0'))
+
+# Every web worker writes its metrics here, for /metrics to add up all of them;
+# emptied when the server starts and removed when it exits
+METRICS_FOLDER = os.environ.setdefault('METRICS_FOLDER',
+                                       os.path.join(tempfile.gettempdir(), f"imgtoavif-metrics-{os.getpid()}"))
+
+def on_starting(server):
+    # Counts of a previous run would be added to this one's
+    shutil.rmtree(METRICS_FOLDER, ignore_errors=True)
+    os.makedirs(METRICS_FOLDER)
+    memory = f"{MEMORY // (1024 * 1024)}MB" if MEMORY else 'unknown memory'
+    server.log.info(f"{CPUS} CPUs, {memory}: {workers} web workers x {threads} threads, "
+                    f"{max(1, TOTAL_CONVERT_WORKERS // workers)} encoder processes each")
+    if os.environ.get('RESULT_STORE') == 'memory' and workers > 1:
+        server.log.warning('RESULT_STORE=memory with several web workers: downloads that reach '
+                           'another worker than the one that converted the batch miss small outputs')
+
+def post_fork(server, worker):
+    # Runs in the new worker before the app, and so the engine, is imported
+    os.environ['CONVERT_WORKERS'] = str(max(1, TOTAL_CONVERT_WORKERS // workers))
+    os.environ['MAX_DECODED_PIXELS'] = str(TOTAL_DECODED_PIXELS // workers)
+    if TOTAL_ADMISSION_CAPACITY:
+        os.environ['ADMISSION_CAPACITY'] = str(TOTAL_ADMISSION_CAPACITY / workers)
+    # Every encoder process on the host gets an equal share of the CPUs for HEIF decoding
+    os.environ.setdefault('HEIF_DECODE_THREADS', str(max(1, CPUS // TOTAL_CONVERT_WORKERS)))
+
+def post_worker_init(worker):
+    # The app is imported by now; log what its cold start cost
+    import plugins
+    worker.log.info(f"Worker {worker.pid} {plugins.summary()}")
+
+def worker_exit(server, worker):
+    # Let batches accepted by this worker finish before it goes away
+    import jobs
+    if not jobs.drain(graceful_timeout):
+        worker.log.warning('Exiting with unfinished batches')
+
+def on_exit(server):
+    shutil.rmtree(METRICS_FOLDER, ignore_errors=True)
@@ -0,0 +1,288 @@
+import struct
+
+# Reference type written over 'thmb' so libheif no longer attaches the items as thumbnails
+DETACHED_THUMBNAIL = b'xthm'
+
+def _boxes(data, start, end):
+    """Yield (type, box start, body start, box end) of the ISOBMFF boxes in data[start:end]"""
+    while start + 8 <= end:
+        size, kind = struct.unpack_from('>I4s', data, start)
+        header = 8
+        if size == 1:
+            if start + 16 > end:
+                return
+            size = struct.unpack_from('>Q', data, start + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - start
+        if size < header or start + size > end:
+            return
+        yield kind, start, start + header, start + size
+        start += size
+
+def _item_id(data, offset, version):
+    if version == 0:
+        return struct.unpack_from('>H', data, offset)[0], offset + 2
+    return struct.unpack_from('>I', data, offset)[0], offset + 4
+
+def detach_thumbnails(data):
+    """Return data with the primary image's thumbnails turned into top-level images.
+
+    pillow_heif only reports the sizes of embedded thumbnails, not their
+    pixels. Renaming the 'thmb' references that point at the primary item
+    makes libheif list each thumbnail as an image of its own, which decodes
+    in a fraction of the time of the full image. Returns None when the file
+    has no thumbnail of its primary image.
+    """
+    data = bytearray(data)
+    meta = next((box for box in _boxes(data, 0, len(data)) if box[0] == b'meta'), None)
+    if meta is None:
+        return None
+    # meta is a full box: version and flags come before its children
+    children = list(_boxes(data, meta[2] + 4, meta[3]))
+    primary = None
+    for kind, _, body, end in children:
+        if kind == b'pitm' and body + 4 < end:
+            primary, _ = _item_id(data, body + 4, data[body])
+    detached = 0
+    for kind, _, body, end in children:
+        if kind != b'iref' or primary is None:
+            continue
+        version = data[body]
+        for ref_kind, ref_start, ref_body, ref_end in _boxes(data, body + 4, end):
+            if ref_kind != b'thmb':
+                continue
+            _, offset = _item_id(data, ref_body, version)
+            count = struct.unpack_from('>H', data, offset)[0]
+            offset += 2
+            targets = []
+            for _ in range(count):
+                if offset >= ref_end:
+                    break
+                target, offset = _item_id(data, offset, version)
+                targets.append(target)
+            if primary in targets:
+                data[ref_start + 4:ref_start + 8] = DETACHED_THUMBNAIL
+                detached += 1
+    return bytes(data) if detached else None
+
+def _full_box(kind, version, flags, payload):
+    return _box(kind, struct.pack('>I', (version << 24) | flags) + payload)
+
+def _box(kind, payload):
+    return struct.pack('>I4s', 8 + len(payload), kind) + payload
+
+def read_avif_items(data):
+    """Return the color and alpha items of a single-image AVIF file.
+
+    Each item is (item data, property boxes) with the properties as raw
+    bytes in association order; alpha is None for opaque images. Only the
+    layout libavif writes is supported: one extent per item in mdat.
+    """
+    meta = next(box for box in _boxes(data, 0, len(data)) if box[0] == b'meta')
+    children = {kind: (body, end) for kind, _, body, end in _boxes(data, meta[2] + 4, meta[3])}
+    body, _ = children[b'pitm']
+    primary, _ = _item_id(data, body + 4, data[body])
+
+    body, end = children[b'iloc']
+    version = data[body]
+    offset_size, length_size = data[body + 4] >> 4, data[body + 4] & 15
+    base_offset_size, index_size = data[body + 5] >> 4, data[body + 5] & 15
+    offset = body + 6
+    count, offset = _item_id(data, offset, 0 if version < 2 else 1)
+    sizes = {0: '', 4: '>I', 8: '>Q'}
+    extents = {}
+    for _ in range(count):
+        item, offset = _item_id(data, offset, 0 if version < 2 else 1)
+        if version:
+            offset += 2  # construction method
+        offset += 2  # data reference index
+        base = struct.unpack_from(sizes[base_offset_size], data, offset)[0] if base_offset_size else 0
+        offset += base_offset_size
+        extent_count = struct.unpack_from('>H', data, offset)[0]
+        offset += 2
+        item_extents = []
+        for _ in range(extent_count):
+            if version and index_size:
+                offset += index_size
+            start = struct.unpack_from(sizes[offset_size], data, offset)[0] if offset_size else 0
+            offset += offset_size
+            length = struct.unpack_from(sizes[length_size], data, offset)[0]
+            offset += length_size
+            item_extents.append(bytes(data[base + start:base + start + length]))
+        extents[item] = b''.join(item_extents)
+
+    alpha = None
+    if b'iref' in children:
+        body, end = children[b'iref']
+        version = data[body]
+        for kind, _, ref_body, _ in _boxes(data, body + 4, end):
+            item, offset = _item_id(data, ref_body, version)
+            count = struct.unpack_from('>H', data, offset)[0]
+            target, _ = _item_id(data, offset + 2, version)
+            if kind == b'auxl' and count and target == primary:
+                alpha = item
+
+    body, end = children[b'iprp']
+    ipco, ipma = None, None
+    for kind, start, box_body, box_end in _boxes(data, body, end):
+        if kind == b'ipco':
+            ipco = [bytes(data[prop_start:prop_end]) for _, prop_start, _, prop_end in _boxes(data, box_body, box_end)]
+        elif kind == b'ipma':
+            ipma = (box_body, box_end)
+    body, end = ipma
+    version, flags = data[body], int.from_bytes(data[body + 1:body + 4], 'big')
+    count = struct.unpack_from('>I', data, body + 4)[0]
+    offset = body + 8
+    properties = {}
+    for _ in range(count):
+        item, offset = _item_id(data, offset, 0 if version < 1 else 1)
+        associations = data[offset]
+        offset += 1
+        item_properties = []
+        for _ in range(associations):
+            if flags & 1:
+                value = struct.unpack_from('>H', data, offset)[0]
+                offset += 2
+                index, essential = value & 0x7fff, value >> 15
+            else:
+                index, essential = data[offset] & 0x7f, data[offset] >> 7
+                offset += 1
+            item_properties.append((ipco[index - 1], bool(essential)))
+        properties[item] = item_properties
+
+    color = (extents[primary], properties[primary])
+    return color, (extents[alpha], properties[alpha]) if alpha else None
+
+def _property_kind(prop):
+    return prop[4:8]
+
+class AvifGridWriter:
+    """Write an AVIF grid image to a file tile by tile.
+
+    Tiles are single-image AVIF files of equal size, added in row-major
+    order. Their coded data is appended to mdat as it arrives, so only the
+    tile in hand is held in memory; the meta box with the item locations
+    is written after mdat once all tiles are known.
+    """
+
+    def __init__(self, f, width, height, rows, columns):
+        self.f = f
+        self.width = width
+        self.height = height
+        self.rows = rows
+        self.columns = columns
+        self.tiles = []  # (color (offset, length, properties), alpha or None)
+        self.f.write(_box(b'ftyp', b'avif' + struct.pack('>I', 0) + b'avifmif1miaf'))
+        self._mdat_start = self.f.tell()
+        # 64-bit box size, filled in by close()
+        self.f.write(struct.pack('>I4sQ', 1, b'mdat', 0))
+
+    def _append(self, item):
+        data, properties = item
+        offset = self.f.tell()
+        self.f.write(data)
+        return offset, len(data), properties
+
+    def add(self, tile_data):
+        color, alpha = read_avif_items(tile_data)
+        self.tiles.append((self._append(color), self._append(alpha) if alpha else None))
+
+    @property
+    def missing_alpha(self):
+        """Whether some tiles have an alpha channel and others, opaque ones, don't"""
+        return len({alpha is None for _, alpha in self.tiles}) == 2
+
+    def close(self, opaque_alpha=None):
+        """Write the grid and the meta box.
+
+        opaque_alpha is needed when missing_alpha is set: a single-image,
+        monochrome AVIF of the tile size whose pixels are all 255, stored
+        once as the alpha of every opaque tile.
+        """
+        if self.missing_alpha:
+            if opaque_alpha is None:
+                raise ValueError('a grid with an alpha channel needs opaque_alpha for its opaque tiles')
+            color, _ = read_avif_items(opaque_alpha)
+            # The alpha tiles' auxC makes the monochrome image an alpha plane
+            aux = next(prop for _, alpha in self.tiles if alpha for prop in alpha[2]
+                       if _property_kind(prop[0]) == b'auxC')
+            data, properties = color
+            filler = self._append((data, [prop for prop in properties
+                                          if _property_kind(prop[0]) in (b'ispe', b'pixi', b'av1C')] + [aux]))
+            self.tiles = [(tile, alpha or filler) for tile, alpha in self.tiles]
+        large = self.width > 0xffff or self.height > 0xffff
+        grid = struct.pack('>BBBB', 0, int(large), self.rows - 1, self.columns - 1)
+        grid += struct.pack('>II' if large else '>HH', self.width, self.height)
+        grid_offset = self.f.tell()
+        self.f.write(grid)
+        mdat_end = self.f.tell()
+        self.f.seek(self._mdat_start + 8)
+        self.f.write(struct.pack('>Q', mdat_end - self._mdat_start))
+        self.f.seek(mdat_end)
+        self.f.write(self._meta(grid_offset, len(grid)))
+
+    def _meta(self, grid_offset, grid_length):
+        has_alpha = any(alpha for _, alpha in self.tiles)
+        count = len(self.tiles)
+        color_ids = list(range(1, count + 1))
+        alpha_ids = list(range(count + 1, 2 * count + 1)) if has_alpha else []
+        grid_id = 2 * count + 1 if has_alpha else count + 1
+        alpha_grid_id = grid_id + 1
+
+        properties = []
+
+        def index(prop):
+            if prop not in properties:
+                properties.append(prop)
+            return properties.index(prop) + 1
+
+        grid_ispe = _full_box(b'ispe', 0, 0, struct.pack('>II', self.width, self.height))
+        locations = []  # (item id, offset, length)
+        associations = []  # (item id, [(property index, essential)])
+        for number, (color, alpha) in enumerate(self.tiles):
+            items = [(color_ids[number], color)] + ([(alpha_ids[number], alpha)] if has_alpha else [])
+            for item_id, (offset, length, item_properties) in items:
+                locations.append((item_id, offset, length))
+                associations.append((item_id, [(index(prop), essential) for prop, essential in item_properties]))
+
+        # The grids take the tiles' pixel format, colour and alpha semantics at the output size
+        color_properties = self.tiles[0][0][2]
+        associations.append((grid_id, [(index(grid_ispe), False)] + [
+            (index(prop), False) for prop, _ in color_properties if _property_kind(prop) in (b'pixi', b'colr')]))
+        locations.append((grid_id, grid_offset, grid_length))
+        if has_alpha:
+            alpha_properties = self.tiles[0][1][2]
+            associations.append((alpha_grid_id, [(index(grid_ispe), False)] + [
+                (index(prop), _property_kind(prop) == b'auxC') for prop, _ in alpha_properties
+                if _property_kind(prop) in (b'pixi', b'auxC')]))
+            locations.append((alpha_grid_id, grid_offset, grid_length))
+
+        infe = [_full_box(b'infe', 2, 1, struct.pack('>HH4s', item_id, 0, b'av01') + b'\0')
+                for item_id in color_ids + alpha_ids]
+        infe.append(_full_box(b'infe', 2, 0, struct.pack('>HH4s', grid_id, 0, b'grid') + b'\0'))
+        references = [_box(b'dimg', struct.pack('>HH', grid_id, count) + struct.pack(f'>{count}H', *color_ids))]
+        if has_alpha:
+            infe.append(_full_box(b'infe', 2, 0, struct.pack('>HH4s', alpha_grid_id, 0, b'grid') + b'\0'))
+            references.append(_box(b'dimg', struct.pack('>HH', alpha_grid_id, count)
+                                   + struct.pack(f'>{count}H', *alpha_ids)))
+            references.append(_box(b'auxl', struct.pack('>HHH', alpha_grid_id, 1, grid_id)))
+
+        # libavif rejects item locations and associations not listed in item id order
+        locations.sort()
+        associations.sort()
+        iloc = struct.pack('>BBH', 0x88, 0, len(locations)) + b''.join(
+            struct.pack('>HHHQQ', item_id, 0, 1, offset, length) for item_id, offset, length in locations)
+        # Flag 1: 15-bit property indices, tiles may bring more than 127 distinct properties
+        ipma = struct.pack('>I', len(associations)) + b''.join(
+            struct.pack('>HB', item_id, len(item)) + b''.join(
+                struct.pack('>H', (essential << 15) | prop) for prop, essential in item)
+            for item_id, item in associations)
+        return _full_box(b'meta', 0, 0, b''.join([
+            _full_box(b'hdlr', 0, 0, struct.pack('>I4s12x', 0, b'pict') + b'\0'),
+            _full_box(b'pitm', 0, 0, struct.pack('>H', grid_id)),
+            _full_box(b'iloc', 0, 0, iloc),
+            _full_box(b'iinf', 0, 0, struct.pack('>H', len(infe)) + b''.join(infe)),
+            _full_box(b'iref', 0, 0, b''.join(references)),
+            _box(b'iprp', _box(b'ipco', b''.join(properties)) + _full_box(b'ipma', 0, 1, ipma)),
+        ]))
@@ -0,0 +1,116 @@
+import os
+import shutil
+import warnings
+from PIL import Image
+import plugins
+import tiles
+
+# Largest accepted input, checked from the header before any pixels are decoded
+MAX_IMAGE_PIXELS = int(os.environ.get('MAX_IMAGE_PIXELS', str(Image.MAX_IMAGE_PIXELS)))
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+# Largest accepted PNG that can be decoded in strips (8-bit, non-interlaced);
+# only the tiled avif and compress conversions take them past MAX_IMAGE_PIXELS
+LARGE_IMAGE_MAX_PIXELS = int(os.environ.get('LARGE_IMAGE_MAX_PIXELS', str(2000 * 1000 * 1000)))
+
+# Oversized images are rejected by probe() with a clear error instead
+warnings.simplefilter('ignore', Image.DecompressionBombWarning)
+
+# Formats Pillow must detect in the header of an upload
+SUPPORTED_FORMATS = {'PNG', 'JPEG', 'MPO', 'HEIF'}
+
+class IngestError(Exception):
+    """Raised when an upload is rejected before conversion"""
+
+class Upload:
+    """An accepted upload stored on disk, with what its header told us"""
+
+    def __init__(self, name, filename, path, size, format, width, height, images=1, depth_maps=0,
+                 streamable=False):
+        self.name = name
+        self.filename = filename
+        self.path = path
+        self.size = size
+        self.format = format
+        self.width = width
+        self.height = height
+        # Top-level images and depth maps of the primary image in a HEIF container
+        self.images = images
+        self.depth_maps = depth_maps
+        # A PNG whose rows can be decoded in strips, see tiles.PngStrips
+        self.streamable = streamable
+
+    @property
+    def pixels(self):
+        return self.width * self.height
+
+def stream_size(file):
+    """Size of an uploaded file without reading it into memory"""
+    stream = file.stream
+    try:
+        position = stream.tell()
+        stream.seek(0, os.SEEK_END)
+        size = stream.tell()
+        stream.seek(position)
+    except (AttributeError, OSError):
+        return file.content_length
+    return size
+
+def probe(stream):
+    """Identify an image from its header only and check its dimensions.
+
+    Returns the Upload fields read from the header as a dict: format, width,
+    height, images and depth_maps, the last two counting the images of a
+    HEIF container and the depth maps of its primary image, and streamable.
+    Pillow opens lazily, so no pixel data is decoded or allocated here.
+    """
+    start = stream.tell()
+    header = tiles.png_header(stream)
+    stream.seek(start)
+    if stream.read(12)[4:8] == b'ftyp':
+        # Pillow only recognises HEIF containers once the plugin is registered
+        plugins.load('heif')
+    stream.seek(start)
+    if header and header[2]:
+        # Read from the IHDR: Pillow would refuse these past twice its own limit
+        width, height, _ = header
+        if width * height > LARGE_IMAGE_MAX_PIXELS:
+            raise IngestError(f"image is {width}x{height}, larger than the {LARGE_IMAGE_MAX_PIXELS} pixel limit")
+        return {'format': 'PNG', 'width': width, 'height': height, 'images': 1, 'depth_maps': 0,
+                'streamable': True}
+    try:
+        img = Image.open(stream)
+    except Image.DecompressionBombError as e:
+        raise IngestError(str(e))
+    except Exception:
+        raise IngestError('not a valid image file')
+    if img.format not in SUPPORTED_FORMATS:
+        raise IngestError(f"unsupported image format {img.format}")
+    width, height = img.size
+    if width * height > MAX_IMAGE_PIXELS:
+        raise IngestError(f"image is {width}x{height}, larger than the {MAX_IMAGE_PIXELS} pixel limit")
+    images = getattr(img, 'n_frames', 1) if img.format == 'HEIF' else 1
+    return {'format': img.format, 'width': width, 'height': height, 'images': images,
+            'depth_maps': len(img.info.get('depth_images') or []), 'streamable': False}
+
+def ingest(file, filename, input_path):
+    """Validate an uploaded file from its header and store it at input_path"""
+    size = stream_size(file)
+    if not size:
+        raise IngestError('file is empty')
+    file.stream.seek(0)
+    header = probe(file.stream)
+    file.stream.seek(0)
+    with open(input_path, 'wb') as dst:
+        shutil.copyfileobj(file.stream, dst)
+    # Drop the spooled copy now instead of when the request ends
+    file.close()
+    return Upload(file.filename, filename, input_path, size, **header)
+
+def ingest_file(path, name, filename):
+    """Validate a file that was assembled on disk, e.g. from upload chunks"""
+    size = os.path.getsize(path)
+    if not size:
+        raise IngestError('file is empty')
+    with open(path, 'rb') as f:
+        header = probe(f)
+    return Upload(name, filename, path, size, **header)
@@ -0,0 +1,347 @@
+import os
+import shutil
+import threading
+import time
+import admission
+import engine
+import metrics
+import storage
+from broker import MemoryBroker, task_broker
+from cache import conversion_cache
+from ingest import Upload
+from results import result_store
+
+# Batches waiting for admission; /upload is refused once this many are queued
+JOB_QUEUE_SIZE = int(os.environ.get('JOB_QUEUE_SIZE', '32'))
+# Batches converted concurrently (their files share the engine's process pool)
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '2'))
+# How long finished jobs stay queryable, matches the converted folder lifetime
+JOB_RETENTION = 600
+# Job status snapshots, so any web worker process or node can answer /status
+JOB_FOLDER = os.environ.get('JOB_FOLDER', storage.path('jobs'))
+# A batch a worker took from the broker fails when its status goes this many
+# seconds without an update, as the worker renews it while converting
+TASK_TIMEOUT = float(os.environ.get('TASK_TIMEOUT', '600'))
+# A batch on the broker fails when no worker takes it within this many seconds
+TASK_QUEUE_TIMEOUT = float(os.environ.get('TASK_QUEUE_TIMEOUT', '3600'))
+# Deliveries of a task before the workers give up on it, so a batch that
+# crashes its worker isn't retried forever
+TASK_MAX_DELIVERIES = int(os.environ.get('TASK_MAX_DELIVERIES', '3'))
+# Seconds between reads of the status of a batch converting on a worker
+TASK_POLL_INTERVAL = 0.5
+# Seconds between refreshes of the status of a batch waiting on the broker
+TASK_STATUS_REFRESH = 60
+
+status_store = storage.StatusStore(JOB_FOLDER)
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+class QueueFull(Exception):
+    """Raised when the server cannot take another batch; retry_after is in seconds"""
+
+    def __init__(self, retry_after=None):
+        super().__init__('job queue is full')
+        self.retry_after = retry_after
+
+class Job:
+    def __init__(self, batch_id, mode, options, batch_folder, upload_folder, uploads, skipped, errors,
+                 client=None, cost=0.0):
+        self.batch_id = batch_id
+        self.mode = mode
+        self.options = options
+        self.batch_folder = batch_folder
+        self.upload_folder = upload_folder
+        self.uploads = uploads
+        self.skipped = skipped
+        self.state = 'queued'
+        self.progress = [{'name': upload.name, 'status': 'queued'} for upload in uploads]
+        self.converted_files = []
+        self.errors = errors
+        # Who sent the batch and its estimated CPU-seconds, for admission control
+        self.client = client
+        self.cost = cost
+        self.ticket = None
+        # convert_file() stats of a batch converted by a worker, handed back to its front-end's metrics
+        self.stats = []
+        self.queued_at = time.time()
+        self.finished_at = None
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+
+    def update(self, index, ok):
+        with self.lock:
+            self.progress[index]['status'] = 'done' if ok else 'error'
+            done = sum(1 for entry in self.progress if entry['status'] != 'queued') / len(self.progress)
+        if self.ticket:
+            admission.scheduler.progress(self.ticket, done)
+        self.save()
+
+    def save(self):
+        """Write the current status where other worker processes and nodes can read it"""
+        with self.save_lock:
+            status = self.status()
+            if self.done.is_set() and self.stats:
+                status['stats'] = self.stats
+            status_store.save(self.batch_id, status)
+
+    def task(self):
+        """The job as a broker task, with paths relative to the storage"""
+        uploads = [dict(vars(upload), path=storage.relative(upload.path)) for upload in self.uploads]
+        return {
+            'batch_id': self.batch_id,
+            'mode': self.mode,
+            'options': self.options,
+            'batch_folder': storage.relative(self.batch_folder),
+            'upload_folder': storage.relative(self.upload_folder),
+            'uploads': uploads,
+            'skipped': self.skipped,
+            'errors': self.errors
+        }
+
+    @classmethod
+    def from_task(cls, task):
+        uploads = [Upload(**dict(upload, path=storage.resolve(upload['path']))) for upload in task['uploads']]
+        return cls(task['batch_id'], task['mode'], task['options'], storage.resolve(task['batch_folder']),
+                   storage.resolve(task['upload_folder']), uploads, task['skipped'], task['errors'])
+
+    def result(self):
+        """Return the upload payload, same keys as the old blocking /upload"""
+        if not self.converted_files:
+            return {'success': False, 'error': 'No files were converted successfully'}
+        return {
+            'success': True,
+            'batch_id': self.batch_id,
+            'files': self.converted_files,
+            'errors': self.errors,
+            'skipped': self.skipped,
+            'is_batch': len(self.converted_files) > 1,
+            'mode': self.mode
+        }
+
+    def status(self):
+        """Return per-file progress, or the final payload once finished"""
+        if self.done.is_set():
+            payload = self.result()
+            payload['state'] = 'done'
+            return payload
+        with self.lock:
+            progress = [dict(entry) for entry in self.progress]
+        return {
+            'success': True,
+            'state': self.state,
+            'batch_id': self.batch_id,
+            'mode': self.mode,
+            'total': len(progress),
+            'completed': sum(1 for entry in progress if entry['status'] != 'queued'),
+            'progress': progress
+        }
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+def _convert(job, observe=metrics.record_conversion):
+    """Convert the uploads of a job in this process; returns the errors of its files"""
+    job.converted_files, errors = engine.convert_batch(
+        job.uploads, job.mode, job.batch_folder, job.options, progress=job.update,
+        cache=conversion_cache, observe=observe, results=result_store)
+    job.errors.extend(errors)
+    return errors
+
+def _dispatch(job):
+    """Hand a job to the workers through the broker and follow its status until they finish it.
+
+    The job stays 'queued' until a worker takes it and saves it as
+    'running'. Waiting behind other batches is bounded by
+    TASK_QUEUE_TIMEOUT; once taken, the worker must keep its status fresh
+    within TASK_TIMEOUT.
+    """
+    task_broker.publish(job.task())
+    dispatched_at = time.time()
+    while True:
+        time.sleep(TASK_POLL_INTERVAL)
+        status = status_store.load(job.batch_id) or {}
+        if status.get('state') == 'done':
+            failed = len(status.get('errors', job.errors)) - len(job.errors)
+            job.converted_files = status.get('files', [])
+            job.errors = status.get('errors', job.errors)
+            metrics.files.inc(max(0, failed), mode=job.mode, result='failed')
+            for stats in status.get('stats', []):
+                metrics.record_conversion(stats)
+            return
+        if status.get('progress'):
+            with job.lock:
+                job.progress = status['progress']
+            admission.scheduler.progress(job.ticket, status['completed'] / status['total'])
+        if status.get('state') == 'running':
+            job.state = 'running'
+            updated_at = status_store.updated_at(job.batch_id)
+            if updated_at is None or time.time() - updated_at > TASK_TIMEOUT:
+                raise RuntimeError('its conversion worker stopped responding')
+        elif time.time() - dispatched_at > TASK_QUEUE_TIMEOUT:
+            raise RuntimeError('no conversion worker took it in time')
+        elif time.time() - (status_store.updated_at(job.batch_id) or 0) > TASK_STATUS_REFRESH:
+            # So the cleanup on other nodes doesn't take the waiting batch for an abandoned one
+            status_store.touch(job.batch_id)
+
+def _run(job):
+    admission.scheduler.wait(job.ticket)
+    if not task_broker:
+        job.state = 'running'
+        job.save()
+    started = time.time()
+    metrics.queue_wait_seconds.observe(started - job.queued_at)
+    try:
+        if task_broker:
+            _dispatch(job)
+        else:
+            metrics.files.inc(len(_convert(job)), mode=job.mode, result='failed')
+    except Exception as e:
+        job.errors.append(f"Batch failed: {str(e)}")
+        metrics.files.inc(len(job.uploads), mode=job.mode, result='failed')
+    finally:
+        metrics.batch_seconds.observe(time.time() - started, mode=job.mode)
+        admission.scheduler.release(job.ticket)
+        job.state = 'done'
+        job.finished_at = time.time()
+        job.done.set()
+        # Saved before the uploads go, so a worker that takes a batch given up on sees it is done
+        job.save()
+        shutil.rmtree(job.upload_folder, ignore_errors=True)
+
+def submit(batch_id, mode, options, batch_folder, upload_folder, uploads, skipped, errors, client=None):
+    """Queue a batch for conversion and return its Job.
+
+    The batch waits for admission in a thread of its own, see
+    admission.FairScheduler. Raises QueueFull when JOB_QUEUE_SIZE batches
+    are already waiting or the batch would wait longer than
+    ADMISSION_MAX_WAIT, with the seconds after which to retry.
+    """
+    cost = admission.batch_cost(uploads, mode, options)
+    retry_after = admission.scheduler.retry_after(client, cost)
+    if retry_after is None and queue_depth() >= JOB_QUEUE_SIZE:
+        retry_after = max(1, round(admission.scheduler.stats()['running_cost'] / admission.scheduler.throughput))
+    if retry_after is not None:
+        raise QueueFull(retry_after)
+    job = Job(batch_id, mode, options, batch_folder, upload_folder, uploads, skipped, errors, client, cost)
+    # Queued right away so the next upload's estimate counts this batch
+    job.ticket = admission.scheduler.enqueue(client, cost, 'batch', JOB_WORKERS)
+    with _jobs_lock:
+        _jobs[batch_id] = job
+    # Saved before starting so it can't overwrite the runner's 'running' status
+    job.save()
+    threading.Thread(target=_run, args=(job,), daemon=True).start()
+    return job
+
+def get(batch_id):
+    """Return the Job of a batch submitted to this process"""
+    with _jobs_lock:
+        return _jobs.get(batch_id)
+
+def status(batch_id):
+    """Return the status of a batch submitted to any worker process, or None"""
+    job = get(batch_id)
+    if job is not None:
+        return job.status()
+    status = status_store.load(batch_id)
+    if status:
+        status.pop('stats', None)
+    return status
+
+def queue_depth():
+    """Batches of this process waiting for admission"""
+    with _jobs_lock:
+        return sum(1 for job in _jobs.values() if job.state == 'queued')
+
+def drain(timeout):
+    """Wait up to timeout seconds for queued and running batches to finish"""
+    deadline = time.time() + timeout
+    with _jobs_lock:
+        pending = [job for job in _jobs.values() if not job.done.is_set()]
+    for job in pending:
+        if not job.wait(max(0, deadline - time.time())):
+            return False
+    return True
+
+def prune():
+    """Forget finished jobs older than JOB_RETENTION"""
+    current_time = time.time()
+    with _jobs_lock:
+        for batch_id, job in list(_jobs.items()):
+            if job.finished_at and current_time - job.finished_at > JOB_RETENTION:
+                del _jobs[batch_id]
+
+def is_active(batch_id):
+    """Whether a batch is still queued or converting in any worker process"""
+    job = get(batch_id)
+    if job is not None:
+        return not job.done.is_set()
+    status, updated_at = status_store.load(batch_id), status_store.updated_at(batch_id)
+    if status is None or updated_at is None:
+        return False
+    # A status that stopped changing belongs to a process that died
+    return status.get('state') != 'done' and time.time() - updated_at < JOB_RETENTION
+
+def forget(batch_id):
+    """Drop everything known about an expired batch"""
+    with _jobs_lock:
+        _jobs.pop(batch_id, None)
+    status_store.remove(batch_id)
+
+def _work(job, deliveries):
+    """Convert a job taken off the broker, saving its status for the front-ends"""
+    job.state = 'running'
+    if deliveries > TASK_MAX_DELIVERIES:
+        job.errors.append('Batch failed: its conversion worker crashed')
+    else:
+        job.save()
+        try:
+            # Recorded by the front-end, whose /metrics is the one scraped
+            _convert(job, observe=job.stats.append)
+        except Exception as e:
+            job.errors.append(f"Batch failed: {str(e)}")
+    job.finished_at = time.time()
+    job.done.set()
+    job.save()
+
+def serve(broker, threads, stopping):
+    """Convert tasks from broker in threads threads until stopping is set; returns the threads.
+
+    While a task converts, its lease and its saved status are renewed every
+    third of the lease, so neither the broker nor the front-end waiting for
+    it takes a slow batch for a dead worker.
+    """
+    def work():
+        while not stopping.is_set():
+            claimed = broker.claim(timeout=1)
+            if claimed is None:
+                continue
+            receipt, task, deliveries = claimed
+            if (status_store.load(task['batch_id']) or {}).get('state') == 'done':
+                # The front-end gave up waiting and removed the uploads
+                broker.ack(receipt)
+                continue
+            job = Job.from_task(task)
+            finished = threading.Event()
+
+            def beat():
+                while not finished.wait(broker.lease / 3):
+                    broker.heartbeat(receipt)
+                    job.save()
+
+            threading.Thread(target=beat, daemon=True).start()
+            try:
+                _work(job, deliveries)
+            finally:
+                finished.set()
+            broker.ack(receipt)
+
+    workers = [threading.Thread(target=work, daemon=True) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    return workers
+
+if isinstance(task_broker, MemoryBroker):
+    # The in-process stand-in has no remote workers; its tasks are converted here
+    serve(task_broker, JOB_WORKERS, threading.Event())
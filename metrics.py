@@ -0,0 +1,236 @@
+import atexit
+import json
+import os
+import threading
+import time
+import engine
+
+# Upper bounds of the latency histograms, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Folder where every process of the host writes its metrics, so /metrics adds
+# up all web workers instead of answering for whichever one was asked. Set by
+# gunicorn.conf.py; empty keeps the metrics of each process to itself.
+METRICS_FOLDER = os.environ.get('METRICS_FOLDER', '')
+# Seconds between writes of this process's changed metrics to METRICS_FOLDER
+METRICS_FLUSH_INTERVAL = 1
+
+_registry = []
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    """Base of the metric types, rendered in the Prometheus text format"""
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.labelnames)
+
+    def snapshot(self):
+        """The values of this process, as JSON for the other processes"""
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    def _add(self, values, key, value):
+        values[key] = values.get(key, 0) + value
+
+    def render(self, snapshots=()):
+        """Samples of this process's values added to the snapshots of other processes"""
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            values = dict(self._values)
+        for snapshot in snapshots:
+            for key, value in snapshot:
+                self._add(values, tuple(key), value)
+        for key, value in sorted(values.items()):
+            lines.extend(self._samples(key, value))
+        return lines
+
+    def _samples(self, key, value):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"]
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    """Gauge read from a callback when /metrics is scraped.
+
+    Across processes the readings of the live ones are summed. A shared
+    gauge reads state all processes see alike, such as a folder's disk
+    usage, so only the process that is scraped reads it.
+    """
+    type = 'gauge'
+
+    def __init__(self, name, help, read, shared=False):
+        super().__init__(name, help)
+        self.read = read
+        self.shared = shared
+
+    def snapshot(self):
+        return None if self.shared else self.read()
+
+    def render(self, snapshots=()):
+        value = self.read() if self.shared else self.read() + sum(snapshots)
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}",
+                f"{self.name} {_format_value(value)}"]
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), [list(counts), total, count]] for key, (counts, total, count) in self._values.items()]
+
+    def _add(self, values, key, value):
+        counts, total, count = values.get(key, ([0] * len(self.buckets), 0.0, 0))
+        values[key] = ([a + b for a, b in zip(counts, value[0])], total + value[1], count + value[2])
+
+    def time(self, **labels):
+        """Context manager observing the seconds spent in its block"""
+        return _Timer(self, labels)
+
+    def _samples(self, key, value):
+        counts, total, count = value
+        bounds = [_format_value(bound) for bound in self.buckets] + ['+Inf']
+        samples = [f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', bound)])} {n}"
+                   for bound, n in zip(bounds, counts + [count])]
+        samples.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+        samples.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return samples
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+# Conversion path, per file
+stage_seconds = Histogram('imgtoavif_stage_seconds', 'Seconds spent in each conversion stage',
+                          ['mode', 'stage'])
+conversion_seconds = Histogram('imgtoavif_conversion_seconds', 'Seconds to convert one file in a worker',
+                               ['mode'])
+batch_seconds = Histogram('imgtoavif_batch_seconds', 'Seconds from a batch leaving the queue to its last file',
+                          ['mode'])
+queue_wait_seconds = Histogram('imgtoavif_queue_wait_seconds', 'Seconds a batch waited for a job worker')
+files = Counter('imgtoavif_files_total',
+                'Uploaded files by outcome: converted, cached, failed or skipped (unsupported extension)',
+                ['mode', 'result'])
+bytes_in = Counter('imgtoavif_bytes_in_total', 'Bytes of converted input files', ['mode'])
+bytes_out = Counter('imgtoavif_bytes_out_total', 'Bytes of the outputs written for them', ['mode'])
+batches_rejected = Counter('imgtoavif_batches_rejected_total', 'Batches refused because the server was busy')
+
+# Background work
+cleanup_seconds = Histogram('imgtoavif_cleanup_seconds', 'Duration of the cleanup sweep')
+
+def record_conversion(stats):
+    """Account the stats of one converted file (engine.convert_batch observe hook)"""
+    mode = stats['mode']
+    files.inc(mode=mode, result='cached' if stats.get('cached') else 'converted')
+    bytes_in.inc(stats['bytes_in'], mode=mode)
+    bytes_out.inc(stats['bytes_out'], mode=mode)
+    if stats.get('cached'):
+        return
+    for stage in engine.STAGES:
+        # Zero means the stage didn't run, e.g. resize outside the responsive mode
+        if stats[stage]:
+            stage_seconds.observe(stats[stage], mode=mode, stage=stage)
+    conversion_seconds.observe(sum(stats[stage] for stage in engine.STAGES), mode=mode)
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+_flushed = None
+
+def flush():
+    """Write this process's metrics to METRICS_FOLDER for the other processes, if they changed"""
+    global _flushed
+    snapshot = json.dumps({metric.name: metric.snapshot() for metric in _registry})
+    if snapshot == _flushed:
+        return
+    path = os.path.join(METRICS_FOLDER, f"{os.getpid()}.json")
+    with open(f"{path}.tmp", 'w') as f:
+        f.write(snapshot)
+    os.replace(f"{path}.tmp", path)
+    _flushed = snapshot
+
+def _other_processes():
+    """{pid: (alive, snapshot)} of the other processes that wrote to METRICS_FOLDER"""
+    snapshots = {}
+    for name in os.listdir(METRICS_FOLDER):
+        pid = name.split('.')[0]
+        if not name.endswith('.json') or not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        try:
+            with open(os.path.join(METRICS_FOLDER, name)) as f:
+                snapshots[int(pid)] = (_alive(int(pid)), json.load(f))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+def render():
+    """Return every metric in the Prometheus text exposition format"""
+    others = _other_processes() if METRICS_FOLDER else {}
+    lines = []
+    for metric in _registry:
+        # Counts of exited workers stay in the totals; gauges only describe running ones
+        snapshots = [snapshot[metric.name] for alive, snapshot in others.values()
+                     if snapshot.get(metric.name) is not None and (alive or metric.type != 'gauge')]
+        lines.extend(metric.render(snapshots))
+    return '\n'.join(lines) + '\n'
+
+def _flush_periodically():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        flush()
+
+if METRICS_FOLDER:
+    os.makedirs(METRICS_FOLDER, exist_ok=True)
+    threading.Thread(target=_flush_periodically, daemon=True).start()
+    # The last counts of an exiting worker still go into the totals
+    atexit.register(flush)
@@ -0,0 +1,90 @@
+import os
+import threading
+import time
+
+# Pillow codec plugins each conversion mode needs, loaded the first time the mode runs
+MODE_PLUGINS = {
+    'avif': ('avif',),
+    'responsive': ('avif',),
+    'target': ('avif',),
+    'png': ('heif',),
+    'compress': (),
+}
+# Modes whose plugins are loaded, and encoder processes started, right after
+# startup instead of on the first request: a comma-separated list or 'all'
+PREWARM_MODES = os.environ.get('PREWARM_MODES', '')
+
+# When the app's own imports started; the startup report counts from here
+STARTED = time.perf_counter()
+
+_modules = {}
+_lock = threading.Lock()
+_steps = []  # (step, seconds) in the order they happened
+_checkpoint = STARTED
+
+def _load_avif():
+    import pillow_avif
+    return pillow_avif
+
+def _load_heif():
+    import pillow_heif
+    pillow_heif.register_heif_opener()
+    return pillow_heif
+
+LOADERS = {'avif': _load_avif, 'heif': _load_heif}
+
+def load(name):
+    """Import and register a codec plugin on first use; returns its module"""
+    with _lock:
+        if name in _modules:
+            return _modules[name]
+    # Imported without holding _lock: a process forked meanwhile, like an
+    # encoder of the pool, would inherit it held and deadlock on its first
+    # load. Threads racing here both import, which Python serialises, and
+    # registering an opener twice is harmless
+    started = time.perf_counter()
+    module = LOADERS[name]()
+    seconds = time.perf_counter() - started
+    with _lock:
+        if name not in _modules:
+            _modules[name] = module
+            _steps.append((f"load {name} plugin", seconds))
+        return _modules[name]
+
+def load_mode(mode):
+    """Load the plugins a conversion mode needs"""
+    for name in MODE_PLUGINS.get(mode, ()):
+        load(name)
+
+def prewarm_modes():
+    """The modes listed in PREWARM_MODES"""
+    if PREWARM_MODES.strip() == 'all':
+        return list(MODE_PLUGINS)
+    return [mode for mode in (token.strip() for token in PREWARM_MODES.split(',')) if mode in MODE_PLUGINS]
+
+def checkpoint(step):
+    """Record the seconds since the previous checkpoint as the cost of step"""
+    global _checkpoint
+    now = time.perf_counter()
+    with _lock:
+        _steps.append((step, now - _checkpoint))
+        _checkpoint = now
+
+def record(step, seconds):
+    with _lock:
+        _steps.append((step, seconds))
+
+def report():
+    """Startup and plugin loading costs of this process, in seconds"""
+    with _lock:
+        return {
+            'steps': [{'step': step, 'seconds': round(seconds, 4)} for step, seconds in _steps],
+            'plugins': sorted(_modules),
+            'ready_seconds': round(_checkpoint - STARTED, 4)
+        }
+
+def summary():
+    """One line of the startup report, for logs"""
+    info = report()
+    steps = ', '.join(f"{step['step']} {step['seconds'] * 1000:.0f}ms" for step in info['steps'])
+    return f"ready in {info['ready_seconds'] * 1000:.0f}ms ({steps})"
@@ -0,0 +1,260 @@
+import io
+import os
+import time
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import numpy as np
+from PIL import Image, ImageChops
+import tiles
+
+# Seconds the compress mode aims to spend on one PNG. The strategy search
+# gets SEARCH_SHARE of it and the final encode is chosen to fit the rest.
+PNG_SEARCH_SECONDS = float(os.environ.get('PNG_SEARCH_SECONDS', '5'))
+SEARCH_SHARE = 0.5
+# Below this many pixels the trials would cost several times the encode they
+# improve on, so the image is encoded once in its smallest colour form
+PNG_SEARCH_MIN_PIXELS = int(os.environ.get('PNG_SEARCH_MIN_PIXELS', str(2 * 1000 * 1000)))
+# Trial encodes run on a SAMPLE_GRID x SAMPLE_GRID grid of blocks of
+# SAMPLE_BLOCK_ROWS rows, one from the middle of each cell of the image, about
+# PNG_SAMPLE_PIXELS in all and at most SAMPLE_SHARE of the image
+PNG_SAMPLE_PIXELS = int(os.environ.get('PNG_SAMPLE_PIXELS', str(256 * 1024)))
+SAMPLE_SHARE = 1 / 16
+SAMPLE_GRID = 4
+SAMPLE_BLOCK_ROWS = 64
+# Pillow's optimize is also encoded in full unless the final encode came out
+# smaller than its projection from the sample by this share
+BASELINE_MARGIN = 0.05
+# Rows per strip of an encode; the final encode deflates each strip in parallel parts
+ENCODE_ROWS = 256
+# Rows mapped to palette indices at a time, bounding the scratch memory
+PALETTE_ROWS = 256
+
+# Modes encoded here; others (16-bit, 1-bit) are left to Pillow
+MODES = ('L', 'LA', 'RGB', 'RGBA', 'P')
+STRATEGIES = {'default': zlib.Z_DEFAULT_STRATEGY, 'filtered': zlib.Z_FILTERED, 'rle': zlib.Z_RLE}
+# zlib (strategy, level) pairs tried with every filter, most promising first.
+# Level 6 is there for images whose level 9 encode wouldn't fit the time budget.
+ZLIB_SETTINGS = (('default', 9), ('filtered', 9), ('rle', 9), ('default', 6))
+# Row filters tried per kind of colour form, most promising first; palette
+# indices rarely gain from filtering
+FORM_FILTERS = {'palette': ('none', 'adaptive'), 'truecolor': ('adaptive', 'paeth', 'up', 'none')}
+MODE_NAMES = {'L': 'grayscale', 'LA': 'grayscale+alpha', 'RGB': 'RGB', 'RGBA': 'RGBA'}
+
+class Form:
+    """A lossless colour form of an image, applied alike to its sample and to the whole image.
+
+    Truecolor forms keep a subset of the bands, dropping an opaque alpha
+    channel or the copies of a gray one. Palette forms map each colour to
+    its palette index, packed into as few bits as the colour count allows.
+    """
+
+    def __init__(self, kind, mode, bands=None, keys=None, indices=None, palette=None, transparency=None):
+        self.kind = kind
+        self.mode = mode
+        self.bands = bands
+        # Palette forms: sorted colour keys and the palette index of each
+        self.keys = keys
+        self.indices = indices
+        self.palette = palette
+        self.transparency = transparency
+        colors = len(palette) // 3 if palette else 0
+        self.depth = next(depth for depth in (1, 2, 4, 8) if colors <= 1 << depth) if palette else 8
+
+    @property
+    def name(self):
+        if self.kind == 'palette':
+            return f"{len(self.palette) // 3}-color palette, {self.depth}-bit"
+        return MODE_NAMES[self.mode]
+
+    def apply(self, img):
+        """The image in this form, as strips for tiles.encode_png()"""
+        return tiles.MemoryStrips(self.image(img), self.depth)
+
+    def image(self, img):
+        """The image in this form"""
+        if self.kind == 'truecolor':
+            converted = img if self.bands is None else Image.merge(self.mode, [img.getchannel(band)
+                                                                               for band in self.bands])
+        else:
+            pixels = np.asarray(img)
+            mapped = np.empty(pixels.shape[:2], np.uint8)
+            for top in range(0, pixels.shape[0], PALETTE_ROWS):
+                mapped[top:top + PALETTE_ROWS] = self.indices[
+                    np.searchsorted(self.keys, _color_keys(pixels[top:top + PALETTE_ROWS]))]
+            converted = Image.frombytes('P', img.size, mapped.tobytes())
+            converted.putpalette(self.palette)
+            if self.transparency:
+                converted.info['transparency'] = self.transparency
+        if img.info.get('icc_profile'):
+            converted.info['icc_profile'] = img.info['icc_profile']
+        return converted
+
+def _color_keys(pixels):
+    """Pack the bands of each pixel into one integer"""
+    if pixels.ndim == 2:
+        return pixels.astype(np.uint32)
+    keys = np.zeros(pixels.shape[:2], np.uint32)
+    for band in range(pixels.shape[2]):
+        keys = (keys << 8) | pixels[..., band]
+    return keys
+
+def _palette_form(img):
+    """Palette form of an image with at most 256 colours, or None"""
+    colors = img.getcolors(256)
+    if colors is None:
+        return None
+    if img.mode == 'P':
+        # Keep only the entries in use
+        palette = img.getpalette()
+        transparency = img.info.get('transparency')
+        if isinstance(transparency, int):
+            transparency = b'\xff' * transparency + b'\0'
+        transparency = transparency or b''
+        entries = [(count, palette[3 * index:3 * index + 3],
+                    transparency[index] if index < len(transparency) else 255, index)
+                   for count, index in colors]
+    else:
+        entries = []
+        for count, color in colors:
+            bands = color if isinstance(color, tuple) else (color,)
+            rgb = list(bands[:3]) if img.mode in ('RGB', 'RGBA') else [bands[0]] * 3
+            key = 0
+            for value in bands:
+                key = (key << 8) | value
+            entries.append((count, rgb, bands[-1] if img.mode in ('LA', 'RGBA') else 255, key))
+    # Most used first; tRNS stops at the last translucent entry
+    entries.sort(key=lambda entry: -entry[0])
+    translucent = [index for index, entry in enumerate(entries) if entry[2] < 255]
+    alpha = bytes(entry[2] for entry in entries[:translucent[-1] + 1]) if translucent else None
+    keys = np.array([entry[3] for entry in entries], np.uint32)
+    order = np.argsort(keys)
+    return Form('palette', 'P', keys=keys[order], indices=order.astype(np.uint8),
+                palette=[value for entry in entries for value in entry[1]], transparency=alpha)
+
+def _truecolor_form(img):
+    """img without its redundant bands: an opaque alpha channel, or equal R, G and B"""
+    bands = list(img.getbands())
+    if bands[-1] == 'A' and img.getchannel('A').getextrema() == (255, 255):
+        bands.pop()
+    if bands[:3] == ['R', 'G', 'B']:
+        red, green, blue = (img.getchannel(band) for band in 'RGB')
+        if not ImageChops.difference(red, green).getbbox() and not ImageChops.difference(green, blue).getbbox():
+            bands[:3] = ['R']
+    mode = {1: 'L', 2: 'LA', 3: 'RGB', 4: 'RGBA'}[len(bands)]
+    return Form('truecolor', mode, None if len(bands) == len(img.getbands()) else tuple(bands))
+
+def forms(img):
+    """The lossless colour forms worth trying for img"""
+    palette = _palette_form(img)
+    if img.mode == 'P':
+        return [palette]
+    truecolor = _truecolor_form(img)
+    candidates = [truecolor]
+    # An 8-bit palette of a grayscale image saves nothing
+    if palette and (truecolor.mode != 'L' or palette.depth < 8):
+        candidates.append(palette)
+    return candidates
+
+def sample_of(img):
+    """Blocks from across img, about PNG_SAMPLE_PIXELS in all and at most SAMPLE_SHARE of img"""
+    width, height = img.size
+    pixels = min(PNG_SAMPLE_PIXELS, int(width * height * SAMPLE_SHARE))
+    rows = min(height // SAMPLE_GRID, SAMPLE_BLOCK_ROWS) or height
+    columns = min(width // SAMPLE_GRID, max(1, pixels // (SAMPLE_GRID * SAMPLE_GRID * rows))) or width
+    grid = SAMPLE_GRID if rows < height and columns < width else 1
+    sample = Image.new(img.mode, (grid * columns, grid * rows))
+    if img.mode == 'P':
+        sample.putpalette(img.getpalette())
+    for row in range(grid):
+        # Centred in their cell, so the edges, often borders or flat margins, don't dominate
+        top = height * (2 * row + 1) // (2 * grid) - rows // 2
+        for column in range(grid):
+            left = width * (2 * column + 1) // (2 * grid) - columns // 2
+            sample.paste(img.crop((left, top, left + columns, top + rows)), (column * columns, row * rows))
+    return sample
+
+def _encode(source, threads, filter, strategy, level):
+    started = time.perf_counter()
+    buffer = io.BytesIO()
+    tiles.encode_png(source, buffer, ENCODE_ROWS, threads, level, STRATEGIES[strategy], filter)
+    return buffer.getvalue(), time.perf_counter() - started
+
+def _pillow_encode(img):
+    """The baseline the search has to beat: Pillow's zlib level 9 with its adaptive filter"""
+    started = time.perf_counter()
+    buffer = io.BytesIO()
+    img.save(buffer, format='PNG', optimize=True)
+    return buffer.getvalue(), time.perf_counter() - started
+
+def optimize(img, threads, budget=PNG_SEARCH_SECONDS):
+    """Encode img as the smallest lossless PNG found in about budget seconds.
+
+    Images below PNG_SEARCH_MIN_PIXELS are encoded once in their smallest
+    colour form, a palette at zlib level 9 or truecolor by Pillow's
+    optimize. Otherwise every combination of colour form, row filter and
+    zlib settings is encoded on a sample of the image, threads trials at a
+    time and the most promising first, until SEARCH_SHARE of the budget is
+    spent. The image is then encoded once with the smallest trial whose
+    full encode, projected from its time on the sample, fits what is left
+    of the budget. Pillow's optimize is trialled on the sample as well; it
+    is used instead when it does better there, and encoded in full to
+    compare against when the final encode doesn't clearly beat it, so the
+    result is never larger than Pillow's. Returns (data, strategy) with
+    strategy describing the settings used.
+    """
+    started = time.perf_counter()
+    if img.mode in ('L', 'RGB') and 'transparency' in img.info:
+        # A transparent colour key becomes an alpha channel or a palette entry
+        img = img.convert('LA' if img.mode == 'L' else 'RGBA')
+    if img.mode not in MODES:
+        return _pillow_encode(img)[0], 'Pillow optimize'
+
+    candidates = forms(img)
+    if img.width * img.height < PNG_SEARCH_MIN_PIXELS:
+        # The palette form when there is one, packed here; the leanest truecolor one otherwise
+        form = candidates[-1]
+        if form.kind == 'palette':
+            data, _ = _encode(form.apply(img), threads, 'none', 'default', 9)
+            return data, f"{form.name}, none filter, zlib default level 9"
+        return _pillow_encode(form.image(img))[0], f"{form.name}, Pillow optimize"
+
+    # Pillow's optimize of the leanest truecolor form (or the palette of a P image)
+    baseline = candidates[0]
+    sample = sample_of(img)
+    trials = [(form, filter, setting) for form in candidates for filter in FORM_FILTERS[form.kind]
+              for setting in ZLIB_SETTINGS]
+    # Stable, so the forms take turns at every rank
+    trials.sort(key=lambda trial: FORM_FILTERS[trial[0].kind].index(trial[1]) + ZLIB_SETTINGS.index(trial[2]))
+    sources = {form: form.apply(sample) for form in {trial[0] for trial in trials}}
+    executor = ThreadPoolExecutor(threads)
+    try:
+        # Submitted first, so the baseline is always measured
+        baseline_trial = executor.submit(_pillow_encode, baseline.image(sample))
+        futures = {executor.submit(_encode, sources[form], 1, filter, *setting): (form, filter, setting)
+                   for form, filter, setting in trials}
+        done, pending = wait(futures, timeout=max(0.0, budget * SEARCH_SHARE - (time.perf_counter() - started)))
+        if not done:
+            done, pending = wait(futures, return_when=FIRST_COMPLETED)
+        baseline_data, baseline_seconds = baseline_trial.result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    results = [(future.result(), futures[future]) for future in done]
+
+    scale = (img.width * img.height) / (sample.width * sample.height)
+    baseline_size = len(baseline_data) * scale
+    left = budget - (time.perf_counter() - started)
+    fitting = [result for result in results if result[0][1] * scale / threads <= left]
+    if fitting:
+        (trial_data, _), (form, filter, (strategy, level)) = min(fitting, key=lambda result: len(result[0][0]))
+    else:
+        (trial_data, _), (form, filter, (strategy, level)) = min(results, key=lambda result: result[0][1])
+    data = None
+    if len(trial_data) < len(baseline_data) or baseline_seconds * scale > left:
+        data, _ = _encode(form.apply(img), threads, filter, strategy, level)
+        if len(data) <= baseline_size * (1 - BASELINE_MARGIN):
+            return data, f"{form.name}, {filter} filter, zlib {strategy} level {level}"
+    # Never worse than the Pillow save the compress mode used to do
+    fallback, _ = _pillow_encode(baseline.image(img))
+    if data is None or len(fallback) <= len(data):
+        return fallback, f"{baseline.name}, Pillow optimize"
+    return data, f"{form.name}, {filter} filter, zlib {strategy} level {level}"
@@ -0,0 +1,202 @@
+import io
+import math
+import os
+import numpy as np
+from PIL import Image
+
+# Encoder quality range searched by the target mode
+QUALITY_MIN = 10
+QUALITY_MAX = 95
+# The search stops once the remaining quality interval is this narrow
+QUALITY_STEP = 3
+# Trial encodes run on a proxy of about this many pixels, built from tiles of
+# PROXY_TILE pixels (a multiple of the AV1 superblock size)
+PROXY_PIXELS = int(os.environ.get('QUALITY_PROXY_PIXELS', str(512 * 512)))
+PROXY_TILE = 128
+# Full-resolution encodes allowed when the proxy's size estimate misses a byte budget
+MAX_FULL_ENCODES = 3
+# Rows of the full-size output measured at a time, bounding the float scratch
+# memory to a few dozen bytes per pixel of a strip instead of the whole image
+MEASURE_ROWS = 256
+
+METRICS = ('size', 'ssim', 'psnr')
+# Largest byte budget accepted, far above any output; bigger numbers are typos or abuse
+MAX_TARGET_BYTES = 1 << 40
+
+def parse_target(text):
+    """Parse 'ssim:0.95', 'psnr:40' or 'size:200k' into a target, None if invalid"""
+    metric, _, value = (text or '').strip().lower().partition(':')
+    if metric not in METRICS:
+        return None
+    multiplier = 1
+    if metric == 'size' and value[-1:] in ('k', 'm'):
+        multiplier = 1024 if value[-1] == 'k' else 1024 * 1024
+        value = value[:-1]
+    try:
+        value = float(value) * multiplier
+    except ValueError:
+        return None
+    # inf and nan would slip past the range checks
+    if not math.isfinite(value) or metric == 'ssim' and not 0 < value < 1 or value <= 0:
+        return None
+    if metric == 'size' and value > MAX_TARGET_BYTES:
+        return None
+    return {'metric': metric, 'value': int(value) if metric == 'size' else value}
+
+def _luma(pixels):
+    return pixels[..., 0] * np.float32(0.299) + pixels[..., 1] * np.float32(0.587) + pixels[..., 2] * np.float32(0.114)
+
+def _box_mean(values, size):
+    """Mean over every size x size window, from an integral image"""
+    integral = np.pad(values, ((1, 0), (1, 0))).cumsum(0, dtype=np.float64).cumsum(1)
+    sums = integral[size:, size:] - integral[:-size, size:] - integral[size:, :-size] + integral[:-size, :-size]
+    return (sums / (size * size)).astype(np.float32)
+
+def _ssim_scores(reference, candidate, window):
+    """SSIM of every window x window block of the luma of two uint8 RGB arrays"""
+    x = _luma(reference.astype(np.float32))
+    y = _luma(candidate.astype(np.float32))
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    mean_x, mean_y = _box_mean(x, window), _box_mean(y, window)
+    var_x = _box_mean(x * x, window) - mean_x * mean_x
+    var_y = _box_mean(y * y, window) - mean_y * mean_y
+    covariance = _box_mean(x * y, window) - mean_x * mean_y
+    return ((2 * mean_x * mean_y + c1) * (2 * covariance + c2)
+            / ((mean_x * mean_x + mean_y * mean_y + c1) * (var_x + var_y + c2)))
+
+def ssim(reference, candidate, window=7):
+    """Mean SSIM of the luma of two uint8 RGB arrays, with a uniform window"""
+    return float(_ssim_scores(reference, candidate, min(window, *reference.shape[:2])).mean())
+
+def _squared_error(reference, candidate):
+    return float(np.sum((reference.astype(np.float32) - candidate.astype(np.float32)) ** 2, dtype=np.float64))
+
+def _psnr(error):
+    return 100.0 if error == 0 else float(10 * math.log10(255 ** 2 / error))
+
+def psnr(reference, candidate):
+    """PSNR in dB of two uint8 RGB arrays"""
+    return _psnr(_squared_error(reference, candidate) / reference.size)
+
+def _pixels(img):
+    return np.asarray(img.convert('RGB'))
+
+def _encode(img, save_options, quality):
+    buffer = io.BytesIO()
+    img.save(buffer, **dict(save_options, quality=quality))
+    return buffer.getvalue()
+
+def _measure(metric, reference, data):
+    with Image.open(io.BytesIO(data)) as decoded:
+        candidate = _pixels(decoded)
+    return ssim(reference, candidate) if metric == 'ssim' else psnr(reference, candidate)
+
+def _measure_strips(metric, img, data, window=7):
+    """Like _measure() against img at full resolution, MEASURE_ROWS rows at a time.
+
+    The strips overlap by the SSIM window, so the result is the one a
+    whole-image measurement gives.
+    """
+    width, height = img.size
+    window = min(window, width, height)
+    total = count = 0
+    with Image.open(io.BytesIO(data)) as decoded:
+        for top in range(0, height - window + 1 if metric == 'ssim' else height, MEASURE_ROWS):
+            bottom = min(height, top + MEASURE_ROWS + (window - 1 if metric == 'ssim' else 0))
+            reference = _pixels(img.crop((0, top, width, bottom)))
+            candidate = _pixels(decoded.crop((0, top, width, bottom)))
+            if metric == 'ssim':
+                scores = _ssim_scores(reference, candidate, window)
+                total += float(scores.sum(dtype=np.float64))
+                count += scores.size
+            else:
+                total += _squared_error(reference, candidate)
+                count += reference.size
+    return total / count if metric == 'ssim' else _psnr(total / count)
+
+def proxy_of(img):
+    """Mosaic of full-resolution tiles spread over img, about PROXY_PIXELS large.
+
+    Unlike a downscaled copy, the tiles keep the image's fine detail and
+    noise, so bytes per pixel and SSIM measured on the mosaic carry over to
+    the full-size encode.
+    """
+    width, height = img.size
+    if width * height <= PROXY_PIXELS * 2:
+        return img
+    tile = min(PROXY_TILE, width, height)
+    count = max(1, PROXY_PIXELS // (tile * tile))
+    columns = max(1, min(width // tile, round(math.sqrt(count * width / height))))
+    rows = max(1, min(height // tile, count // columns))
+    mosaic = Image.new(img.mode, (columns * tile, rows * tile))
+    for row in range(rows):
+        y = (height - tile) * row // (rows - 1) if rows > 1 else (height - tile) // 2
+        for column in range(columns):
+            x = (width - tile) * column // (columns - 1) if columns > 1 else (width - tile) // 2
+            mosaic.paste(img.crop((x, y, x + tile, y + tile)), (column * tile, row * tile))
+    return mosaic
+
+def search(img, save_options, target):
+    """Find the encoder quality that meets target and encode img with it.
+
+    Binary search over quality runs on a small proxy of the image, where a
+    trial encode costs a fraction of a full one; results are memoised. For a
+    byte budget the proxy size is scaled by the pixel ratio, then corrected
+    with at most MAX_FULL_ENCODES full encodes. Returns (data, quality, measured)
+    where measured maps 'ssim' or 'psnr' to the value of the final output
+    (SSIM for byte budgets).
+    """
+    metric, goal = target['metric'], target['value']
+    proxy = proxy_of(img)
+    scale = (img.width * img.height) / (proxy.width * proxy.height)
+    reference = _pixels(proxy)
+    trials = {}
+
+    def meets(quality):
+        if quality not in trials:
+            data = _encode(proxy, save_options, quality)
+            trials[quality] = len(data) * scale if metric == 'size' else _measure(metric, reference, data)
+        return trials[quality] <= goal if metric == 'size' else trials[quality] >= goal
+
+    # Size shrinks as quality drops, metrics improve as it rises: keep the
+    # highest quality within a byte budget, the lowest one above a metric floor
+    low, high = QUALITY_MIN, QUALITY_MAX
+    if metric == 'size':
+        if meets(high):
+            quality = high
+        elif not meets(low):
+            quality = low
+        else:
+            while high - low > QUALITY_STEP:
+                middle = (low + high) // 2
+                if meets(middle):
+                    low = middle
+                else:
+                    high = middle
+            quality = low
+    else:
+        if meets(low):
+            quality = low
+        elif not meets(high):
+            quality = high
+        else:
+            while high - low > QUALITY_STEP:
+                middle = (low + high) // 2
+                if meets(middle):
+                    high = middle
+                else:
+                    low = middle
+            quality = high
+
+    data = _encode(img, save_options, quality)
+    if metric == 'size':
+        encodes = 1
+        while len(data) > goal and quality > QUALITY_MIN and encodes < MAX_FULL_ENCODES:
+            # The proxy underestimated; bits shrink roughly linearly with quality
+            quality = max(QUALITY_MIN, min(quality - QUALITY_STEP, int(quality * goal / len(data))))
+            data = _encode(img, save_options, quality)
+            encodes += 1
+
+    measured_metric = 'ssim' if metric == 'size' else metric
+    # In strips: the float copies of a whole large image would take dozens of bytes a pixel
+    return data, quality, {measured_metric: round(_measure_strips(measured_metric, img, data), 4)}
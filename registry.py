@@ -0,0 +1,101 @@
+import os
+import sqlite3
+import time
+from contextlib import closing
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS batches (
+    batch_id TEXT PRIMARY KEY,
+    created_at REAL NOT NULL,
+    accessed_at REAL NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS batches_expires_at ON batches (expires_at);
+"""
+
+class BatchRegistry:
+    """Creation, last access and expiry time of every batch, indexed by expiry.
+
+    Backed by SQLite so all server processes on a host share it; keep it on a
+    local disk, SQLite's locking isn't reliable over network filesystems.
+    The cleanup sweep asks for the batches that are due instead of scanning
+    folders.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with closing(self._connect()) as db:
+            # WAL lets readers in other processes run while the sweep writes
+            db.execute('PRAGMA journal_mode=WAL')
+            db.executescript(SCHEMA)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def register(self, batch_id, ttl, created_at=None):
+        """Add a batch that expires ttl seconds after created_at (default: now)"""
+        created_at = created_at or time.time()
+        with closing(self._connect()) as db, db:
+            db.execute('INSERT OR IGNORE INTO batches VALUES (?, ?, ?, ?)',
+                       (batch_id, created_at, created_at, created_at + ttl))
+
+    def touch(self, batch_id, ttl):
+        """Record an access and keep the batch for at least ttl more seconds"""
+        now = time.time()
+        with closing(self._connect()) as db, db:
+            db.execute('UPDATE batches SET accessed_at = ?, expires_at = MAX(expires_at, ?) WHERE batch_id = ?',
+                       (now, now + ttl, batch_id))
+
+    def remove(self, batch_id):
+        with closing(self._connect()) as db, db:
+            db.execute('DELETE FROM batches WHERE batch_id = ?', (batch_id,))
+
+    def due(self, limit=1000):
+        """Return up to limit batch ids whose expiry has passed, oldest first"""
+        with closing(self._connect()) as db:
+            rows = db.execute('SELECT batch_id FROM batches WHERE expires_at <= ? ORDER BY expires_at LIMIT ?',
+                              (time.time(), limit)).fetchall()
+        return [batch_id for batch_id, in rows]
+
+    def next_expiry(self):
+        """Time at which the next batch expires, or None without batches"""
+        with closing(self._connect()) as db:
+            return db.execute('SELECT MIN(expires_at) FROM batches').fetchone()[0]
+
+    def known(self, batch_ids):
+        """Return which of batch_ids are registered"""
+        batch_ids = list(batch_ids)
+        known = set()
+        with closing(self._connect()) as db:
+            # Stay below SQLite's limit on bound parameters
+            for start in range(0, len(batch_ids), 500):
+                chunk = batch_ids[start:start + 500]
+                rows = db.execute(f"SELECT batch_id FROM batches WHERE batch_id IN ({','.join('?' * len(chunk))})",
+                                  chunk).fetchall()
+                known.update(batch_id for batch_id, in rows)
+        return known
+
+    def count(self):
+        with closing(self._connect()) as db:
+            return db.execute('SELECT COUNT(*) FROM batches').fetchone()[0]
+
+def adopt_folders(registry, folders, ttl):
+    """Register batch folders the registry doesn't know yet, aged by their ctime.
+
+    Run at startup and then periodically, for batches left by a version
+    without the registry, by a crash between storing an upload and
+    registering it, or created through another node sharing the storage.
+    """
+    found = {}
+    for folder in folders:
+        if not os.path.isdir(folder):
+            continue
+        for batch_id in os.listdir(folder):
+            path = os.path.join(folder, batch_id)
+            if not batch_id.startswith('.') and os.path.isdir(path):
+                found.setdefault(batch_id, os.path.getctime(path))
+    known = registry.known(found)
+    for batch_id, created_at in found.items():
+        if batch_id not in known:
+            registry.register(batch_id, ttl, created_at)
+    return len(found) - len(known)
@@ -0,0 +1,208 @@
+import hashlib
+import io
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+import storage
+
+CONVERTED_FOLDER = storage.path('converted')
+
+# Where converted outputs are kept until their batch expires: 'disk' or 'memory'
+RESULT_STORE = os.environ.get('RESULT_STORE', 'disk')
+# Size cap of the memory store; least recently used outputs spill to disk beyond it
+RESULT_MEMORY_BYTES = int(os.environ.get('RESULT_MEMORY_BYTES', str(64 * 1024 * 1024)))
+# Outputs of at least this size always go to disk
+RESULT_MEMORY_FILE_BYTES = int(os.environ.get('RESULT_MEMORY_FILE_BYTES', str(256 * 1024)))
+
+# Content hashes of files on disk remembered per process, so each file is read once
+MAX_DIGESTS = 4096
+_digests = OrderedDict()  # (path, size, mtime) -> hex digest, least recently used first
+_digests_lock = threading.Lock()
+
+def _digest(stream):
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(1024 * 1024), b''):
+        digest.update(chunk)
+    return digest.hexdigest()[:32]
+
+class StoredResult:
+    """One converted output, either a file on disk (path) or bytes in memory (data)"""
+
+    def __init__(self, filename, size, mtime, path=None, data=None):
+        self.filename = filename
+        self.size = size
+        self.mtime = mtime
+        self.path = path
+        self.data = data
+        self._etag = None
+
+    def open(self):
+        return open(self.path, 'rb') if self.path else io.BytesIO(self.data)
+
+    @property
+    def etag(self):
+        """Hash of the content; outputs never change, so it is a strong validator"""
+        if self._etag is None and self.data is not None:
+            self._etag = _digest(io.BytesIO(self.data))
+        elif self._etag is None:
+            key = (self.path, self.size, self.mtime)
+            with _digests_lock:
+                self._etag = _digests.get(key)
+                if self._etag:
+                    _digests.move_to_end(key)
+            if self._etag is None:
+                with self.open() as f:
+                    self._etag = _digest(f)
+                with _digests_lock:
+                    _digests[key] = self._etag
+                    if len(_digests) > MAX_DIGESTS:
+                        _digests.popitem(last=False)
+        return self._etag
+
+class DiskResultStore:
+    """Outputs as files in <folder>/<batch_id>/, written by the encoder processes"""
+
+    # Outputs smaller than this are handed to put() instead of written by the encoder
+    inline_bytes = 0
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def batch_folder(self, batch_id):
+        # Batch ids and output names never start with a dot, '..' must not escape the folder
+        if not batch_id or batch_id.startswith('.') or os.sep in batch_id:
+            raise ValueError(f"invalid batch id {batch_id!r}")
+        return os.path.join(self.folder, batch_id)
+
+    def put(self, batch_id, filename, data):
+        path = os.path.join(self.batch_folder(batch_id), filename)
+        if os.path.exists(path):
+            # May be a hardlink into the conversion cache
+            os.remove(path)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def get(self, batch_id, filename):
+        """Return the StoredResult of an output, or None"""
+        if filename.startswith('.') or os.sep in filename:
+            return None
+        try:
+            path = os.path.join(self.batch_folder(batch_id), filename)
+            stat = os.stat(path)
+        except (ValueError, OSError):
+            return None
+        if not os.path.isfile(path):
+            return None
+        return StoredResult(filename, stat.st_size, stat.st_mtime, path=os.path.abspath(path))
+
+    def list(self, batch_id):
+        """Sorted output filenames of a batch, None for an unknown batch"""
+        try:
+            batch_folder = self.batch_folder(batch_id)
+            return sorted(name for name in os.listdir(batch_folder)
+                          if os.path.isfile(os.path.join(batch_folder, name)))
+        except (ValueError, OSError):
+            return None
+
+    def touch(self, batch_id):
+        """Record an access in the batch folder's mtime, seen by every node"""
+        try:
+            os.utime(self.batch_folder(batch_id))
+        except (ValueError, OSError):
+            pass
+
+    def accessed_at(self, batch_id):
+        """Time of the last touch() or output written, None for an unknown batch"""
+        try:
+            return os.path.getmtime(self.batch_folder(batch_id))
+        except (ValueError, OSError):
+            return None
+
+    def remove(self, batch_id):
+        try:
+            shutil.rmtree(self.batch_folder(batch_id), ignore_errors=True)
+        except ValueError:
+            pass
+
+    def stats(self):
+        return {'store': 'disk'}
+
+class MemoryResultStore(DiskResultStore):
+    """Small outputs kept in memory with LRU eviction, the rest on disk.
+
+    Outputs below file_bytes never touch the disk unless the store grows
+    past max_bytes; the least recently used ones are then written to their
+    batch folder, so they stay downloadable until the batch expires. The
+    memory is private to the process, so it suits a single web worker
+    converting its own batches, without a broker.
+    """
+
+    def __init__(self, folder, max_bytes, file_bytes):
+        super().__init__(folder)
+        self.max_bytes = max_bytes
+        self.inline_bytes = file_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # (batch_id, filename) -> StoredResult, least recently used first
+        self._total = 0
+
+    def put(self, batch_id, filename, data):
+        if len(data) >= self.inline_bytes:
+            return super().put(batch_id, filename, data)
+        result = StoredResult(filename, len(data), time.time(), data=bytes(data))
+        with self._lock:
+            previous = self._entries.pop((batch_id, filename), None)
+            self._total += result.size - (previous.size if previous else 0)
+            self._entries[(batch_id, filename)] = result
+        self._evict()
+
+    def _evict(self):
+        while True:
+            with self._lock:
+                if self._total <= self.max_bytes or not self._entries:
+                    return
+                (batch_id, filename), result = self._entries.popitem(last=False)
+                self._total -= result.size
+            if os.path.isdir(self.batch_folder(batch_id)):
+                # Spill to disk so the output stays downloadable until its batch expires
+                super().put(batch_id, filename, result.data)
+
+    def get(self, batch_id, filename):
+        with self._lock:
+            result = self._entries.get((batch_id, filename))
+            if result:
+                self._entries.move_to_end((batch_id, filename))
+                return result
+        return super().get(batch_id, filename)
+
+    def list(self, batch_id):
+        filenames = super().list(batch_id)
+        if filenames is None:
+            return None
+        with self._lock:
+            in_memory = [filename for key_batch, filename in self._entries if key_batch == batch_id]
+        return sorted(set(filenames).union(in_memory))
+
+    def remove(self, batch_id):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == batch_id]:
+                self._total -= self._entries.pop(key).size
+        super().remove(batch_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'store': 'memory',
+                'entries': len(self._entries),
+                'bytes': self._total,
+                'max_bytes': self.max_bytes
+            }
+
+def create_store(kind, folder):
+    if kind == 'memory':
+        return MemoryResultStore(folder, RESULT_MEMORY_BYTES, RESULT_MEMORY_FILE_BYTES)
+    return DiskResultStore(folder)
+
+result_store = create_store(RESULT_STORE, CONVERTED_FOLDER)
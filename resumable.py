@@ -0,0 +1,262 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+import admission
+import engine
+import metrics
+from cache import conversion_cache
+from ingest import ingest_file
+from results import result_store
+
+# Size of the chunks clients are asked to send, must stay below MAX_CONTENT_LENGTH
+UPLOAD_CHUNK_BYTES = int(os.environ.get('UPLOAD_CHUNK_BYTES', str(8 * 1024 * 1024)))
+# Total declared size a chunked batch may have
+MAX_BATCH_BYTES = int(os.environ.get('MAX_BATCH_BYTES', str(2 * 1024 * 1024 * 1024)))
+# A batch without any upload or conversion activity for this long is abandoned
+IDLE_TIMEOUT = 600
+
+BATCH_FILE = 'batch.json'
+
+# Files whose last chunk arrived are converted here, in the process that received it.
+# The threads mostly wait for admission, the engine's process pool and decode budget.
+CONVERTER_THREADS = engine.CONVERT_WORKERS * 2
+_converters = ThreadPoolExecutor(max_workers=CONVERTER_THREADS)
+
+class ChunkError(Exception):
+    """Raised when a chunk can't be accepted; status is the HTTP status to answer"""
+
+    def __init__(self, message, status=400, received=None):
+        super().__init__(message)
+        self.status = status
+        self.received = received
+
+class ChunkedBatch:
+    """A batch uploaded file by file in chunks, with all its state on disk.
+
+    Every web worker process can take chunks, so nothing lives in memory:
+    upload_folder holds batch.json with the declared files, <n>_<name>.part
+    while a file is received, <n>_<name> once complete and <n>.json with the
+    conversion result of file n.
+    """
+
+    def __init__(self, batch_id, upload_folder, batch_folder, info):
+        self.batch_id = batch_id
+        self.upload_folder = upload_folder
+        self.batch_folder = batch_folder
+        self.info = info
+
+    @classmethod
+    def create(cls, batch_id, upload_folder, batch_folder, mode, options, files, skipped, errors, client=None):
+        """Start a batch of files given as (name, filename, size); client is who sends it"""
+        os.makedirs(upload_folder, exist_ok=True)
+        os.makedirs(batch_folder, exist_ok=True)
+        info = {
+            'mode': mode,
+            'options': options,
+            'files': [{'name': name, 'filename': filename, 'size': size} for name, filename, size in files],
+            'skipped': skipped,
+            'errors': errors,
+            'client': client,
+            'finalized': False,
+            'created_at': time.time()
+        }
+        batch = cls(batch_id, upload_folder, batch_folder, info)
+        batch._save_info()
+        return batch
+
+    @classmethod
+    def load(cls, batch_id, upload_folder, batch_folder):
+        """Return the chunked batch stored in upload_folder, or None"""
+        try:
+            with open(os.path.join(upload_folder, BATCH_FILE)) as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return cls(batch_id, upload_folder, batch_folder, info)
+
+    def _save_info(self):
+        path = os.path.join(self.upload_folder, BATCH_FILE)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.info, f)
+        os.replace(tmp_path, path)
+
+    def _path(self, index):
+        return os.path.join(self.upload_folder, f"{index}_{self.info['files'][index]['filename']}")
+
+    def _result_path(self, index):
+        return os.path.join(self.upload_folder, f"{index}.json")
+
+    def _result(self, index):
+        try:
+            with open(self._result_path(index)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def received(self, index):
+        """Bytes of file index stored so far"""
+        path = self._path(index)
+        if os.path.exists(path) or os.path.exists(self._result_path(index)):
+            return self.info['files'][index]['size']
+        try:
+            return os.path.getsize(f"{path}.part")
+        except OSError:
+            return 0
+
+    def write_chunk(self, index, offset, stream):
+        """Append the chunk in stream at offset; returns the bytes received so far.
+
+        Conversion of the file starts as soon as its last chunk is stored.
+        Raises ChunkError when offset isn't where the stored data ends, which
+        tells a resuming client where to continue.
+        """
+        if not 0 <= index < len(self.info['files']):
+            raise ChunkError('unknown file', 404)
+        size = self.info['files'][index]['size']
+        if self.received(index) == size:
+            # A retry of the last chunk after its response was lost
+            return size
+        if self.info['finalized']:
+            raise ChunkError('batch was already finalized', 409)
+
+        part_path = f"{self._path(index)}.part"
+        with open(part_path, 'ab') as f:
+            if fcntl:
+                # Retries of one chunk may reach two worker processes at once
+                fcntl.flock(f, fcntl.LOCK_EX)
+            received = f.seek(0, os.SEEK_END)
+            if offset != received:
+                raise ChunkError(f"expected offset {received}", 409, received)
+            remaining = size - received
+            for chunk in iter(lambda: stream.read(min(1024 * 1024, remaining + 1)), b''):
+                if len(chunk) > remaining:
+                    f.truncate(received)
+                    raise ChunkError('chunk goes past the declared file size', 400, received)
+                f.write(chunk)
+                received += len(chunk)
+                remaining -= len(chunk)
+            f.flush()
+        if received == size:
+            try:
+                os.rename(part_path, self._path(index))
+            except FileNotFoundError:
+                # Completed by a concurrent retry, which also started the conversion
+                return size
+            _converters.submit(self._convert, index)
+        return received
+
+    def _convert(self, index):
+        declared = self.info['files'][index]
+        mode = self.info['mode']
+        result = {'status': 'error', 'entries': []}
+        try:
+            with metrics.stage_seconds.time(mode=mode, stage='ingest'):
+                upload = ingest_file(self._path(index), declared['name'], declared['filename'])
+            ticket = admission.scheduler.acquire(self.info.get('client'),
+                                                 admission.batch_cost([upload], mode, self.info['options']),
+                                                 'file', CONVERTER_THREADS)
+            try:
+                entries, errors = engine.convert_batch([upload], mode, self.batch_folder, self.info['options'],
+                                                       cache=conversion_cache, observe=metrics.record_conversion,
+                                                       results=result_store)
+            finally:
+                admission.scheduler.release(ticket)
+            if errors:
+                result['error'] = errors[0]
+            else:
+                result.update(status='done', entries=entries)
+        except Exception as e:
+            result['error'] = f"{declared['name']}: {str(e)}"
+        if result['status'] == 'error':
+            metrics.files.inc(mode=mode, result='failed')
+        tmp_path = f"{self._result_path(index)}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(result, f)
+        os.replace(tmp_path, self._result_path(index))
+        # The input isn't needed once its outputs exist
+        try:
+            os.remove(self._path(index))
+        except OSError:
+            pass
+
+    def finalize(self):
+        """Declare that no more chunks will come"""
+        self.info['finalized'] = True
+        self._save_info()
+
+    def progress(self):
+        """Per-file upload and conversion state"""
+        progress = []
+        for index, declared in enumerate(self.info['files']):
+            result = self._result(index)
+            entry = {'name': declared['name'], 'size': declared['size']}
+            if result:
+                entry['status'] = result['status']
+            elif os.path.exists(self._path(index)):
+                entry['status'] = 'queued'
+            else:
+                entry['status'] = 'incomplete' if self.info['finalized'] else 'uploading'
+                entry['received'] = self.received(index)
+            progress.append(entry)
+        return progress
+
+    def last_activity(self):
+        times = [self.info['created_at']]
+        for name in os.listdir(self.upload_folder):
+            try:
+                times.append(os.path.getmtime(os.path.join(self.upload_folder, name)))
+            except OSError:
+                pass
+        return max(times)
+
+    def is_active(self):
+        """Whether the batch still receives chunks or converts files"""
+        if all(entry['status'] in ('done', 'error', 'incomplete') for entry in self.progress()):
+            return False
+        return time.time() - self.last_activity() < IDLE_TIMEOUT
+
+    def status(self):
+        """Progress while uploading or converting, then the usual upload payload"""
+        progress = self.progress()
+        mode = self.info['mode']
+        finished = all(entry['status'] in ('done', 'error', 'incomplete') for entry in progress)
+        if not (self.info['finalized'] and finished):
+            return {
+                'success': True,
+                'state': 'running' if self.info['finalized'] else 'uploading',
+                'batch_id': self.batch_id,
+                'mode': mode,
+                'total': len(progress),
+                'completed': sum(1 for entry in progress if entry['status'] in ('done', 'error')),
+                'progress': progress
+            }
+
+        converted_files = []
+        errors = list(self.info['errors'])
+        for index, entry in enumerate(progress):
+            if entry['status'] == 'incomplete':
+                errors.append(f"{entry['name']}: upload incomplete")
+                continue
+            result = self._result(index)
+            converted_files.extend(result['entries'])
+            if result.get('error'):
+                errors.append(result['error'])
+        if not converted_files:
+            return {'success': False, 'state': 'done', 'error': 'No files were converted successfully'}
+        return {
+            'success': True,
+            'state': 'done',
+            'batch_id': self.batch_id,
+            'files': converted_files,
+            'errors': errors,
+            'skipped': self.info['skipped'],
+            'is_batch': len(converted_files) > 1,
+            'mode': mode
+        }
@@ -10,6 +10,12 @@ document.addEventListener('DOMContentLoaded', function() {
         if (e.target.name === 'mode') {
             const selectedMode = e.target.value;
             modeInput.value = selectedMode;
+            // Encoder profiles only apply to AVIF output
+            const avifOutput = selectedMode === 'avif' || selectedMode === 'responsive' || selectedMode === 'target';
+            document.getElementById('profilePicker').style.display = avifOutput ? '' : 'none';
+            document.getElementById('widthsPicker').style.display = selectedMode === 'responsive' ? '' : 'none';
+            document.getElementById('targetPicker').style.display = selectedMode === 'target' ? '' : 'none';
+            document.getElementById('heifPicker').style.display = selectedMode === 'png' ? '' : 'none';
             
             if (selectedMode === 'avif') {
                 document.getElementById('pageTitle').textContent = 'AVIF Converter';
@@ -25,6 +31,20 @@ document.addEventListener('DOMContentLoaded', function() {
                 document.getElementById('uploadHint').textContent = 'or click to browse';
                 fileInput.accept = '.heic,.heif';
                 convertBtn.textContent = 'Convert to PNG';
+            } else if (selectedMode === 'responsive') {
+                document.getElementById('pageTitle').textContent = 'Responsive Images';
+                document.getElementById('pageSubtitle').textContent = 'Generate AVIF variants at several widths from one upload';
+                document.getElementById('uploadText').textContent = 'Drag & drop images here';
+                document.getElementById('uploadHint').textContent = 'or click to browse';
+                fileInput.accept = '.png,.jpg,.jpeg';
+                convertBtn.textContent = 'Generate Variants';
+            } else if (selectedMode === 'target') {
+                document.getElementById('pageTitle').textContent = 'Target Quality';
+                document.getElementById('pageSubtitle').textContent = 'Find the AVIF quality that meets a size or SSIM/PSNR target';
+                document.getElementById('uploadText').textContent = 'Drag & drop images here';
+                document.getElementById('uploadHint').textContent = 'or click to browse';
+                fileInput.accept = '.png,.jpg,.jpeg';
+                convertBtn.textContent = 'Encode to Target';
             } else {
                 document.getElementById('pageTitle').textContent = 'Image Compressor';
                 document.getElementById('pageSubtitle').textContent = 'Lossless compression for PNG and JPG files';
@@ -129,7 +149,7 @@ document.addEventListener('DOMContentLoaded', function() {
         e.preventDefault();
         
         const mode = document.querySelector('input[name="mode"]:checked').value;
-        convertBtn.textContent = mode === 'avif' ? 'Converting to AVIF...' : mode === 'png' ? 'Converting to PNG...' : 'Compressing...';
+        convertBtn.textContent = mode === 'avif' ? 'Converting to AVIF...' : mode === 'png' ? 'Converting to PNG...' : mode === 'responsive' ? 'Generating variants...' : mode === 'target' ? 'Searching quality...' : 'Compressing...';
         convertBtn.disabled = true;
         
         // Clear any existing flash messages
@@ -138,34 +158,53 @@ document.addEventListener('DOMContentLoaded', function() {
             flashMessages.style.display = 'none';
         }
         
-        const formData = new FormData();
-        Array.from(fileInput.files).forEach(file => {
-            formData.append('files', file);
-        });
-        formData.append('mode', modeInput.value);
+        const files = Array.from(fileInput.files);
+        const fields = {
+            mode: modeInput.value,
+            profile: document.getElementById('profileInput').value,
+            widths: document.getElementById('widthsInput').value,
+            target: document.getElementById('targetInput').value,
+            images: document.getElementById('imagesInput').value,
+            metadata: document.getElementById('metadataInput').value
+        };
         
         try {
-            const response = await fetch('/upload', {
-                method: 'POST',
-                headers: {
-                    'X-Requested-With': 'XMLHttpRequest'
-                },
-                body: formData
-            });
-            
-            const result = await response.json();
+            let job;
+            if (files.reduce((total, file) => total + file.size, 0) > CHUNKED_UPLOAD_BYTES) {
+                job = await chunkedUpload(files, fields);
+            } else {
+                const formData = new FormData();
+                files.forEach(file => {
+                    formData.append('files', file);
+                });
+                Object.entries(fields).forEach(([name, value]) => formData.append(name, value));
+                
+                const response = await fetch('/upload', {
+                    method: 'POST',
+                    headers: {
+                        'X-Requested-With': 'XMLHttpRequest'
+                    },
+                    body: formData
+                });
+                job = await response.json();
+            }
             
-            if (result.success) {
-                showResults(result);
+            if (job.success) {
+                const result = await pollJob(job.status_url, mode);
+                if (result.success) {
+                    showResults(result);
+                } else {
+                    showError(result.error);
+                }
             } else {
-                showError(result.error);
+                showError(job.error);
             }
         } catch (error) {
             showError('Upload failed: ' + error.message);
         }
         
         const mode2 = document.querySelector('input[name="mode"]:checked').value;
-        convertBtn.textContent = mode2 === 'avif' ? 'Convert to AVIF' : mode2 === 'png' ? 'Convert to PNG' : 'Compress Images';
+        convertBtn.textContent = mode2 === 'avif' ? 'Convert to AVIF' : mode2 === 'png' ? 'Convert to PNG' : mode2 === 'responsive' ? 'Generate Variants' : mode2 === 'target' ? 'Encode to Target' : 'Compress Images';
         convertBtn.disabled = false;
     });
 
@@ -221,13 +260,15 @@ function showResults(results) {
                     <div class="file-card">
                         <img src="/download/${results.batch_id}/${file.filename}" class="result-preview-img" alt="${file.filename}">
                         <div class="file-name">${file.filename}</div>
+                        ${file.quality ? `<div class="file-quality">Quality ${file.quality}${file.ssim ? ` · SSIM ${file.ssim}` : ''}${file.psnr ? ` · PSNR ${file.psnr} dB` : ''}</div>` : ''}
+                        ${file.strategy ? `<div class="file-quality">${file.strategy} · ${file.encode_seconds}s</div>` : ''}
                         <div class="file-sizes">
                             <div class="size-info">
                                 <div class="size-label">Original</div>
                                 <div class="size-value">${formatFileSize2(file.original_size)}</div>
                             </div>
                             <div class="size-info">
-                                <div class="size-label">${results.mode === 'avif' ? 'AVIF' : results.mode === 'png' ? 'PNG' : 'Compressed'}</div>
+                                <div class="size-label">${results.mode === 'avif' || results.mode === 'responsive' || results.mode === 'target' ? 'AVIF' : results.mode === 'png' ? 'PNG' : 'Compressed'}</div>
                                 <div class="size-value">${formatFileSize2(file.converted_size)}</div>
                             </div>
                         </div>
@@ -264,6 +305,104 @@ function showResults(results) {
     startCleanupTimer();
 }
 
+// Poll a queued conversion job until the server reports it finished
+async function pollJob(statusUrl, mode) {
+    const convertBtn = document.getElementById('convertBtn');
+    const label = mode === 'avif' ? 'Converting to AVIF' : mode === 'png' ? 'Converting to PNG' : mode === 'responsive' ? 'Generating variants' : mode === 'target' ? 'Searching quality' : 'Compressing';
+    while (true) {
+        const response = await fetch(statusUrl);
+        const status = await response.json();
+        if (!status.success || status.state === 'done') {
+            return status;
+        }
+        convertBtn.textContent = status.state === 'queued' ?
+            `Waiting in queue (${status.total} file${status.total > 1 ? 's' : ''})...` :
+            `${label}... ${status.completed}/${status.total}`;
+        await new Promise(resolve => setTimeout(resolve, 500));
+    }
+}
+
+// Selections larger than this are sent in resumable chunks instead of one POST
+const CHUNKED_UPLOAD_BYTES = 32 * 1024 * 1024;
+// Files sent at the same time; each starts converting once its last chunk is in
+const CHUNKED_UPLOAD_CONCURRENCY = 2;
+const CHUNK_RETRIES = 5;
+
+// Upload a large selection file by file in chunks. A dropped connection only
+// repeats the chunk in flight, and the server converts every completed file
+// while the rest is still uploading.
+async function chunkedUpload(files, fields) {
+    const convertBtn = document.getElementById('convertBtn');
+    const response = await fetch('/uploads', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ ...fields, files: files.map(file => ({ name: file.name, size: file.size })) })
+    });
+    const batch = await response.json();
+    if (!batch.success) {
+        return batch;
+    }
+    
+    const total = batch.files.reduce((sum, entry) => sum + entry.size, 0);
+    const sent = batch.files.map(() => 0);
+    const pending = batch.files.slice();
+    const uploadNext = async () => {
+        while (pending.length) {
+            const entry = pending.shift();
+            await uploadChunks(batch, entry, files[entry.position], received => {
+                sent[entry.index] = received;
+                const percent = Math.floor(sent.reduce((sum, bytes) => sum + bytes, 0) / total * 100);
+                convertBtn.textContent = `Uploading... ${percent}%`;
+            });
+        }
+    };
+    await Promise.all(Array.from({ length: Math.min(CHUNKED_UPLOAD_CONCURRENCY, pending.length) }, uploadNext));
+    
+    const finalized = await fetch(`${batch.upload_url}/finalize`, { method: 'POST' });
+    return finalized.json();
+}
+
+// Send one file from the offset the server has, resuming after network errors.
+// Files the server refuses are left out and reported as incomplete.
+async function uploadChunks(batch, entry, file, onProgress) {
+    let offset = 0;
+    let failures = 0;
+    while (offset < entry.size) {
+        let result;
+        try {
+            const response = await fetch(`${batch.upload_url}/${entry.index}`, {
+                method: 'PUT',
+                headers: { 'Upload-Offset': String(offset) },
+                body: file.slice(offset, offset + batch.chunk_size)
+            });
+            result = await response.json();
+            if (response.status === 409 && result.received !== null) {
+                // Out of step with the server, continue where its data ends
+                offset = result.received;
+                continue;
+            }
+        } catch (error) {
+            if (++failures > CHUNK_RETRIES) {
+                throw error;
+            }
+            await new Promise(resolve => setTimeout(resolve, 1000 * failures));
+            try {
+                const state = await (await fetch(batch.upload_url)).json();
+                offset = state.files[entry.index].received;
+            } catch (e) {
+                // Still offline, the next attempt asks again
+            }
+            continue;
+        }
+        if (!result.success) {
+            return;
+        }
+        failures = 0;
+        offset = result.received;
+        onProgress(offset);
+    }
+}
+
 function formatFileSize2(bytes) {
     if (bytes === 0) return '0 Bytes';
     const prefix = bytes < 0 ? '-' : '';
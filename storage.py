@@ -0,0 +1,70 @@
+import json
+import os
+import threading
+
+# Folder holding the uploads, converted outputs, job status and task queue of
+# every batch (default: the working directory). Point every front-end and
+# worker at the same shared volume and any of them can serve any batch.
+STORAGE_FOLDER = os.environ.get('STORAGE_FOLDER', '')
+
+def path(name):
+    """Path of a folder inside the storage"""
+    return os.path.join(STORAGE_FOLDER, name)
+
+def relative(file_path):
+    """file_path relative to the storage, for handing to another node"""
+    return os.path.relpath(file_path, STORAGE_FOLDER or os.curdir)
+
+def resolve(relative_path):
+    """Path on this node of a path made by relative(), wherever it mounts the storage"""
+    return os.path.join(STORAGE_FOLDER, relative_path)
+
+class StatusStore:
+    """Status of every batch as a JSON file per batch, written atomically.
+
+    The file's mtime is the batch's last status update, which tells a
+    batch whose converting process died from one still being worked on.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def _path(self, batch_id):
+        return os.path.join(self.folder, f"{batch_id}.json")
+
+    def save(self, batch_id, status):
+        path = self._path(batch_id)
+        # Unique per process and thread, other nodes may write the same batch
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(status, f)
+        os.replace(tmp_path, path)
+
+    def load(self, batch_id):
+        """The saved status of a batch, None if there is none"""
+        try:
+            with open(self._path(batch_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def updated_at(self, batch_id):
+        """Time of the last save() of a batch, None if there is none"""
+        try:
+            return os.path.getmtime(self._path(batch_id))
+        except OSError:
+            return None
+
+    def touch(self, batch_id):
+        """Mark a batch's status as current without rewriting it"""
+        try:
+            os.utime(self._path(batch_id))
+        except OSError:
+            pass
+
+    def remove(self, batch_id):
+        try:
+            os.remove(self._path(batch_id))
+        except OSError:
+            pass
@@ -0,0 +1,41 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# The app creates its folders on import, so keep them out of the checkout
+STORAGE = tempfile.mkdtemp()
+os.environ.setdefault('STORAGE_FOLDER', STORAGE)
+os.environ.setdefault('CACHE_FOLDER', os.path.join(STORAGE, 'cache'))
+os.environ.setdefault('STATE_FOLDER', os.path.join(STORAGE, 'state'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import app as webapp
+
+@pytest.fixture
+def client():
+    return webapp.app.test_client()
+
+@pytest.mark.parametrize('body', [
+    ['photo.png'],
+    'photo.png',
+    {'files': 'photo.png'},
+    {'files': ['photo.png']},
+    {'files': [{'name': 'photo.png', 'size': '100'}]},
+    {'files': [{'name': 'photo.png', 'size': True}]},
+    {'files': [{'name': 'photo.png', 'size': 1.5}]},
+    {'files': [{'name': ['photo.png'], 'size': 100}]},
+    {'files': [{'name': 'photo.png', 'size': 100}], 'widths': [320, 640]},
+    {'files': [{'name': 'photo.png', 'size': 100}], 'mode': ['avif']},
+    {'files': [{'name': 'photo.png', 'size': 100}], 'profile': {'speed': 6}},
+])
+def test_malformed_chunked_upload_is_rejected(client, body):
+    response = client.post('/uploads', json=body)
+    assert response.status_code == 400
+    assert response.get_json()['success'] is False
+    assert response.get_json()['error']
+
+def test_chunked_upload_without_files(client):
+    response = client.post('/uploads', json={'files': []})
+    assert response.status_code == 400
+    assert response.get_json() == {'success': False, 'error': 'No files selected'}
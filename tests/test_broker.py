@@ -0,0 +1,96 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import pytest
+
+# jobs opens its status and cache folders on import, so keep them out of the checkout
+STORAGE = tempfile.mkdtemp()
+os.environ.setdefault('STORAGE_FOLDER', STORAGE)
+os.environ.setdefault('CACHE_FOLDER', os.path.join(STORAGE, 'cache'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import jobs
+from broker import MemoryBroker
+
+LEASE = 0.2
+
+def task(batch_id):
+    return {'batch_id': batch_id, 'mode': 'compress', 'options': {}, 'batch_folder': f"converted/{batch_id}",
+            'upload_folder': f"uploads/{batch_id}", 'uploads': [], 'skipped': [], 'errors': []}
+
+def test_publish_claim_ack():
+    broker = MemoryBroker(lease=LEASE)
+    broker.publish(task('one'))
+    broker.publish(task('two'))
+    assert broker.depth() == 2
+    receipt, claimed, deliveries = broker.claim(timeout=0)
+    assert claimed == task('one')
+    assert deliveries == 1
+    assert broker.depth() == 1
+    broker.ack(receipt)
+    time.sleep(LEASE * 1.5)
+    # Acked, so never delivered again
+    assert broker.claim(timeout=0)[1] == task('two')
+    assert broker.claim(timeout=0) is None
+
+def test_claim_waits_for_a_publish():
+    broker = MemoryBroker(lease=LEASE)
+    threading.Timer(0.05, broker.publish, (task('late'),)).start()
+    assert broker.claim(timeout=1)[1] == task('late')
+
+def test_expired_lease_is_delivered_again():
+    broker = MemoryBroker(lease=LEASE)
+    broker.publish(task('one'))
+    first, _, _ = broker.claim(timeout=0)
+    assert broker.claim(timeout=0) is None
+    second, claimed, deliveries = broker.claim(timeout=LEASE * 3)
+    assert claimed == task('one')
+    assert deliveries == 2
+    assert second != first
+    # The late ack of the dead claim doesn't drop the new one
+    broker.ack(first)
+    assert broker.claim(timeout=LEASE * 3)[2] == 3
+
+def test_heartbeat_keeps_the_claim():
+    broker = MemoryBroker(lease=LEASE)
+    broker.publish(task('one'))
+    receipt, _, _ = broker.claim(timeout=0)
+    for _ in range(4):
+        time.sleep(LEASE / 2)
+        broker.heartbeat(receipt)
+    assert broker.claim(timeout=0) is None
+    broker.ack(receipt)
+    assert broker.depth() == 0
+
+def test_tasks_must_be_json():
+    broker = MemoryBroker(lease=LEASE)
+    with pytest.raises(TypeError):
+        broker.publish({'batch_id': 'one', 'uploads': object()})
+    assert broker.depth() == 0
+
+@pytest.mark.parametrize('crashes', [jobs.TASK_MAX_DELIVERIES - 1, jobs.TASK_MAX_DELIVERIES])
+def test_task_is_given_up_after_max_deliveries(monkeypatch, crashes):
+    converted = []
+    monkeypatch.setattr(jobs, '_convert', lambda job, observe: converted.append(job.batch_id))
+    batch_id = f"crashing-{crashes}"
+    broker = MemoryBroker(lease=LEASE)
+    broker.publish(task(batch_id))
+    # Workers that died mid-conversion, leaving their claims to expire
+    for _ in range(crashes):
+        assert broker.claim(timeout=LEASE * 3) is not None
+    stopping = threading.Event()
+    workers = jobs.serve(broker, 1, stopping)
+    deadline = time.monotonic() + 5
+    while (jobs.status_store.load(batch_id) or {}).get('state') != 'done' and time.monotonic() < deadline:
+        time.sleep(0.05)
+    stopping.set()
+    for worker in workers:
+        worker.join()
+    assert jobs.status_store.load(batch_id)['state'] == 'done'
+    # Converted on the last delivery allowed, failed without converting past it
+    assert converted == ([batch_id] if crashes < jobs.TASK_MAX_DELIVERIES else [])
+    # Acked either way, not delivered yet again
+    time.sleep(LEASE * 1.5)
+    assert broker.depth() == 0
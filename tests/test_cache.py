@@ -0,0 +1,32 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from cache import ConversionCache
+
+def stored(cache, tmp_path, key, data):
+    output_path = tmp_path / f"{key}.avif"
+    output_path.write_bytes(data)
+    cache.store(key, str(output_path))
+    # As if written an hour ago
+    os.utime(cache._path(key), (os.path.getmtime(output_path) - 3600,) * 2)
+    return output_path
+
+def test_fetch_leaves_the_output_mtime_alone(tmp_path):
+    cache = ConversionCache(str(tmp_path / 'cache'), 1024)
+    stored(cache, tmp_path, 'aa01', b'x' * 100)
+    written = os.path.getmtime(cache._path('aa01'))
+    assert cache.fetch('aa01', str(tmp_path / 'batch.avif'))
+    assert os.path.getmtime(tmp_path / 'batch.avif') == written
+    assert os.path.getmtime(cache._path('aa01')) == written
+
+def test_recency_survives_a_reload(tmp_path):
+    cache = ConversionCache(str(tmp_path / 'cache'), 250)
+    stored(cache, tmp_path, 'aa01', b'x' * 100)
+    stored(cache, tmp_path, 'bb02', b'y' * 100)
+    assert cache.fetch('aa01', str(tmp_path / 'batch.avif'))
+    cache = ConversionCache(str(tmp_path / 'cache'), 250)
+    stored(cache, tmp_path, 'cc03', b'z' * 100)
+    # bb02 was used least recently
+    assert not os.path.exists(cache._path('bb02'))
+    assert os.path.exists(cache._path('aa01'))
@@ -0,0 +1,27 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils'))
+import convert
+from PIL import Image
+
+def run(source, out, *args):
+    return convert.main([source, '--out', out, '--workers', '1', *args])
+
+def manifest(out):
+    with open(os.path.join(out, convert.MANIFEST_NAME)) as f:
+        return [json.loads(line) for line in f]
+
+def test_changed_profile_converts_again(tmp_path, capsys):
+    source, out = str(tmp_path / 'in'), str(tmp_path / 'out')
+    os.makedirs(source)
+    Image.linear_gradient('L').convert('RGB').save(os.path.join(source, 'a.png'))
+
+    assert run(source, out, '--profile', 'balanced') == 0
+    assert run(source, out, '--profile', 'balanced') == 0
+    assert '0 converted, 1 up to date' in capsys.readouterr().out
+    # The output is newer than the input, but was encoded with other settings
+    assert run(source, out, '--profile', 'fast') == 0
+    assert '1 converted, 0 up to date' in capsys.readouterr().out
+    assert [record['settings']['speed'] for record in manifest(out)] == [6, 10]
@@ -0,0 +1,23 @@
+import os
+import sys
+
+import pillow_heif
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import engine
+
+def test_heic_preview_is_the_primary_thumbnail_not_a_burst_frame(tmp_path):
+    # A red primary with a 160px thumbnail, and a blue second frame larger than the thumbnail
+    heif_file = pillow_heif.from_pillow(Image.new('RGB', (640, 480), (255, 0, 0)))
+    heif_file.add_from_pillow(Image.new('RGB', (400, 300), (0, 0, 255)))
+    path = str(tmp_path / 'burst.heic')
+    heif_file.save(path, quality=80, thumbnails=[160])
+
+    entries, _ = engine.convert_file(path, 'burst.heic', 'png', str(tmp_path), os.path.getsize(path),
+                                     {'images': 'preview'})
+
+    with Image.open(tmp_path / entries[0]['filename']) as preview:
+        assert preview.size == (160, 120)
+        red, green, blue = preview.convert('RGB').getpixel((80, 60))
+        assert red > 200 and blue < 60
@@ -0,0 +1,30 @@
+import io
+import os
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import quality
+
+@pytest.mark.parametrize('text', ['size:inf', 'size:-inf', 'size:nan', 'size:1e400', 'size:1e300k',
+                                  'psnr:inf', 'psnr:nan', 'ssim:nan', 'size:0', 'ssim:1', 'psnr:x', 'speed:3'])
+def test_invalid_targets_are_rejected(text):
+    assert quality.parse_target(text) is None
+
+def test_valid_targets():
+    assert quality.parse_target('size:200k') == {'metric': 'size', 'value': 200 * 1024}
+    assert quality.parse_target('SSIM:0.95') == {'metric': 'ssim', 'value': 0.95}
+    assert quality.parse_target('psnr:40') == {'metric': 'psnr', 'value': 40.0}
+
+@pytest.mark.parametrize('metric', ['ssim', 'psnr'])
+def test_strips_measure_like_the_whole_image(monkeypatch, metric):
+    pixels = np.random.default_rng(0).integers(0, 256, (101, 77, 3), np.uint8)
+    img = Image.fromarray(pixels)
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', quality=60)
+    whole = quality._measure(metric, pixels, buffer.getvalue())
+    monkeypatch.setattr(quality, 'MEASURE_ROWS', 16)
+    assert quality._measure_strips(metric, img, buffer.getvalue()) == pytest.approx(whole, abs=1e-5)
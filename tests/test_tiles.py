@@ -0,0 +1,101 @@
+import io
+import os
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import plugins
+import tiles
+
+AVIF_OPTIONS = {'format': 'AVIF', 'quality': 90, 'speed': 8}
+
+def sample(mode, width=150, height=100):
+    """Gradients with an alpha ramp over the left half, opaque on the right"""
+    y, x = np.mgrid[:height, :width]
+    rgb = np.dstack([x * 255 // width, y * 255 // height, (x + y) % 256]).astype(np.uint8)
+    alpha = np.where(x < width // 2, x * 255 // width, 255).astype(np.uint8)
+    if mode == 'P':
+        return Image.fromarray(rgb).quantize(16)
+    if mode == 'P;transparency':
+        img = Image.fromarray(rgb).quantize(16)
+        img.info['transparency'] = 3
+        return img
+    img = Image.fromarray(np.dstack([rgb, alpha]), 'RGBA')
+    return img if mode == 'RGBA' else img.convert(mode)
+
+def encode_png(source, **options):
+    buffer = io.BytesIO()
+    tiles.encode_png(source, buffer, 7, 3, **options)
+    buffer.seek(0)
+    decoded = Image.open(buffer)
+    decoded.load()
+    return decoded
+
+def assert_same(decoded, img):
+    assert decoded.size == img.size
+    assert decoded.mode == img.mode
+    assert np.array_equal(np.asarray(decoded), np.asarray(img))
+    if img.mode == 'P':
+        # A packed palette keeps the entries its depth can index
+        assert decoded.getpalette() == img.getpalette()[:len(decoded.getpalette())]
+        assert decoded.info.get('transparency') == img.info.get('transparency')
+
+@pytest.mark.parametrize('mode', ['RGB', 'RGBA', 'L', 'LA', 'P', 'P;transparency'])
+@pytest.mark.parametrize('filter', sorted(tiles.FILTERS))
+def test_png_round_trip(mode, filter):
+    img = sample(mode)
+    assert_same(encode_png(tiles.MemoryStrips(img), filter=filter), img)
+
+@pytest.mark.parametrize('depth', [1, 2, 4])
+def test_png_packed_palette_round_trip(depth):
+    img = sample('RGB').quantize(1 << depth)
+    assert_same(encode_png(tiles.MemoryStrips(img, depth)), img)
+
+@pytest.mark.parametrize('mode', ['RGB', 'RGBA', 'L', 'LA', 'P', 'P;transparency'])
+def test_png_strips_rewrite(tmp_path, mode):
+    img = sample(mode)
+    path = tmp_path / 'input.png'
+    # Pillow would pack the 16 colours into 4 bits, which only the whole-image path reads
+    img.save(path, bits=8)
+    with open(path, 'rb') as f:
+        assert tiles.png_header(f) == img.size + (True,)
+    source = tiles.PngStrips(str(path))
+    try:
+        assert_same(encode_png(source), img)
+    finally:
+        source.close()
+
+def test_png_over_budget_falls_back_losslessly():
+    img = sample('RGB')
+    buffer = io.BytesIO()
+    assert tiles.encode_png(tiles.MemoryStrips(img), buffer, 7, 3, budget=0) == 7
+    assert tiles.encode_png(tiles.MemoryStrips(img), io.BytesIO(), 7, 3, budget=60) is None
+    buffer.seek(0)
+    assert_same(Image.open(buffer), img)
+
+@pytest.mark.parametrize('mode, decoded_mode', [
+    ('RGB', 'RGB'), ('RGBA', 'RGBA'), ('L', 'RGB'), ('P', 'RGB'), ('P;transparency', 'RGBA'),
+    # Like the whole-image path, LA is encoded without its alpha
+    ('LA', 'RGB'),
+])
+def test_avif_grid_round_trip(tmp_path, mode, decoded_mode):
+    plugins.load('avif')
+    img = sample(mode)
+    path = tmp_path / 'output.avif'
+    # 64-pixel tiles: a 2x3 grid whose right and bottom tiles are padded
+    assert tiles.encode_avif(tiles.MemoryStrips(img), str(path), AVIF_OPTIONS, 64, 2) == 6
+    with Image.open(path) as decoded:
+        decoded.load()
+        assert decoded.size == img.size
+        assert decoded.mode == decoded_mode
+        expected = np.asarray(img.convert(decoded_mode), np.int16)
+        pixels = np.asarray(decoded, np.int16)
+    assert np.abs(pixels[..., :3] - expected[..., :3]).mean() < 4
+    if decoded_mode == 'RGBA':
+        assert np.abs(pixels[..., 3] - expected[..., 3]).mean() < 4
+    if mode == 'RGBA':
+        # The tiles right of the alpha ramp are opaque and share the stored opaque plane
+        assert (pixels[:, 128:, 3] == 255).all()
@@ -0,0 +1,346 @@
+import io
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image, ImageOps
+import heif
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# Colour types of 8-bit PNGs whose rows can be decoded in strips: (Pillow mode, bytes per pixel)
+PNG_MODES = {0: ('L', 1), 2: ('RGB', 3), 3: ('P', 1), 4: ('LA', 2), 6: ('RGBA', 4)}
+PNG_COLOR_TYPES = {mode: color_type for color_type, (mode, _) in PNG_MODES.items()}
+# Ancillary chunks kept when a PNG is rewritten strip by strip
+PNG_COPIED_CHUNKS = (b'iCCP', b'sRGB', b'gAMA', b'cHRM', b'pHYs', b'PLTE', b'tRNS')
+# Compressed image data read from the input and written to the output at a time
+PNG_IO_SIZE = 1024 * 1024
+# Rows filtered together when rewriting a PNG; bounds the filter scratch memory
+PNG_FILTER_ROWS = 32
+
+# An ImageGrid has at most 256 rows and columns, and item ids are 16-bit
+# with two items per tile (colour and alpha) plus the two grids
+MAX_GRID_SIDE = 256
+MAX_GRID_ITEMS = 0xffff
+
+def png_header(stream):
+    """Return (width, height, streamable) from a PNG's IHDR, or None if it isn't a PNG.
+
+    streamable is True for the 8-bit non-interlaced images PngStrips decodes.
+    Reads from the current position, which is left after the IHDR chunk.
+    """
+    data = stream.read(33)
+    if len(data) < 33 or data[:8] != PNG_SIGNATURE or data[12:16] != b'IHDR':
+        return None
+    width, height, depth, color_type, _, _, interlace = struct.unpack('>IIBBBBB', data[16:29])
+    return width, height, depth == 8 and color_type in PNG_MODES and not interlace
+
+class PngStrips:
+    """Decode a PNG file a strip of rows at a time.
+
+    The compressed data is inflated only as far as the strip needs, and the
+    rows are unfiltered by Pillow's PNG decoder, so memory stays at a few
+    strips whatever the image size. Only the PNGs png_header() reports as
+    streamable are supported.
+    """
+
+    def __init__(self, path):
+        self._f = open(path, 'rb')
+        self._f.seek(len(PNG_SIGNATURE))
+        # Chunks before the image data, as (type, data) in file order
+        self.chunks = []
+        while True:
+            length, kind = struct.unpack('>I4s', self._f.read(8))
+            if kind == b'IDAT':
+                break
+            self.chunks.append((kind, self._f.read(length)))
+            self._f.read(4)  # CRC
+        self.width, self.height, _, color_type = struct.unpack('>IIBB', self.chunks[0][1][:10])
+        self.mode, self.bpp = PNG_MODES[color_type]
+        self.depth = 8
+        chunks = dict(self.chunks)
+        self.info = {}
+        if b'iCCP' in chunks:
+            # Profile name, a zero byte, the compression method, then the zlib stream
+            self.info['icc_profile'] = zlib.decompress(chunks[b'iCCP'].partition(b'\0')[2][1:])
+        if self.mode == 'P':
+            self._palette = chunks[b'PLTE']
+            if b'tRNS' in chunks:
+                self.info['transparency'] = chunks[b'tRNS']
+        self._idat_left = length
+        self._pending = b''
+        self._inflate = zlib.decompressobj()
+        self._previous = bytes(self.width * self.bpp)
+
+    def close(self):
+        self._f.close()
+
+    def _read_idat(self):
+        """Next piece of compressed image data, b'' after the last IDAT chunk"""
+        while not self._idat_left:
+            if self._idat_left is None:
+                return b''
+            self._f.read(4)  # CRC
+            length, kind = struct.unpack('>I4s', self._f.read(8))
+            self._idat_left = length if kind == b'IDAT' else None
+        data = self._f.read(min(self._idat_left, PNG_IO_SIZE))
+        if not data:
+            raise ValueError('truncated PNG image data')
+        self._idat_left -= len(data)
+        return data
+
+    def _inflate_rows(self, rows):
+        size = rows * (self.width * self.bpp + 1)
+        parts = []
+        while size:
+            if not self._pending:
+                self._pending = self._read_idat()
+                if not self._pending:
+                    raise ValueError('truncated PNG image data')
+            part = self._inflate.decompress(self._pending, size)
+            self._pending = self._inflate.unconsumed_tail
+            parts.append(part)
+            size -= len(part)
+        return b''.join(parts)
+
+    def strips(self, rows):
+        """Yield (top, image) for consecutive strips of at most rows rows"""
+        for top in range(0, self.height, rows):
+            count = min(rows, self.height - top)
+            # Prepend the last row of the previous strip, unfiltered, for the
+            # filters that refer to the row above; its filter type 0 keeps it as is
+            data = zlib.compress(b'\0' + self._previous + self._inflate_rows(count), 0)
+            strip = Image.frombytes(self.mode, (self.width, count + 1), data, 'zip', self.mode)
+            strip = strip.crop((0, 1, self.width, count + 1))
+            if self.mode == 'P':
+                strip.putpalette(self._palette)
+            strip.info.update(self.info)
+            self._previous = strip.crop((0, count - 1, self.width, count)).tobytes()
+            yield top, strip
+
+class ImageStrips:
+    """Strips cropped from an image decoded in full, for inputs PngStrips can't read"""
+
+    def __init__(self, path):
+        with Image.open(path) as img:
+            # Tiles can't carry the EXIF orientation of the whole image, so apply it
+            self._img = ImageOps.exif_transpose(img)
+        self.width, self.height = self._img.size
+        self.mode = self._img.mode
+        self.info = self._img.info
+
+    def close(self):
+        self._img.close()
+
+    def strips(self, rows):
+        for top in range(0, self.height, rows):
+            yield top, self._img.crop((0, top, self.width, min(self.height, top + rows)))
+
+class MemoryStrips:
+    """Strips of an image in memory in one of the PNG_MODES, for encode_png().
+
+    depth below 8 packs the palette indices of a P image into 1, 2 or 4 bits.
+    """
+
+    def __init__(self, img, depth=8):
+        self._img = img
+        self.width, self.height = img.size
+        self.mode = img.mode
+        self.bpp = next(bpp for mode, bpp in PNG_MODES.values() if mode == img.mode)
+        self.depth = depth
+        self.info = img.info
+        self.chunks = []
+        if img.info.get('icc_profile'):
+            self.chunks.append((b'iCCP', b'ICC Profile\0\0' + zlib.compress(img.info['icc_profile'])))
+        if img.mode == 'P':
+            palette = img.getpalette()[:3 * (1 << depth)]
+            self.chunks.append((b'PLTE', bytes(palette)))
+            transparency = img.info.get('transparency')
+            if isinstance(transparency, int):
+                transparency = b'\xff' * transparency + b'\0'
+            if transparency:
+                self.chunks.append((b'tRNS', bytes(transparency)[:len(palette) // 3]))
+
+    def strips(self, rows):
+        for top in range(0, self.height, rows):
+            yield top, self._img.crop((0, top, self.width, min(self.height, top + rows)))
+
+def grid_tile_size(width, height, tile):
+    """Tile side from tile up, a multiple of 64, that fits the image in one AVIF grid"""
+    tile = max(64, -(-tile // 64) * 64)
+    while True:
+        rows, columns = -(-height // tile), -(-width // tile)
+        if max(rows, columns) <= MAX_GRID_SIDE and 2 * rows * columns + 2 <= MAX_GRID_ITEMS:
+            return tile
+        tile *= 2
+
+def _encode_tile(strip, left, tile, save_options):
+    img = strip.crop((left, 0, min(strip.width, left + tile), strip.height))
+    if img.size != (tile, tile):
+        # Grid tiles all have the same size; pad the edge ones by repeating their last pixels
+        pixels = np.asarray(img)
+        padding = ((0, tile - img.height), (0, tile - img.width)) + ((0, 0),) * (pixels.ndim - 2)
+        img = Image.fromarray(np.pad(pixels, padding, mode='edge'), img.mode)
+    buffer = io.BytesIO()
+    img.save(buffer, **save_options)
+    return buffer.getvalue()
+
+def _opaque_alpha(tile, save_options):
+    """Alpha plane of an opaque tile: libavif leaves it out, but a grid needs one for every tile"""
+    buffer = io.BytesIO()
+    # Monochrome and lossless, so every pixel decodes to exactly 255
+    options = dict(save_options, quality=100, subsampling='4:0:0')
+    options.pop('icc_profile', None)
+    Image.new('RGB', (tile, tile), (255, 255, 255)).save(buffer, **options)
+    return buffer.getvalue()
+
+def encode_avif(source, output_path, save_options, tile, threads):
+    """Encode strips into an AVIF grid of tile x tile images; returns the tile count.
+
+    The tiles of a strip are encoded in parallel while the next strip is
+    decoded, and written out in order as they finish.
+    """
+    tile = grid_tile_size(source.width, source.height, tile)
+    rows, columns = -(-source.height // tile), -(-source.width // tile)
+    if source.info.get('icc_profile'):
+        save_options = dict(save_options, icc_profile=source.info['icc_profile'])
+    with open(output_path, 'wb') as f, ThreadPoolExecutor(threads) as executor:
+        grid = heif.AvifGridWriter(f, source.width, source.height, rows, columns)
+        pending = []
+        for _, strip in source.strips(tile):
+            if strip.mode in ('LA', 'P'):
+                strip = strip.convert('RGBA' if 'transparency' in strip.info else 'RGB')
+            submitted = [executor.submit(_encode_tile, strip, left, tile, save_options)
+                         for left in range(0, source.width, tile)]
+            for future in pending:
+                grid.add(future.result())
+            pending = submitted
+        for future in pending:
+            grid.add(future.result())
+        grid.close(_opaque_alpha(tile, save_options) if grid.missing_alpha else None)
+    return rows * columns
+
+# Row filters of encode_png(): a PNG filter type for every row, or 'adaptive' to pick one per row
+FILTERS = {'none': 0, 'sub': 1, 'up': 2, 'average': 3, 'paeth': 4, 'adaptive': None}
+# What encode_png() falls back to once over its budget, several times faster
+# than level 9 for a few percent more bytes; palettes stay unfiltered
+PNG_FALLBACK_LEVEL = 1
+PNG_FALLBACK_FILTER = 'up'
+
+def _filter_rows(raw, previous, bpp, filter):
+    """PNG-filter rows (a 2D uint8 array), previous being the unfiltered row above the first.
+
+    Like libpng, the adaptive filter gives each row the filter whose output
+    has the smallest sum of absolute signed bytes.
+    """
+    filtered = np.empty((raw.shape[0], raw.shape[1] + 1), np.uint8)
+    if filter == 'none':
+        filtered[:, 0] = 0
+        filtered[:, 1:] = raw
+        return filtered
+    up = np.vstack([previous[np.newaxis], raw[:-1]])
+    left = np.zeros_like(raw)
+    left[:, bpp:] = raw[:, :-bpp]
+    up_left = np.zeros_like(up)
+    up_left[:, bpp:] = up[:, :-bpp]
+    a, b, c = left.astype(np.int16), up.astype(np.int16), up_left.astype(np.int16)
+    pa, pb, pc = np.abs(b - c), np.abs(a - c), np.abs(a + b - 2 * c)
+    paeth = np.where((pa <= pb) & (pa <= pc), left, np.where(pb <= pc, up, up_left))
+    candidates = np.stack([raw, raw - left, raw - up, raw - ((a + b) >> 1).astype(np.uint8), raw - paeth])
+    if FILTERS[filter] is not None:
+        choice = np.full(raw.shape[0], FILTERS[filter])
+    else:
+        scores = np.abs(candidates.view(np.int8).astype(np.int16)).sum(axis=2, dtype=np.int64)
+        choice = scores.argmin(axis=0)
+    filtered[:, 0] = choice
+    filtered[:, 1:] = candidates[choice, np.arange(raw.shape[0])]
+    return filtered
+
+def _pack(indices, depth):
+    """Pack rows of palette indices into depth bits each, leftmost pixel in the high bits"""
+    per_byte = 8 // depth
+    height, width = indices.shape
+    padded = np.zeros((height, -(-width // per_byte) * per_byte), np.uint8)
+    padded[:, :width] = indices
+    shifts = np.arange(8 - depth, -1, -depth, dtype=np.uint8)
+    return (padded.reshape(height, -1, per_byte) << shifts).sum(axis=2, dtype=np.uint8)
+
+def _deflate(data, dictionary, level, strategy):
+    # Raw deflate primed with the 32 KiB before the part and ended on a byte
+    # boundary, so independently compressed parts concatenate into one stream
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, 9, strategy, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, 9, strategy)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+def _chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+def encode_png(source, f, rows, threads, level=9, strategy=zlib.Z_DEFAULT_STRATEGY, filter=None, budget=None):
+    """Write strips as a PNG to the file object f, deflating each strip on threads parts in parallel.
+
+    filter is one of FILTERS, by default 'adaptive' except for palette images,
+    which are better left unfiltered. Once the encode is projected to take
+    longer than budget seconds, the remaining rows get PNG_FALLBACK_FILTER
+    and zlib level PNG_FALLBACK_LEVEL. Returns the row they start at, or
+    None when the whole image got the settings asked for.
+    """
+    filter = filter or ('none' if source.mode == 'P' else 'adaptive')
+    started = time.perf_counter()
+    fallback_row = None
+    # Sub-byte pixels are filtered bytewise
+    bpp = source.bpp if source.depth == 8 else 1
+    f.write(PNG_SIGNATURE)
+    f.write(_chunk(b'IHDR', struct.pack('>IIBBBBB', source.width, source.height, source.depth,
+                                        PNG_COLOR_TYPES[source.mode], 0, 0, 0)))
+    for kind, data in source.chunks:
+        if kind in PNG_COPIED_CHUNKS:
+            f.write(_chunk(kind, data))
+
+    idat = bytearray()
+
+    def write(data, last=False):
+        # Parts are gathered into IDAT chunks of PNG_IO_SIZE, each chunk costs 12 bytes
+        idat.extend(data)
+        while len(idat) >= PNG_IO_SIZE or last and idat:
+            f.write(_chunk(b'IDAT', bytes(idat[:PNG_IO_SIZE])))
+            del idat[:PNG_IO_SIZE]
+
+    with ThreadPoolExecutor(threads) as executor:
+        # zlib header for the level, then the parts, an empty final block and the checksum
+        write(zlib.compress(b'', level)[:2])
+        checksum = zlib.adler32(b'')
+        window = b''
+        previous = np.zeros(-(-source.width * source.bpp * source.depth // 8), np.uint8)
+        pending = []
+        for top, strip in source.strips(rows):
+            overrun = budget is not None and top and (time.perf_counter() - started) * source.height / top > budget
+            if overrun and fallback_row is None:
+                fallback_row = top
+                level, strategy = PNG_FALLBACK_LEVEL, zlib.Z_DEFAULT_STRATEGY
+                filter = 'none' if source.mode == 'P' else PNG_FALLBACK_FILTER
+            raw = np.asarray(strip).reshape(strip.height, -1)
+            if source.depth < 8:
+                raw = _pack(raw, source.depth)
+            filtered = b''.join(
+                _filter_rows(raw[start:start + PNG_FILTER_ROWS], raw[start - 1] if start else previous,
+                             bpp, filter).tobytes()
+                for start in range(0, strip.height, PNG_FILTER_ROWS))
+            previous = raw[-1].copy()
+            checksum = zlib.adler32(filtered, checksum)
+            part_size = -(-len(filtered) // threads)
+            submitted = []
+            for start in range(0, len(filtered), part_size):
+                dictionary = (window + filtered[max(0, start - 32768):start])[-32768:]
+                submitted.append(executor.submit(_deflate, filtered[start:start + part_size], dictionary,
+                                                 level, strategy))
+            window = filtered[-32768:]
+            for future in pending:
+                write(future.result())
+            pending = submitted
+        for future in pending:
+            write(future.result())
+    write(zlib.compressobj(level, zlib.DEFLATED, -15).flush() + struct.pack('>I', checksum), last=True)
+    f.write(_chunk(b'IEND', b''))
+    return fallback_row
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""Reproducible benchmark of the conversion engine.
+
+Generates a deterministic synthetic corpus of PNG, JPEG and HEIC images in
+several sizes (cached between runs), then measures every mode and size with
+engine.convert_file: per-file latency percentiles, per-stage time, throughput
+over a worker pool and peak RSS. Each mode/size cell runs in a fresh Python
+process so peak RSS belongs to that cell alone.
+
+    python utils/bench.py --sizes small,medium --json baseline.json
+
+Keep the JSON of a release and compare it after upgrading Pillow or
+pillow-avif to catch regressions.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import engine
+import plugins
+import quality
+
+SIZES = {
+    'small': (640, 480),
+    'medium': (1920, 1080),
+    'large': (4000, 3000),
+}
+# Corpus formats each mode reads
+MODE_FORMATS = {
+    'avif': ['png', 'jpg'],
+    'png': ['heic'],
+    'compress': ['png', 'jpg'],
+    'responsive': ['png', 'jpg'],
+    'target': ['png', 'jpg'],
+}
+# Bump when the generator changes so cached corpora are rebuilt
+CORPUS_VERSION = 2
+DEFAULT_CORPUS = os.path.join(tempfile.gettempdir(), 'imgtoavif-bench')
+
+def synthetic_image(size, seed):
+    """Photo-like test image: smooth gradients, fractal detail, hard edges and noise"""
+    from PIL import Image, ImageChops, ImageDraw
+    width, height = size
+    rng = random.Random(seed)
+    red = Image.linear_gradient('L').resize(size)
+    green = Image.radial_gradient('L').resize(size)
+    blue = Image.effect_mandelbrot(size, (-2.0 + rng.random() * 0.5, -1.2, 0.6, 1.2), 64)
+    img = Image.merge('RGB', (red, green, blue))
+    draw = ImageDraw.Draw(img)
+    for _ in range(40):
+        x, y = rng.randrange(width), rng.randrange(height)
+        radius = rng.randrange(max(2, width // 40), max(3, width // 6))
+        color = tuple(rng.randrange(256) for _ in range(3))
+        if rng.random() < 0.5:
+            draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill=color)
+        else:
+            draw.rectangle((x - radius, y - radius // 2, x + radius, y + radius // 2), outline=color,
+                           width=max(1, radius // 8))
+    noise = Image.effect_noise(size, 12).convert('RGB')
+    return ImageChops.add(img, noise, scale=1.0, offset=-32)
+
+def build_corpus(folder, sizes, formats, files):
+    """Create the missing corpus files and return {(size, format): [paths]}"""
+    corpus = {}
+    for size_name in sizes:
+        size_folder = os.path.join(folder, f"v{CORPUS_VERSION}", size_name)
+        os.makedirs(size_folder, exist_ok=True)
+        for format in formats:
+            paths = []
+            for number in range(files):
+                path = os.path.join(size_folder, f"{size_name}-{number}.{format}")
+                if not os.path.exists(path):
+                    img = synthetic_image(SIZES[size_name], seed=f"{size_name}-{number}")
+                    if format == 'png':
+                        img.save(path, format='PNG')
+                    elif format == 'jpg':
+                        img.save(path, format='JPEG', quality=90)
+                    else:
+                        # With an embedded thumbnail like camera files, for the png mode's previews
+                        plugins.load('heif')
+                        img.save(path, format='HEIF', quality=90, thumbnails=[320])
+                paths.append(path)
+            corpus[(size_name, format)] = paths
+    return corpus
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a non-empty list"""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+def peak_rss_mb(who):
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    rss = resource.getrusage(who).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+def run_cell(cell):
+    """Measure one mode/size cell; runs inside its own process"""
+    mode, paths, options = cell['mode'], cell['paths'], cell['options']
+    with tempfile.TemporaryDirectory() as out:
+        def convert(path):
+            return engine.convert_file(path, os.path.basename(path), mode, out,
+                                       os.path.getsize(path), options)
+
+        # Warm up codec initialisation and the page cache before timing
+        convert(paths[0])
+        latencies = []
+        stages = dict.fromkeys(engine.STAGES, 0.0)
+        bytes_in = bytes_out = 0
+        for _ in range(cell['iterations']):
+            for path in paths:
+                started = time.perf_counter()
+                _, stats = convert(path)
+                latencies.append(time.perf_counter() - started)
+                for stage in engine.STAGES:
+                    stages[stage] += stats[stage]
+                bytes_in += stats['bytes_in']
+                bytes_out += stats['bytes_out']
+        serial_rss = peak_rss_mb(resource.RUSAGE_SELF)
+
+        jobs = paths * cell['iterations']
+        with ProcessPoolExecutor(max_workers=cell['workers']) as pool:
+            # Start the workers before the clock does
+            list(pool.map(abs, range(cell['workers'])))
+            started = time.perf_counter()
+            list(pool.map(convert_in_worker, [(path, mode, out, options) for path in jobs]))
+            elapsed = time.perf_counter() - started
+        input_bytes = sum(os.path.getsize(path) for path in jobs)
+
+    return {
+        'mode': mode,
+        'size': cell['size'],
+        'files': len(latencies),
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'mean_ms': sum(latencies) / len(latencies) * 1000,
+        'stage_ms': {stage: seconds / len(latencies) * 1000 for stage, seconds in stages.items()},
+        'ratio': bytes_out / bytes_in if bytes_in else 0,
+        'workers': cell['workers'],
+        'files_per_second': len(jobs) / elapsed,
+        'mb_per_second': input_bytes / (1024 * 1024) / elapsed,
+        'peak_rss_mb': serial_rss,
+        'peak_worker_rss_mb': peak_rss_mb(resource.RUSAGE_CHILDREN),
+    }
+
+def convert_in_worker(job):
+    path, mode, out, options = job
+    return engine.convert_file(path, os.path.basename(path), mode, out, os.path.getsize(path),
+                               options)[1]
+
+def environment():
+    from PIL import __version__ as pillow_version
+    import pillow_avif
+    import pillow_heif
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'pillow': pillow_version,
+        'pillow_avif': pillow_avif.__version__,
+        'pillow_heif': pillow_heif.__version__,
+        'libheif': pillow_heif.libheif_version(),
+    }
+
+def print_table(results):
+    print(f"{'mode':<11}{'size':<8}{'files':>6}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+          f"{'files/s':>9}{'MB/s':>7}{'ratio':>7}{'RSS MB':>8}{'wRSS MB':>9}")
+    for result in results:
+        print(f"{result['mode']:<11}{result['size']:<8}{result['files']:>6}"
+              f"{result['p50_ms']:>9.1f}{result['p95_ms']:>9.1f}{result['p99_ms']:>9.1f}"
+              f"{result['files_per_second']:>9.2f}{result['mb_per_second']:>7.2f}"
+              f"{result['ratio']:>7.2f}{result['peak_rss_mb']:>8.0f}{result['peak_worker_rss_mb']:>9.0f}")
+
+def split_list(text, choices):
+    items = [item.strip() for item in text.split(',') if item.strip()]
+    unknown = [item for item in items if item not in choices]
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unknown: {', '.join(unknown)}")
+    return items
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the ImgToAvif conversion engine')
+    parser.add_argument('--modes', default=','.join(MODE_FORMATS),
+                        type=lambda text: split_list(text, MODE_FORMATS))
+    parser.add_argument('--sizes', default='small,medium',
+                        type=lambda text: split_list(text, SIZES), help=f"any of {', '.join(SIZES)}")
+    parser.add_argument('--files', type=int, default=3, help='corpus files per size and format')
+    parser.add_argument('--iterations', type=int, default=3, help='passes over the corpus per cell')
+    parser.add_argument('--workers', type=int, default=engine.CONVERT_WORKERS)
+    parser.add_argument('--profile', choices=sorted(engine.AVIF_PROFILES), default=engine.DEFAULT_PROFILE)
+    parser.add_argument('--widths', default=engine.RESPONSIVE_WIDTHS)
+    parser.add_argument('--target', default=engine.QUALITY_TARGET)
+    parser.add_argument('--images', choices=engine.HEIF_IMAGES, default=engine.DEFAULT_HEIF_IMAGES)
+    parser.add_argument('--corpus', default=DEFAULT_CORPUS, help=f"corpus cache folder (default: {DEFAULT_CORPUS})")
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--cell', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.cell:
+        print(json.dumps(run_cell(json.loads(args.cell))))
+        return 0
+
+    formats = sorted({format for mode in args.modes for format in MODE_FORMATS[mode]})
+    print(f"Preparing corpus in {args.corpus}...")
+    corpus = build_corpus(args.corpus, args.sizes, formats, args.files)
+    options = {'profile': args.profile, 'widths': engine.parse_widths(args.widths),
+               'target': quality.parse_target(args.target), 'images': args.images}
+
+    results = []
+    for mode in args.modes:
+        for size_name in args.sizes:
+            paths = [path for format in MODE_FORMATS[mode] for path in corpus[(size_name, format)]]
+            cell = {'mode': mode, 'size': size_name, 'paths': paths, 'options': options,
+                    'iterations': args.iterations, 'workers': args.workers}
+            print(f"Running {mode}/{size_name}...", flush=True)
+            completed = subprocess.run([sys.executable, os.path.abspath(__file__), '--cell', json.dumps(cell)],
+                                       capture_output=True, text=True)
+            if completed.returncode != 0:
+                print(completed.stderr, file=sys.stderr)
+                return 1
+            results.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+
+    print_table(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'environment': environment(),
+                       'options': {'profile': args.profile, 'widths': args.widths, 'target': args.target,
+                                   'images': args.images},
+                       'iterations': args.iterations, 'results': results}, f, indent=2)
+        print(f"Wrote {args.json}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,15 +1,213 @@
-from PIL import Image
+#!/usr/bin/env python3
+"""Headless batch converter for large trees of images.
+
+Walks the given files and directories recursively and converts every image
+the mode accepts with the same engine the web app uses, spread over a pool
+of worker processes. Outputs that are already up to date are skipped, and a
+JSON-lines manifest records every finished file so an interrupted run can be
+restarted and pick up where it stopped.
+
+    python utils/convert.py photos/ --mode avif --profile fast --out converted/
+"""
+import argparse
+import hashlib
+import json
 import os
-import pillow_avif  # Ensure AVIF plugin is registered
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import engine
+import quality
+from ingest import probe, IngestError
+
+MANIFEST_NAME = '.convert-manifest.jsonl'
+
+def walk(sources, mode, skip_dir=None):
+    """Yield input files under sources that the mode accepts, in sorted order"""
+    extensions = engine.MODE_EXTENSIONS[mode]
+    for source in sources:
+        if os.path.isfile(source):
+            yield source
+            continue
+        for root, dirs, files in os.walk(source):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.')
+                             and os.path.abspath(os.path.join(root, d)) != skip_dir)
+            for filename in sorted(files):
+                if '.' in filename and filename.rsplit('.', 1)[1].lower() in extensions:
+                    yield os.path.join(root, filename)
+
+def output_folder(input_path, sources, out):
+    """Mirror the input's place below its source root inside out"""
+    if not out:
+        return os.path.dirname(input_path) or '.'
+    for source in sources:
+        root = source if os.path.isdir(source) else os.path.dirname(source)
+        relative = os.path.relpath(os.path.dirname(input_path), root)
+        if not relative.startswith('..'):
+            return os.path.normpath(os.path.join(out, relative))
+    return out
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def load_manifest(path):
+    """Return the last successful manifest record of every input"""
+    records = {}
+    if not os.path.exists(path):
+        return records
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Torn last line from a crash
+                continue
+            if record.get('status') == 'done':
+                records[record['input']] = record
+    return records
+
+def up_to_date(input_path, stat, outputs, record, settings, skip):
+    """Decide whether an input can be skipped"""
+    if skip == 'none' or not all(os.path.exists(path) for path in outputs):
+        return False
+    if record:
+        if record['settings'] != settings or record['outputs'] != outputs:
+            # Converted with other options; the outputs being newer doesn't make them current
+            return False
+        if record['mtime'] == stat.st_mtime and record['size'] == stat.st_size:
+            return True
+        if skip == 'hash' and record.get('sha256') == file_hash(input_path):
+            return True
+    if skip == 'mtime':
+        return all(os.path.getmtime(path) >= stat.st_mtime for path in outputs)
+    return False
+
+def format_rate(count, seconds):
+    return f"{count / seconds:.1f}" if seconds > 0 else '-'
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert image trees with the ImgToAvif engine')
+    parser.add_argument('sources', nargs='*', default=['.'], help='files or directories (default: .)')
+    parser.add_argument('--mode', choices=sorted(engine.MODE_EXTENSIONS), default='avif')
+    parser.add_argument('--profile', choices=sorted(engine.AVIF_PROFILES), default=engine.DEFAULT_PROFILE,
+                        help='AVIF encoder profile for the avif, responsive and target modes')
+    parser.add_argument('--widths', default=engine.RESPONSIVE_WIDTHS,
+                        help='variant widths of the responsive mode, e.g. 320,640,full')
+    parser.add_argument('--target', default=engine.QUALITY_TARGET,
+                        help='goal of the target mode: ssim:0.95, psnr:40 or size:200k')
+    parser.add_argument('--images', choices=engine.HEIF_IMAGES, default=engine.DEFAULT_HEIF_IMAGES,
+                        help='HEIF images the png mode exports: the primary one, all or a thumbnail preview')
+    parser.add_argument('--metadata', choices=['keep', 'drop'], default=engine.DEFAULT_HEIF_METADATA,
+                        help='whether the png mode keeps EXIF and exports depth maps')
+    parser.add_argument('--out', help='output root mirroring the source tree (default: next to each input)')
+    parser.add_argument('--workers', type=int, default=engine.CONVERT_WORKERS)
+    parser.add_argument('--skip', choices=['mtime', 'hash', 'none'], default='mtime',
+                        help='how to detect outputs that are already up to date (default: mtime)')
+    parser.add_argument('--manifest', help=f"progress log for resuming (default: <out>/{MANIFEST_NAME})")
+    args = parser.parse_args(argv)
+
+    options = {'profile': args.profile, 'widths': engine.parse_widths(args.widths),
+               'target': quality.parse_target(args.target), 'images': args.images, 'metadata': args.metadata}
+    if args.mode == 'target' and not options['target']:
+        parser.error(f"invalid --target {args.target}")
+    sources = [os.path.normpath(source) for source in args.sources]
+    out = os.path.abspath(args.out) if args.out else None
+    manifest_path = args.manifest or os.path.join(out or '.', MANIFEST_NAME)
+    records = load_manifest(manifest_path)
+    if out:
+        os.makedirs(out, exist_ok=True)
+
+    stats = {'converted': 0, 'skipped': 0, 'failed': 0, 'bytes_in': 0, 'bytes_out': 0}
+    started = time.time()
+    window = max(1, args.workers) * 4
+    pending = {}
+    stage_seconds = dict.fromkeys(engine.STAGES, 0.0)
+
+    def finish(future):
+        input_path, record = pending.pop(future)
+        try:
+            entries, file_stats = future.result()
+        except Exception as e:
+            stats['failed'] += 1
+            record.update(status='error', error=str(e))
+            print(f"FAILED {input_path}: {e}")
+        else:
+            stats['converted'] += 1
+            stats['bytes_in'] += record['size']
+            stats['bytes_out'] += sum(entry['converted_size'] for entry in entries)
+            for stage in engine.STAGES:
+                stage_seconds[stage] += file_stats[stage]
+            record['status'] = 'done'
+        manifest.write(json.dumps(record) + '\n')
+        manifest.flush()
 
-print("Starting PNG to AVIF batch conversion...")
+    print(f"Converting {', '.join(sources)} ({args.mode}) with {args.workers} workers...")
+    with open(manifest_path, 'a') as manifest, ProcessPoolExecutor(max_workers=args.workers) as pool:
+        try:
+            for input_path in walk(sources, args.mode, skip_dir=out):
+                filename = os.path.basename(input_path)
+                folder = output_folder(input_path, sources, out)
+                stat = os.stat(input_path)
+                width, images, depth_maps = 0, 1, 0
+                if args.mode in ('responsive', 'png'):
+                    # Which outputs exist depends on the source width or the images in the container
+                    try:
+                        with open(input_path, 'rb') as f:
+                            header = probe(f)
+                        width, images, depth_maps = header['width'], header['images'], header['depth_maps']
+                    except IngestError as e:
+                        stats['failed'] += 1
+                        print(f"FAILED {input_path}: {e}")
+                        continue
+                plan = engine.output_plan(filename, args.mode, options, width, images, depth_maps)
+                outputs = [os.path.join(folder, output_filename) for output_filename, _ in plan]
+                if os.path.abspath(input_path) in map(os.path.abspath, outputs):
+                    stats['failed'] += 1
+                    print(f"FAILED {input_path}: output would overwrite the input, use --out")
+                    continue
+                settings = engine.cache_settings(filename, args.mode, options)
+                if up_to_date(input_path, stat, outputs, records.get(input_path), settings, args.skip):
+                    stats['skipped'] += 1
+                    continue
 
-for filename in os.listdir("."):
-    if filename.lower().endswith(".png"):
-        avif_name = filename.rsplit(".", 1)[0] + ".avif"
-        print(f"Converting {filename} → {avif_name}")
+                record = {'input': input_path, 'mtime': stat.st_mtime, 'size': stat.st_size,
+                          'settings': settings, 'outputs': outputs}
+                if args.skip == 'hash':
+                    record['sha256'] = file_hash(input_path)
+                os.makedirs(folder, exist_ok=True)
+                future = pool.submit(engine.convert_file, input_path, filename, args.mode, folder,
+                                     stat.st_size, options)
+                pending[future] = (input_path, record)
+                # Keep a bounded number of files in flight so huge trees don't queue up in memory
+                while len(pending) >= window:
+                    done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+                    for future in done:
+                        finish(future)
+            while pending:
+                done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+                for future in done:
+                    finish(future)
+        except KeyboardInterrupt:
+            print('Interrupted, finished files are recorded in the manifest')
+            pool.shutdown(wait=False, cancel_futures=True)
+            return 130
 
-        with Image.open(filename) as img:
-            img.save(avif_name, "AVIF")
+    elapsed = time.time() - started
+    saved = stats['bytes_in'] - stats['bytes_out']
+    print(f"Done in {elapsed:.1f}s: {stats['converted']} converted, {stats['skipped']} up to date, "
+          f"{stats['failed']} failed")
+    print(f"Throughput: {format_rate(stats['converted'], elapsed)} files/s, "
+          f"{format_rate(stats['bytes_in'] / (1024 * 1024), elapsed)} MB/s")
+    print(f"Bytes in: {stats['bytes_in']}, bytes out: {stats['bytes_out']}, saved: {saved} "
+          f"({(saved / stats['bytes_in'] * 100) if stats['bytes_in'] else 0:.1f}%)")
+    print('Worker time: ' + ', '.join(f"{stage} {seconds:.1f}s" for stage, seconds in stage_seconds.items()))
+    return 1 if stats['failed'] else 0
 
-print("Done!")
+if __name__ == '__main__':
+    sys.exit(main())
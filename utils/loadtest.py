@@ -0,0 +1,496 @@
+#!/usr/bin/env python3
+"""End-to-end load test of the web app over HTTP.
+
+Starts the app locally (gunicorn, or Flask's threaded server) in a scratch
+working directory, then runs sessions that each upload a synthetic batch of
+images and fetch the results the way a browser does:
+
+    ajax  POST /upload as XMLHttpRequest, poll /status/<batch_id> until done
+    form  POST /upload as a plain form, which answers once converted
+
+after which every output is fetched from /download/<batch_id>/<filename>
+and the ZIP from /download_batch/<batch_id>. Sessions run closed-loop with
+--concurrency clients, or open-loop with Poisson arrivals at --rate sessions
+per second. Reports throughput, latency percentiles and error rates per
+request kind, peak RSS of the server's process tree and peak disk usage of
+converted/. Works offline; the corpus is the one utils/bench.py builds.
+
+    python utils/loadtest.py --concurrency 4 --duration 60 --json load.json
+
+The JSON records the git commit, so runs of two commits can be compared.
+"""
+import argparse
+import http.client
+import importlib.util
+import json
+import os
+import random
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import bench
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SESSION_KINDS = ('ajax', 'form')
+# Request kinds reported, in the order they happen in a session
+REQUEST_KINDS = ('upload_ajax', 'upload_form', 'status', 'download', 'download_batch', 'session')
+# Seconds to wait for a started server to answer
+STARTUP_TIMEOUT = 120
+SAMPLE_INTERVAL = 0.25
+LINK_PATTERN = re.compile(r'/download/([\w-]+)/([^"?&]+)')
+
+class Recorder:
+    """Thread-safe log of (kind, seconds, status) per request; status None for a failed connection"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = []
+        self.bytes = 0
+
+    def record(self, kind, seconds, status, size=0):
+        with self._lock:
+            self.requests.append((kind, seconds, status))
+            self.bytes += size
+
+    def summary(self, elapsed):
+        """Per-kind counts, error rates and latency percentiles"""
+        with self._lock:
+            requests = list(self.requests)
+        results = {}
+        for kind in REQUEST_KINDS:
+            entries = [entry for entry in requests if entry[0] == kind]
+            if not entries:
+                continue
+            latencies = [seconds for _, seconds, _ in entries]
+            rejected = sum(1 for _, _, status in entries if status == 503)
+            errors = sum(1 for _, _, status in entries if not ok(status))
+            results[kind] = {
+                'count': len(entries),
+                'errors': errors,
+                'rejected': rejected,
+                'error_rate': errors / len(entries),
+                'per_second': len(entries) / elapsed,
+                'p50_ms': bench.percentile(latencies, 0.50) * 1000,
+                'p95_ms': bench.percentile(latencies, 0.95) * 1000,
+                'p99_ms': bench.percentile(latencies, 0.99) * 1000,
+                'max_ms': max(latencies) * 1000,
+            }
+        return results
+
+def ok(status):
+    return status is not None and (200 <= status < 300 or status == 304)
+
+class Client:
+    """Minimal HTTP client; redirects are answers, not followed, since the app redirects on errors"""
+
+    def __init__(self, url, recorder, timeout):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.recorder = recorder
+        self.timeout = timeout
+
+    def request(self, kind, method, path, body=None, headers=None):
+        """Returns (status, body); status is None when the connection failed"""
+        started = time.perf_counter()
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            connection.request(method, path, body=body, headers=headers or {})
+            response = connection.getresponse()
+            status, data = response.status, response.read()
+        except (OSError, http.client.HTTPException):
+            status, data = None, b''
+        finally:
+            connection.close()
+        self.recorder.record(kind, time.perf_counter() - started, status, len(data))
+        return status, data
+
+def multipart(fields, files):
+    """Encode form fields and (name, filename, data) files as multipart/form-data"""
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, filename, data in files:
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: application/octet-stream\r\n\r\n'.encode() + data + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+def unique(data):
+    """data with a trailing ISO BMFF 'free' box of random bytes, which PNG, JPEG and HEIC decoders
+    skip; every upload then misses the server's conversion cache"""
+    return data + (24).to_bytes(4, 'big') + b'free' + os.urandom(16)
+
+class Session:
+    """One visitor: upload a batch, wait for it and download every output"""
+
+    def __init__(self, client, kind, mode, files, poll, options):
+        self.client = client
+        self.kind = kind
+        self.mode = mode
+        self.files = files
+        self.poll = poll
+        self.options = options
+
+    def run(self):
+        """Returns the number of files downloaded, None when the session failed"""
+        body, content_type = multipart({'mode': self.mode, **self.options},
+                                       [('files', name, data) for name, data in self.files])
+        headers = {'Content-Type': content_type}
+        if self.kind == 'ajax':
+            headers['X-Requested-With'] = 'XMLHttpRequest'
+            status, data = self.client.request('upload_ajax', 'POST', '/upload', body, headers)
+            if status != 202:
+                return None
+            batch_id, filenames = self.wait(json.loads(data))
+        else:
+            status, data = self.client.request('upload_form', 'POST', '/upload', body, headers)
+            if status != 200:
+                return None
+            links = LINK_PATTERN.findall(data.decode('utf-8', 'replace'))
+            batch_id = links[0][0] if links else None
+            filenames = list(dict.fromkeys(filename for _, filename in links))
+        if not filenames:
+            return None
+
+        failed = False
+        for filename in filenames:
+            status, _ = self.client.request('download', 'GET', f'/download/{batch_id}/{filename}')
+            failed = failed or not ok(status)
+        status, _ = self.client.request('download_batch', 'GET', f'/download_batch/{batch_id}')
+        return None if failed or not ok(status) else len(filenames)
+
+    def wait(self, payload):
+        """Poll the status of an AJAX upload; returns (batch_id, output filenames)"""
+        while True:
+            time.sleep(self.poll)
+            status, data = self.client.request('status', 'GET', payload['status_url'])
+            if not ok(status):
+                return None, []
+            result = json.loads(data)
+            if not result.get('success'):
+                return None, []
+            if result.get('state') == 'done':
+                return result['batch_id'], [entry['filename'] for entry in result['files']]
+
+class Server:
+    """The app started in its own working directory, for the duration of a run"""
+
+    def __init__(self, kind, workdir):
+        self.kind = kind
+        self.workdir = workdir
+        self.process = None
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.startup_seconds = None
+
+    def start(self):
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.abspath(ROOT),
+                                                           os.environ.get('PYTHONPATH', '')]).rstrip(os.pathsep))
+        if self.kind == 'gunicorn':
+            env['BIND'] = f"127.0.0.1:{self.port}"
+            command = [sys.executable, '-m', 'gunicorn', '-c', os.path.join(os.path.abspath(ROOT), 'gunicorn.conf.py'),
+                       'app:app']
+        else:
+            command = [sys.executable, '-c', "import sys; from app import app; "
+                       "app.run(host='127.0.0.1', port=int(sys.argv[1]), threaded=True)", str(self.port)]
+        self.log = open(os.path.join(self.workdir, 'server.log'), 'wb')
+        started = time.perf_counter()
+        self.process = subprocess.Popen(command, cwd=self.workdir, env=env, stdout=self.log,
+                                        stderr=subprocess.STDOUT, start_new_session=True)
+        while time.perf_counter() - started < STARTUP_TIMEOUT and self.process.poll() is None:
+            connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=5)
+            try:
+                connection.request('GET', '/')
+                if connection.getresponse().status == 200:
+                    self.startup_seconds = time.perf_counter() - started
+                    return
+            except (OSError, http.client.HTTPException):
+                pass
+            finally:
+                connection.close()
+            time.sleep(0.2)
+        self.stop()
+        with open(os.path.join(self.workdir, 'server.log'), errors='replace') as f:
+            raise RuntimeError(f"The {self.kind} server didn't start:\n{f.read()[-4000:]}")
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)
+            try:
+                self.process.wait(30)
+            except subprocess.TimeoutExpired:
+                os.killpg(self.process.pid, signal.SIGKILL)
+                self.process.wait()
+        self.log.close()
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def tree_rss_bytes(pid):
+    """Resident memory of a process and all its descendants, from /proc (Linux only)"""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # The command name may contain spaces; the parent pid follows its closing paren
+                parent = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+        children.setdefault(parent, []).append(int(entry))
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        pending.extend(children.get(current, []))
+        try:
+            with open(f'/proc/{current}/statm') as f:
+                total += int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, IndexError):
+            pass
+    return total
+
+def disk_usage_bytes(folder):
+    """Bytes allocated to the files under folder, like du"""
+    total = 0
+    for path, _, filenames in os.walk(folder):
+        for filename in filenames:
+            try:
+                total += os.lstat(os.path.join(path, filename)).st_blocks * 512
+            except OSError:
+                pass
+    return total
+
+class Sampler(threading.Thread):
+    """Track the peak RSS of the server and the peak size of its converted/ folder"""
+
+    def __init__(self, pid, folder):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.folder = folder
+        self.peak_rss = 0
+        self.peak_disk = 0
+        self.stopped = threading.Event()
+
+    def sample(self):
+        if self.pid and os.path.isdir('/proc'):
+            self.peak_rss = max(self.peak_rss, tree_rss_bytes(self.pid))
+        if self.folder:
+            self.peak_disk = max(self.peak_disk, disk_usage_bytes(self.folder))
+
+    def run(self):
+        while not self.stopped.wait(SAMPLE_INTERVAL):
+            self.sample()
+
+def parse_mix(text):
+    """'ajax=3,form=1' -> {'ajax': 3.0, 'form': 1.0}; a bare kind weighs 1"""
+    mix = {}
+    for item in (item.strip() for item in text.split(',') if item.strip()):
+        kind, _, weight = item.partition('=')
+        if kind not in SESSION_KINDS:
+            raise argparse.ArgumentTypeError(f"unknown session kind: {kind}")
+        try:
+            mix[kind] = float(weight or 1)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"bad weight: {item}")
+    if not mix or not sum(mix.values()) > 0:
+        raise argparse.ArgumentTypeError('no session kinds')
+    return mix
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args, url, recorder, sessions_done):
+    """Drive sessions until the duration or session count is reached; returns elapsed seconds"""
+    formats = sorted({format for mode in args.modes for format in bench.MODE_FORMATS[mode]})
+    corpus = bench.build_corpus(args.corpus, args.sizes, formats, args.corpus_files)
+    contents = {}
+    for paths in corpus.values():
+        for path in paths:
+            with open(path, 'rb') as f:
+                contents[path] = f.read()
+    client = Client(url, recorder, args.timeout)
+    rng = random.Random(args.seed)
+    rng_lock = threading.Lock()
+    kinds, weights = zip(*args.mix.items())
+    options = {'profile': args.profile} if args.profile else {}
+    deadline = time.perf_counter() + args.duration
+    counter = iter(range(args.sessions)) if args.sessions else None
+    counter_lock = threading.Lock()
+
+    def next_session():
+        with rng_lock:
+            mode = rng.choice(args.modes)
+            size = rng.choice(args.sizes)
+            paths = [path for format in bench.MODE_FORMATS[mode] for path in corpus[(size, format)]]
+            picked = [rng.choice(paths) for _ in range(args.files)]
+            kind = rng.choices(kinds, weights)[0]
+        files = [(os.path.basename(path), unique(contents[path]) if args.unique else contents[path])
+                 for path in picked]
+        return Session(client, kind, mode, files, args.poll, options)
+
+    def more():
+        if time.perf_counter() >= deadline:
+            return False
+        if counter is None:
+            return True
+        with counter_lock:
+            return next(counter, None) is not None
+
+    def run_session(session, arrived):
+        converted = session.run()
+        recorder.record('session', time.perf_counter() - arrived, 200 if converted else None)
+        if converted:
+            sessions_done.append(converted)
+
+    started = time.perf_counter()
+    if args.rate:
+        # Open loop: sessions arrive on schedule whether or not earlier ones have finished, and
+        # their latency counts from arrival, so a saturated server shows as growing latency
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            arrival = time.perf_counter()
+            while more():
+                pool.submit(run_session, next_session(), arrival)
+                arrival += rng.expovariate(args.rate)
+                time.sleep(max(0.0, arrival - time.perf_counter()))
+    else:
+        def loop():
+            while more():
+                run_session(next_session(), time.perf_counter())
+
+        threads = [threading.Thread(target=loop) for _ in range(args.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return time.perf_counter() - started
+
+def print_table(results):
+    print(f"{'request':<16}{'count':>7}{'errors':>8}{'503s':>6}{'req/s':>8}{'p50 ms':>9}{'p95 ms':>9}"
+          f"{'p99 ms':>9}{'max ms':>9}")
+    for kind, result in results.items():
+        print(f"{kind:<16}{result['count']:>7}{result['errors']:>8}{result['rejected']:>6}"
+              f"{result['per_second']:>8.2f}{result['p50_ms']:>9.1f}{result['p95_ms']:>9.1f}"
+              f"{result['p99_ms']:>9.1f}{result['max_ms']:>9.1f}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test the ImgToAvif web app over HTTP')
+    parser.add_argument('--server', choices=['gunicorn', 'flask'],
+                        default='gunicorn' if importlib.util.find_spec('gunicorn') else 'flask',
+                        help='how to start the app (default: gunicorn when installed)')
+    parser.add_argument('--url', help='test a server already running at this URL instead of starting one')
+    parser.add_argument('--workdir', help="the server's working directory, whose converted/ is measured "
+                                          "(default: a temporary folder)")
+    parser.add_argument('--mix', default='ajax=3,form=1', type=parse_mix,
+                        help='session kinds and their weights (default: ajax=3,form=1)')
+    parser.add_argument('--modes', default='avif', type=lambda text: bench.split_list(text, bench.MODE_FORMATS))
+    parser.add_argument('--sizes', default='small', type=lambda text: bench.split_list(text, bench.SIZES),
+                        help=f"any of {', '.join(bench.SIZES)}")
+    parser.add_argument('--profile', help='AVIF profile sent with each upload (default: the server default)')
+    parser.add_argument('--files', type=int, default=3, help='files per uploaded batch')
+    parser.add_argument('--corpus-files', type=int, default=4, help='corpus files per size and format')
+    parser.add_argument('--concurrency', type=int, default=4, help='concurrent sessions')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='open-loop arrivals in sessions per second (default: closed loop)')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to start new sessions for')
+    parser.add_argument('--sessions', type=int, default=0, help='stop after this many sessions (default: no limit)')
+    parser.add_argument('--poll', type=float, default=0.25, help='seconds between status polls')
+    parser.add_argument('--timeout', type=float, default=300, help='seconds before a request fails')
+    parser.add_argument('--no-unique', dest='unique', action='store_false',
+                        help="upload corpus files unchanged, so repeats hit the server's conversion cache")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--corpus', default=bench.DEFAULT_CORPUS,
+                        help=f"corpus cache folder (default: {bench.DEFAULT_CORPUS})")
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args(argv)
+
+    server = None
+    workdir = args.workdir
+    scratch = None
+    if not args.url:
+        if not workdir:
+            workdir = scratch = tempfile.mkdtemp(prefix='imgtoavif-load-')
+        os.makedirs(workdir, exist_ok=True)
+        server = Server(args.server, workdir)
+        print(f"Starting {args.server} in {workdir}...", flush=True)
+        server.start()
+        print(f"Ready in {server.startup_seconds:.1f}s at {server.url}", flush=True)
+    url = args.url or server.url
+    converted = os.path.join(workdir, 'converted') if workdir else None
+
+    recorder = Recorder()
+    sessions_done = []
+    sampler = Sampler(server.process.pid if server else None, converted)
+    sampler.start()
+    try:
+        print(f"Running for {args.duration:g}s "
+              f"({f'{args.rate:g} sessions/s' if args.rate else f'{args.concurrency} concurrent sessions'})...",
+              flush=True)
+        elapsed = run(args, url, recorder, sessions_done)
+        sampler.stopped.set()
+        sampler.join()
+        sampler.sample()
+        final_disk = disk_usage_bytes(converted) if converted else None
+    finally:
+        sampler.stopped.set()
+        if server:
+            server.stop()
+        if scratch:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    requests = recorder.summary(elapsed)
+    results = {
+        'elapsed_seconds': elapsed,
+        'sessions': len(sessions_done),
+        'sessions_per_second': len(sessions_done) / elapsed,
+        'files_per_second': sum(sessions_done) / elapsed,
+        'mb_downloaded_per_second': recorder.bytes / (1024 * 1024) / elapsed,
+        'error_rate': sum(result['errors'] for kind, result in requests.items() if kind != 'session')
+                      / max(1, sum(result['count'] for kind, result in requests.items() if kind != 'session')),
+        'startup_seconds': server.startup_seconds if server else None,
+        'peak_rss_mb': sampler.peak_rss / (1024 * 1024) if sampler.peak_rss else None,
+        'peak_converted_mb': sampler.peak_disk / (1024 * 1024) if converted else None,
+        'final_converted_mb': final_disk / (1024 * 1024) if converted else None,
+        'requests': requests,
+    }
+
+    print_table(requests)
+    print(f"{results['sessions']} sessions in {elapsed:.1f}s: {results['sessions_per_second']:.2f} sessions/s, "
+          f"{results['files_per_second']:.2f} files/s, error rate {results['error_rate']:.1%}")
+    if results['peak_rss_mb'] is not None:
+        print(f"Server peak RSS {results['peak_rss_mb']:.0f} MB")
+    if converted:
+        print(f"converted/ peak {results['peak_converted_mb']:.1f} MB, final {results['final_converted_mb']:.1f} MB")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'environment': {**bench.environment(), 'commit': git_commit(),
+                                       'server': 'external' if args.url else args.server},
+                       'options': {'mix': args.mix, 'modes': args.modes, 'sizes': args.sizes,
+                                   'profile': args.profile, 'files': args.files, 'concurrency': args.concurrency,
+                                   'rate': args.rate, 'duration': args.duration, 'sessions': args.sessions,
+                                   'unique': args.unique, 'seed': args.seed},
+                       'results': results}, f, indent=2)
+        print(f"Wrote {args.json}")
+    return 1 if not sessions_done else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
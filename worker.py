@@ -0,0 +1,45 @@
+"""Conversion worker for multi-node deployments.
+
+Takes the batches the web front-ends queue on the broker and converts them,
+reading the uploads from and writing the outputs and status to the shared
+storage. Run any number of them, on any node that mounts the storage:
+
+    BROKER=directory STORAGE_FOLDER=/mnt/imgtoavif python worker.py
+
+The front-ends run with the same BROKER and STORAGE_FOLDER. SIGTERM or
+Ctrl+C lets the batches being converted finish before the worker exits.
+"""
+import argparse
+import signal
+import sys
+import threading
+import broker
+import jobs
+import results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert the batches queued by the ImgToAvif front-ends')
+    parser.add_argument('--threads', type=int, default=jobs.JOB_WORKERS,
+                        help=f"batches converted at the same time (default: {jobs.JOB_WORKERS})")
+    args = parser.parse_args(argv)
+
+    if broker.task_broker is None or isinstance(broker.task_broker, broker.MemoryBroker):
+        print('Set BROKER to the shared broker the front-ends use, such as BROKER=directory', file=sys.stderr)
+        return 2
+    if results.RESULT_STORE == 'memory':
+        print("RESULT_STORE=memory keeps outputs where the front-ends can't serve them; use disk", file=sys.stderr)
+        return 2
+
+    stopping = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stopping.set())
+    print(f"Converting {broker.BROKER} tasks, {args.threads} batches at a time", flush=True)
+    workers = jobs.serve(broker.task_broker, args.threads, stopping)
+    # Joined with a timeout so the signal handlers get to run
+    while any(worker.is_alive() for worker in workers):
+        for worker in workers:
+            worker.join(timeout=1)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())